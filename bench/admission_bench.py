@@ -0,0 +1,195 @@
+"""Connection admission, idle eviction and rate limit benchmark.
+
+Runs three scenarios against each engine:
+
+    stall  connections that never send a nickname are opened first, then
+           connections one after another time the server's NICK request;
+           the silent ones must not hold them up, and are closed after
+           --handshake-timeout
+    sweep  bots register and then never answer the server's pings, next to
+           bots that do; reports how long the sweeper took to close the
+           silent ones, the server's CPU meanwhile and how many answering
+           bots are still connected
+    flood  one bot writes chat lines as fast as it can to a server with
+           --rate-messages; a listener reports the rate the lines arrive at
+
+    python bench/admission_bench.py --silent 500 --idle 2000 --rate 100
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import cpu_seconds, free_port, percentile, raise_fd_limit, start_server, stop_server
+import protocol
+from load_test import join
+
+
+async def closed_after(reader, started):
+    """Seconds from started until the server closed the connection"""
+    try:
+        while await reader.read(65536):
+            pass
+    except ConnectionError:
+        pass
+    return time.monotonic() - started
+
+
+async def answer_pings(reader, writer):
+    decoder = protocol.FrameDecoder()
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            decoder.feed(data)
+            for frame_type, _ in decoder:
+                if frame_type == protocol.PING:
+                    writer.write(protocol.encode_frame(protocol.PONG))
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def stall(port, args):
+    started = time.monotonic()
+    silent = await asyncio.gather(*(asyncio.open_connection('127.0.0.1', port) for _ in range(args.silent)))
+    closing = [asyncio.ensure_future(closed_after(reader, started)) for reader, _ in silent]
+    times = []
+    for _ in range(args.connections):
+        connect_started = time.perf_counter()
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        header = await reader.readexactly(protocol.HEADER.size)
+        await reader.readexactly(protocol.HEADER.unpack(header)[1])
+        times.append((time.perf_counter() - connect_started) * 1000)
+        writer.close()
+    closed = await asyncio.wait_for(asyncio.gather(*closing), args.handshake_timeout + 10)
+    return {
+        'scenario': 'stall',
+        'silent': args.silent,
+        'connections': args.connections,
+        'connect_ms_p50': round(percentile(times, 50), 3),
+        'connect_ms_p99': round(percentile(times, 99), 3),
+        'silent_closed_s_max': round(max(closed), 2),
+    }
+
+
+async def sweep(proc, port, args):
+    answering = []
+    tasks = []
+    for i in range(args.answering):
+        reader, writer = await join(port, f"answering{i}")
+        answering.append(writer)
+        tasks.append(asyncio.ensure_future(answer_pings(reader, writer)))
+    cpu_before = cpu_seconds(proc.pid)
+    started = time.monotonic()
+    closing = []
+    silent = []  # Writers that are collected close their connections
+    for i in range(args.idle):
+        reader, writer = await join(port, f"silent{i}")
+        silent.append(writer)
+        # Silent from the moment it joined
+        closing.append(asyncio.ensure_future(closed_after(reader, time.monotonic())))
+    closed = await asyncio.wait_for(asyncio.gather(*closing), args.idle_timeout + args.heartbeat_interval + 30)
+    elapsed = time.monotonic() - started
+    cpu = cpu_seconds(proc.pid) - cpu_before
+    alive = sum(not task.done() for task in tasks)
+    for writer in answering:
+        writer.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {
+        'scenario': 'sweep',
+        'idle': args.idle,
+        'idle_timeout_s': args.idle_timeout,
+        'silent_s_before_eviction_p50': round(percentile(closed, 50), 2),
+        'silent_s_before_eviction_max': round(max(closed), 2),
+        'server_cpu_percent': round(cpu / elapsed * 100, 2),
+        'answering': args.answering,
+        'answering_alive': alive,
+    }
+
+
+async def flood(port, args):
+    listener_reader, listener_writer = await join(port, 'listener')
+    times = []
+
+    async def count_lines():
+        decoder = protocol.FrameDecoder()
+        while len(times) < args.lines:
+            data = await listener_reader.read(65536)
+            if not data:
+                return
+            decoder.feed(data)
+            for frame_type, payload in decoder:
+                if frame_type == protocol.CHAT and b': flood' in payload:
+                    times.append(time.monotonic())
+
+    counting = asyncio.ensure_future(count_lines())
+    _, writer = await join(port, 'flooder')
+    await asyncio.sleep(0.2)
+    started = time.monotonic()
+    for _ in range(args.lines):
+        writer.write(protocol.encode_text(protocol.CHAT, 'flood'))
+    await writer.drain()
+    written = time.monotonic() - started
+    await asyncio.wait_for(counting, args.lines / args.rate + 30)
+    elapsed = times[-1] - started
+    writer.close()
+    listener_writer.close()
+    return {
+        'scenario': 'flood',
+        'lines': args.lines,
+        'rate_limit': args.rate,
+        'burst': args.burst,
+        'written_per_s': round(args.lines / written, 1) if written else None,
+        'arrived_per_s': round(len(times) / elapsed, 1),
+        'expected_s': round((args.lines - args.burst) / args.rate, 2),
+        'took_s': round(elapsed, 2),
+    }
+
+
+async def run(engine, args):
+    timeouts = ['--handshake-timeout', str(args.handshake_timeout), '--heartbeat-interval', str(args.heartbeat_interval),
+                '--idle-timeout', str(args.idle_timeout), '--log-interval', '60', '--listen-backlog', '1024']
+    for scenario in args.scenarios:
+        port = free_port()
+        extra = timeouts
+        if scenario == 'flood':
+            extra = timeouts + ['--rate-messages', str(args.rate), '--burst-messages', str(args.burst)]
+        proc = start_server(port, engine, extra)
+        try:
+            if scenario == 'stall':
+                result = await stall(port, args)
+            elif scenario == 'sweep':
+                result = await sweep(proc, port, args)
+            else:
+                result = await flood(port, args)
+            print(json.dumps({'engine': engine, **result}))
+        finally:
+            stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engines', nargs='+', default=['threads', 'eventloop'])
+    parser.add_argument('--scenarios', nargs='+', default=['stall', 'sweep', 'flood'],
+                        choices=['stall', 'sweep', 'flood'])
+    parser.add_argument('--silent', type=int, default=500, help="connections that never send a nickname")
+    parser.add_argument('--connections', type=int, default=200, help="connections timed in the stall scenario")
+    parser.add_argument('--idle', type=int, default=2000, help="bots that never answer pings")
+    parser.add_argument('--answering', type=int, default=20, help="bots that answer pings")
+    parser.add_argument('--lines', type=int, default=1000, help="lines written by the flooding bot")
+    parser.add_argument('--rate', type=float, default=100, help="--rate-messages of the flood server")
+    parser.add_argument('--burst', type=float, default=20, help="--burst-messages of the flood server")
+    parser.add_argument('--handshake-timeout', type=float, default=2.0)
+    parser.add_argument('--heartbeat-interval', type=float, default=1.0)
+    parser.add_argument('--idle-timeout', type=float, default=3.0)
+    args = parser.parse_args()
+    raise_fd_limit()
+    for engine in args.engines:
+        asyncio.run(run(engine, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Write batching benchmark.
+
+Connects a lobby full of clients, has a few of them send timestamped lines
+at several rates, and compares the server with batching off and with a few
+batch delays. Reports send syscalls per delivered message (counted by the
+server's outboxes), delivery latency and server CPU. The server runs in a
+forked child of the bench so its counters can be read directly:
+
+    python bench/batch_bench.py --rates 200 1000 5000 --batch-delays 0 200 1000
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import (cpu_seconds, free_port, percentile, raise_fd_limit, server_call,
+                    start_server_process, stop_server_process)
+import protocol
+from load_test import join
+
+
+def send_counts(pipe):
+    """(send calls, frames sent) summed over every client's queue"""
+    queues = server_call(pipe, 'queue_stats').values()
+    return sum(queue['writes'] for queue in queues), sum(queue['sent'] for queue in queues)
+
+
+async def listen(reader, latencies):
+    decoder = protocol.FrameDecoder()
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            now = time.monotonic_ns()
+            decoder.feed(data)
+            for frame_type, payload in decoder:
+                if frame_type == protocol.CHAT and b': bench:' in payload:
+                    sent = int(payload.rsplit(b':', 1)[1])
+                    latencies.append((now - sent) / 1e6)
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def run(engine, batch_delay, rate, args):
+    port = free_port()
+    proc, pipe = start_server_process(port, engine, {'batch_delay': batch_delay / 1e6})
+    writers = []
+    tasks = []
+    latencies = []
+    try:
+        for i in range(args.clients):
+            reader, writer = await join(port, f"c{i}")
+            writers.append(writer)
+            tasks.append(asyncio.ensure_future(listen(reader, latencies)))
+        await asyncio.sleep(args.settle)
+
+        writes_before, frames_before = send_counts(pipe)
+        cpu_before = cpu_seconds(proc.pid)
+        senders = writers[:args.senders]
+        total = int(rate * args.duration)
+        tick = 0.005
+        started = time.monotonic()
+        for sent in range(total):
+            senders[sent % len(senders)].write(protocol.encode_text(protocol.CHAT, f"bench:{time.monotonic_ns()}"))
+            # Keep to the rate: sleep whenever the sender is a tick ahead of schedule
+            ahead = started + (sent + 1) / rate - time.monotonic()
+            if ahead > tick:
+                await asyncio.sleep(ahead)
+
+        expected = total * (args.clients - 1)
+        deadline = time.monotonic() + args.timeout
+        while len(latencies) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - started
+        cpu_used = cpu_seconds(proc.pid) - cpu_before
+        writes_after, frames_after = send_counts(pipe)
+        writes = writes_after - writes_before
+        frames = frames_after - frames_before
+
+        return {
+            'engine': engine,
+            'batch_delay_us': batch_delay,
+            'rate': rate,
+            'clients': args.clients,
+            'messages_sent': total,
+            'deliveries_expected': expected,
+            'deliveries': len(latencies),
+            'send_calls': writes,
+            'send_calls_per_delivery': round(writes / frames, 3) if frames else None,
+            'latency_ms_p50': round(percentile(latencies, 50), 3),
+            'latency_ms_p99': round(percentile(latencies, 99), 3),
+            'server_cpu_ms_per_message': round(cpu_used * 1000 / total, 3) if total else None,
+            'elapsed_s': round(elapsed, 3),
+        }
+    finally:
+        for writer in writers:
+            writer.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        stop_server_process(proc, pipe)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engines', nargs='+', default=['threads', 'eventloop'])
+    parser.add_argument('--batch-delays', nargs='+', type=int, default=[0, 200, 1000],
+                        help="microseconds; 0 is batching off")
+    parser.add_argument('--rates', nargs='+', type=float, default=[200, 1000, 5000], help="lines per second")
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--senders', type=int, default=4, help="clients that send the lines")
+    parser.add_argument('--duration', type=float, default=3.0, help="seconds of sending per run")
+    parser.add_argument('--settle', type=float, default=0.5, help="seconds to wait after connecting")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for engine in args.engines:
+        for rate in args.rates:
+            for batch_delay in args.batch_delays:
+                print(json.dumps(await run(engine, batch_delay, rate, args)))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+"""Helpers shared by the benchmark scripts"""
+import multiprocessing
+import os
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+
+def raise_fd_limit():
+    # Thousands of sockets need more than the usual 1024 descriptors, in this
+    # process and in the server started from it
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, engine='threads', extra_args=()):
+    """Start chat_server.py in a subprocess and wait until it is listening"""
+    cmd = [sys.executable, '-u', os.path.join(REPO_ROOT, 'chat_server.py'),
+           '--host', '127.0.0.1', '--port', str(port), '--engine', engine]
+    cmd.extend(extra_args)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=REPO_ROOT)
+
+    for line in proc.stdout:
+        if b'Server started' in line:
+            break
+    else:
+        raise RuntimeError(f"Server exited before listening (code {proc.wait()})")
+
+    # The server prints every message; keep its pipe drained so it never blocks
+    threading.Thread(target=lambda: proc.stdout.read(), daemon=True).start()
+    return proc
+
+
+def serve(port, engine, options, pipe):
+    # Runs in the child started by start_server_process
+    sys.stdout = open(os.devnull, 'w')  # The server prints every line it relays
+    if engine == 'eventloop':
+        from event_server import EventLoopServer as server_class
+    else:
+        from chat_server import Server as server_class
+    server = server_class('127.0.0.1', port, **options)
+    threading.Thread(target=server.receive, daemon=True).start()
+    pipe.send('ready')
+    while True:
+        method = pipe.recv()
+        if method is None:
+            return
+        target = server
+        for name in method.split('.'):  # e.g. 'metrics.summary'
+            target = getattr(target, name)
+        pipe.send(target())
+
+
+def start_server_process(port, engine='threads', options=None):
+    """Run a server in a forked child process, for benches that read its counters.
+
+    Returns (process, pipe); server_call(pipe, 'queue_stats') calls one of the
+    server's stats methods (or 'metrics.summary') and returns the result.
+    """
+    pipe, child_pipe = multiprocessing.Pipe()
+    proc = multiprocessing.get_context('fork').Process(target=serve, args=(port, engine, options or {}, child_pipe),
+                                                       daemon=True)
+    proc.start()
+    pipe.recv()
+    return proc, pipe
+
+
+def server_call(pipe, method):
+    pipe.send(method)
+    return pipe.recv()
+
+
+def stop_server_process(proc, pipe):
+    pipe.send(None)
+    proc.join(timeout=5)
+    if proc.is_alive():
+        proc.kill()
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def rss_kb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    return (int(fields[11]) + int(fields[12])) / ticks
+
+
+def child_pids(pid):
+    """Direct child processes, e.g. the workers of a server started with --workers"""
+    pids = []
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as f:
+            pids.extend(int(child) for child in f.read().split())
+    return pids
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def wait_until(predicate, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(interval)
+    return predicate()
@@ -0,0 +1,199 @@
+"""Compression benchmark.
+
+Runs a text-heavy workload (chat lines, some of them long pastes) and a
+file-heavy one (one upload relayed to every receiver) with compression off
+and with each installed codec. File workloads run with each --file-relay mode,
+since broadcast and spool compress file data on different paths. Reports the
+bytes the receivers read off the wire against the bytes they would have read
+uncompressed, the server's compression ratio and CPU time, server CPU overall
+and, for files, the relay throughput:
+
+    python bench/compression_bench.py --workloads text file-random --codecs off zlib
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from common import (cpu_seconds, free_port, raise_fd_limit, server_call, start_server_process,
+                    stop_server_process)
+import compression
+import protocol
+
+WORDS = ("the server relays every frame to each client in the channel while uploads are spooled "
+         "to disk and sent with sendfile error warning info debug request response connection "
+         "timeout retry nickname message file chunk offset length checksum").split()
+
+
+def chat_lines(count, seed=1):
+    """Mostly short lines, with a pasted log or traceback every so often"""
+    rng = random.Random(seed)
+    lines = []
+    for i in range(count):
+        if rng.random() < 0.2:
+            rows = [f"2024-05-0{rng.randint(1, 9)} 12:{rng.randint(10, 59)}:{rng.randint(10, 59)} "
+                    f"{rng.choice(['INFO', 'WARN', 'ERROR'])} " + ' '.join(rng.choices(WORDS, k=12))
+                    for _ in range(rng.randint(5, 40))]
+            lines.append('\n'.join(rows))
+        else:
+            lines.append(' '.join(rng.choices(WORDS, k=rng.randint(3, 20))))
+    return lines
+
+
+def file_body(kind, size, seed=1):
+    rng = random.Random(seed)
+    if kind == 'random':
+        return rng.randbytes(size)
+    text = bytearray()
+    while len(text) < size:
+        text += (f"{rng.randint(0, 10 ** 6)},{rng.choice(WORDS)},{rng.random():.6f}," +
+                 ' '.join(rng.choices(WORDS, k=6)) + "\n").encode()
+    return bytes(text[:size])
+
+
+async def join(port, nickname, codec):
+    """Connect and negotiate codec (None leaves compression off)"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    header = await reader.readexactly(protocol.HEADER.size)
+    payload = await reader.readexactly(protocol.HEADER.unpack(header)[1])
+    offered = protocol.decode_json(payload).get('compression', []) if payload else []
+    if codec is not None and codec.name in offered:
+        writer.write(protocol.encode_json(protocol.COMPRESSION, {'codec': codec.name}))
+    writer.write(protocol.encode_text(protocol.NICK, nickname))
+    await writer.drain()
+    return reader, writer
+
+
+class Receiver:
+    def __init__(self):
+        self.decoder = protocol.FrameDecoder(codecs=compression.DECODERS)
+        self.wire_bytes = 0
+        self.plain_bytes = 0  # What the same frames take uncompressed
+        self.lines = 0
+        self.complete = False
+
+    async def run(self, reader):
+        try:
+            while True:
+                data = await reader.read(262144)
+                if not data:
+                    return
+                self.wire_bytes += len(data)
+                self.decoder.feed(data)
+                for frame_type, payload in self.decoder:
+                    self.plain_bytes += protocol.HEADER.size + len(payload)
+                    if frame_type == protocol.CHAT and payload.startswith(b'sender: '):
+                        self.lines += 1
+                    elif frame_type == protocol.FILE_COMPLETE:
+                        self.complete = True
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+
+async def run(workload, codec_name, file_relay, args):
+    codec = compression.CODECS.get(codec_name)
+    port = free_port()
+    proc, pipe = start_server_process(port, args.engine, {'file_relay': file_relay})
+    writers = []
+    tasks = []
+    receivers = []
+    try:
+        for i in range(args.receivers):
+            reader, writer = await join(port, f"r{i}", codec)
+            receiver = Receiver()
+            receivers.append(receiver)
+            writers.append(writer)
+            tasks.append(asyncio.ensure_future(receiver.run(reader)))
+        sender_reader, sender = await join(port, "sender", None)
+        writers.append(sender)
+        await asyncio.sleep(args.settle)
+        for receiver in receivers:
+            receiver.wire_bytes = receiver.plain_bytes = 0  # Join notices don't count
+
+        stats_before = server_call(pipe, 'compression_stats')
+        cpu_before = cpu_seconds(proc.pid)
+        started = time.monotonic()
+        if workload == 'text':
+            lines = chat_lines(args.lines)
+            for line in lines:
+                sender.write(protocol.encode_text(protocol.CHAT, line))
+                await sender.drain()
+            done = lambda: all(receiver.lines == len(lines) for receiver in receivers)
+        else:
+            body = file_body(workload.split('-')[1], args.size_mb * 1024 * 1024)
+            sender.write(protocol.encode_json(protocol.FILE_OFFER, {'id': 1, 'name': 'bench.dat', 'size': len(body)}))
+            for offset in range(0, len(body), args.chunk):
+                sender.write(protocol.encode_file_data(1, offset, body[offset:offset + args.chunk]))
+                await sender.drain()
+            done = lambda: all(receiver.complete for receiver in receivers)
+
+        deadline = time.monotonic() + args.timeout
+        while not done() and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        elapsed = time.monotonic() - started
+        cpu_used = cpu_seconds(proc.pid) - cpu_before
+        stats_after = server_call(pipe, 'compression_stats')
+
+        wire = sum(receiver.wire_bytes for receiver in receivers)
+        plain = sum(receiver.plain_bytes for receiver in receivers)
+        result = {
+            'workload': workload,
+            'codec': codec_name,
+            'engine': args.engine,
+            'file_relay': file_relay,
+            'receivers': args.receivers,
+            'complete': done(),
+            'wire_mb': round(wire / 1e6, 3),
+            'uncompressed_mb': round(plain / 1e6, 3),
+            'bandwidth_saved_percent': round((1 - wire / plain) * 100, 1) if plain else None,
+            'server_cpu_s': round(cpu_used, 3),
+            'elapsed_s': round(elapsed, 3),
+        }
+        if workload != 'text':
+            result['file_mb_per_s'] = round(args.size_mb * 1024 * 1024 / elapsed / 1e6, 1)
+        if codec is not None:
+            before, after = stats_before[codec_name], stats_after[codec_name]
+            bytes_in = after['bytes_in'] - before['bytes_in']
+            result.update({
+                'frames_compressed': after['frames'] - before['frames'],
+                'frames_skipped': after['skipped'] - before['skipped'],
+                'compression_ratio': round((after['bytes_out'] - before['bytes_out']) / bytes_in, 3)
+                if bytes_in else None,
+                'compress_cpu_ms': round(after['compress_ms'] - before['compress_ms'], 3),
+            })
+        return result
+    finally:
+        for writer in writers:
+            writer.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        stop_server_process(proc, pipe)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workloads', nargs='+', default=['text', 'file-text', 'file-random'],
+                        help="text, file-text (compressible upload) or file-random (incompressible)")
+    parser.add_argument('--codecs', nargs='+', default=['off'] + list(compression.CODECS))
+    parser.add_argument('--engine', default='eventloop', choices=['threads', 'eventloop'])
+    parser.add_argument('--file-relay', nargs='+', default=['broadcast', 'spool'], choices=['broadcast', 'spool'])
+    parser.add_argument('--receivers', type=int, default=10)
+    parser.add_argument('--lines', type=int, default=2000, help="chat lines in the text workload")
+    parser.add_argument('--size-mb', type=int, default=16, help="upload size in the file workloads")
+    parser.add_argument('--chunk', type=int, default=1024 * 1024, help="upload frame size")
+    parser.add_argument('--settle', type=float, default=0.5, help="seconds to wait after connecting")
+    parser.add_argument('--timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for workload in args.workloads:
+        # Chat lines don't go through the file relay
+        for file_relay in args.file_relay[:1] if workload == 'text' else args.file_relay:
+            for codec_name in args.codecs:
+                print(json.dumps(await run(workload, codec_name, file_relay, args)))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,140 @@
+"""Channel fan-out benchmark.
+
+Splits the connected clients into channels of a fixed size, has one member of
+each of a few channels send timestamped lines, and reports delivery latency
+and server CPU per message. With channel-indexed fan-out the cost per message
+follows the channel size and stays flat as the server grows; a channel size
+of 0 puts everyone in the lobby, the old single-room behaviour:
+
+    python bench/fanout_bench.py --clients 100 1000 --channel-sizes 10 0
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import (cpu_seconds, free_port, percentile, raise_fd_limit,
+                    start_server, stop_server)
+import protocol
+import sessions
+from load_test import join
+
+
+async def listen(reader, latencies, counts, index):
+    decoder = protocol.FrameDecoder()
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            now = time.monotonic_ns()
+            decoder.feed(data)
+            for frame_type, payload in decoder:
+                # "[#room] <nickname>: bench:<send time>", or without the channel in the lobby
+                if frame_type == protocol.CHAT and b': bench:' in payload:
+                    sent = int(payload.rsplit(b':', 1)[1])
+                    latencies.append((now - sent) / 1e6)
+                    counts[index] += 1
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def run(engine, clients, channel_size, args):
+    port = free_port()
+    proc = start_server(port, engine)
+    size = channel_size or clients
+    channel_count = (clients + size - 1) // size
+    writers = []
+    tasks = []
+    latencies = []
+    counts = [0] * clients
+    try:
+        limiter = asyncio.Semaphore(args.concurrency)
+
+        async def client(i):
+            async with limiter:
+                reader, writer = await join(port, f"c{i}")
+                if channel_size:
+                    writer.write(protocol.encode_json(protocol.JOIN, {'channel': f"room{i // size}"}))
+                    writer.write(protocol.encode_json(protocol.PART, {'channel': sessions.LOBBY}))
+                    await writer.drain()
+            writers.append((i, writer))
+            tasks.append(asyncio.ensure_future(listen(reader, latencies, counts, i)))
+
+        await asyncio.gather(*(client(i) for i in range(clients)))
+        await asyncio.sleep(args.settle)
+
+        # The first member of each of the first few channels talks
+        senders = [(i // size, writer) for i, writer in writers if i % size == 0 and i // size < args.active]
+        cpu_before = cpu_seconds(proc.pid)
+        started = time.monotonic()
+        for _ in range(args.messages):
+            for room, writer in senders:
+                marker = f"bench:{time.monotonic_ns()}"
+                if channel_size:
+                    writer.write(protocol.encode_json(protocol.CHANNEL_MESSAGE,
+                                                      {'channel': f"room{room}", 'text': marker}))
+                else:
+                    writer.write(protocol.encode_text(protocol.CHAT, marker))
+            await asyncio.sleep(1 / args.rate)
+
+        members = [min(size, clients - room * size) for room in range(min(args.active, channel_count))]
+        expected = sum(member_count - 1 for member_count in members) * args.messages
+        deadline = time.monotonic() + args.timeout
+        while len(latencies) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)  # Anything that should not have been delivered at all
+        cpu_used = cpu_seconds(proc.pid) - cpu_before
+        sent = len(senders) * args.messages
+
+        outsiders = sum(counts[i] for i in range(clients) if i // size >= args.active)
+        return {
+            'engine': engine,
+            'clients': clients,
+            'channel_size': size,
+            'channels': channel_count,
+            'messages_sent': sent,
+            'deliveries_expected': expected,
+            'deliveries': len(latencies),
+            'delivered_outside_channel': outsiders,
+            'latency_ms_p50': round(percentile(latencies, 50), 3),
+            'latency_ms_p99': round(percentile(latencies, 99), 3),
+            'server_cpu_ms_per_message': round(cpu_used * 1000 / sent, 3) if sent else None,
+            'elapsed_s': round(time.monotonic() - started, 3),
+        }
+    finally:
+        for _, writer in writers:
+            writer.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        stop_server(proc)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engines', nargs='+', default=['threads', 'eventloop'])
+    parser.add_argument('--clients', nargs='+', type=int, default=[100, 1000], help="connected clients")
+    parser.add_argument('--channel-sizes', nargs='+', type=int, default=[10, 0],
+                        help="members per channel; 0 puts everyone in the lobby")
+    parser.add_argument('--active', type=int, default=5, help="channels with someone talking")
+    parser.add_argument('--messages', type=int, default=50, help="lines per talking member")
+    parser.add_argument('--rate', type=float, default=50, help="rounds of messages per second")
+    parser.add_argument('--concurrency', type=int, default=5, help="simultaneous connection attempts")
+    parser.add_argument('--settle', type=float, default=1.0, help="seconds to wait after connecting")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    results = []
+    for engine in args.engines:
+        for clients in args.clients:
+            for channel_size in args.channel_sizes:
+                result = await run(engine, clients, channel_size, args)
+                print(json.dumps(result))
+                results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+"""GUI chat rendering benchmark.
+
+A thread posts chat lines to the GUI's ChatView as fast as it can, or at
+--rate lines per second, while the Tk loop renders them. The bench compares
+the batched view with one that renders a line per tick, like the old GUI.
+It reports render time per 1,000 lines, the time until every line was shown,
+and the lines left in the widget after trimming. Tk needs a display; on a
+headless machine run it under xvfb-run:
+
+    python bench/gui_bench.py --messages 20000 --max-lines 5000
+"""
+import argparse
+import json
+import threading
+import time
+import tkinter as tk
+
+import common  # Puts the repository on sys.path
+from gui import ChatView
+
+CONFIGS = {
+    'batched': {'interval_ms': 50, 'batch_lines': 2000},
+    'per-line': {'interval_ms': 1, 'batch_lines': 1},
+}
+
+
+def run(name, config, args):
+    root = tk.Tk()
+    view = ChatView(root, args.max_lines, wrap=tk.WORD, width=70, height=30, **config)
+    view.text.pack()
+    posted = [None, None]  # start and end of posting
+
+    def post_lines():
+        posted[0] = time.monotonic()
+        for i in range(args.messages):
+            view.post(f"bot{i % 50}: line {i} of the benchmark, long enough to look like chat")
+            if args.rate:
+                ahead = posted[0] + (i + 1) / args.rate - time.monotonic()
+                if ahead > 0:
+                    time.sleep(ahead)
+        posted[1] = time.monotonic()
+
+    deadline = time.monotonic() + args.timeout
+
+    def check():
+        if view.rendered >= args.messages or time.monotonic() > deadline:
+            root.quit()
+        else:
+            root.after(10, check)
+
+    threading.Thread(target=post_lines, daemon=True).start()
+    root.after(10, check)
+    root.mainloop()
+    finished = time.monotonic()
+    lines = int(view.text.index('end-1c').split('.')[0]) - 1
+    root.destroy()
+    return {
+        'config': name,
+        'messages': args.messages,
+        'rendered': view.rendered,
+        'render_ms_per_1000': round(view.render_ms_per_1000(), 2),
+        'post_seconds': round(posted[1] - posted[0], 3) if posted[1] else None,
+        'shown_after_s': round(finished - posted[0], 3),
+        'lines_in_widget': lines,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rate', type=float, default=0, help="lines per second to post; 0 posts as fast as possible")
+    parser.add_argument('--max-lines', type=int, default=5000, help="scrollback kept in the widget")
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument('--timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    for name in args.configs:
+        print(json.dumps(run(name, CONFIGS[name], args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+"""Scenario benchmark harness.
+
+Runs the server in a forked child and drives it with bots that speak the
+client protocol, one scenario at a time:
+
+    idle   bots connect, finish the handshake and stay connected
+    storm  a few bots send lines at a fixed rate to a lobby full of listeners
+    file   one bot uploads a file that every other bot receives
+    churn  bots connect, join a channel, say a line and disconnect, over and over
+
+Each scenario reports its own numbers (connection setup rate, messages per
+second, p50/p99/p999 fan-out latency, memory per connection, server CPU).
+Everything is written to one JSON file, and --compare checks a run against
+an earlier one and exits with 1 if anything got worse by more than
+--tolerance percent:
+
+    python bench/harness.py --scenarios idle storm file churn --output run.json
+    python bench/harness.py --output new.json --compare run.json
+"""
+import argparse
+import ast
+import asyncio
+import json
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from common import (REPO_ROOT, cpu_seconds, free_port, percentile, raise_fd_limit, rss_kb, server_call,
+                    start_server_process, stop_server_process)
+import protocol
+from load_test import drain, join, listen_for_markers
+from relay_bench import FrameCounter
+
+
+def latency_stats(prefix, values):
+    return {
+        f'{prefix}_ms_p50': round(percentile(values, 50), 3),
+        f'{prefix}_ms_p99': round(percentile(values, 99), 3),
+        f'{prefix}_ms_p999': round(percentile(values, 99.9), 3),
+    }
+
+
+def harness_cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Bots:
+    """The bots of one scenario: their connections and the tasks reading them"""
+
+    def __init__(self, port, args):
+        self.port = port
+        self.timeout = args.timeout
+        self.limiter = asyncio.Semaphore(args.concurrency)
+        self.writers = []
+        self.tasks = []
+        self.handshakes = []  # ms from connect to the server's greeting
+        self.failed = 0  # Connects that were refused or timed out
+
+    async def connect(self, nickname, listener=drain):
+        """The bot's writer, or None if it couldn't connect within the timeout"""
+        async with self.limiter:
+            started = time.monotonic()
+            try:
+                reader, writer = await asyncio.wait_for(join(self.port, nickname), self.timeout)
+            except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError, OSError):
+                self.failed += 1
+                return None
+            self.handshakes.append((time.monotonic() - started) * 1000)
+        self.writers.append(writer)
+        self.tasks.append(asyncio.ensure_future(listener(reader)))
+        return writer
+
+    async def connect_all(self, prefix, count, listener=drain):
+        started = time.monotonic()
+        await asyncio.gather(*(self.connect(f"{prefix}{i}", listener) for i in range(count)))
+        return time.monotonic() - started
+
+    async def close(self):
+        for writer in self.writers:
+            writer.close()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+async def count_file(reader, counter, finished):
+    try:
+        while not counter.complete:
+            data = await reader.read(262144)
+            if not data:
+                return
+            counter.consume(memoryview(data))
+        finished.append(time.monotonic())
+        await drain(reader)
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def idle(server, args):
+    bots = Bots(server.port, args)
+    try:
+        rss_before = rss_kb(server.pid)
+        connect_seconds = await bots.connect_all('idle', args.bots)
+        await asyncio.sleep(args.settle)
+        rss_after = rss_kb(server.pid)
+        cpu_before = cpu_seconds(server.pid)
+        await asyncio.sleep(args.duration)
+        connected = len(bots.writers)
+        return {
+            'bots': args.bots,
+            'failed_connects': bots.failed,
+            'connect_rate_per_s': round(connected / connect_seconds, 1),
+            **latency_stats('handshake_latency', bots.handshakes),
+            'server_rss_kb': rss_after,
+            'kb_per_connection': round((rss_after - rss_before) / connected, 2) if connected else None,
+            'idle_server_cpu_percent': round((cpu_seconds(server.pid) - cpu_before) / args.duration * 100, 2),
+        }
+    finally:
+        await bots.close()
+
+
+async def storm(server, args):
+    bots = Bots(server.port, args)
+    latencies = []
+    try:
+        # Only a sample of the listeners decode what they get; the rest just read, so the
+        # harness keeps up with the server
+        await bots.connect_all('listener', args.latency_bots, lambda reader: listen_for_markers(reader, latencies))
+        listeners = len(bots.writers)
+        await bots.connect_all('idle', max(0, args.bots - args.latency_bots - args.senders))
+        senders = [await bots.connect(f"sender{i}") for i in range(args.senders)]
+        senders = [sender for sender in senders if sender is not None]
+        if not senders:
+            return {'bots': args.bots, 'failed_connects': bots.failed, 'error': "no sender could connect"}
+        await asyncio.sleep(args.settle)
+
+        metrics_before = server.call('metrics.summary')
+        cpu_before = cpu_seconds(server.pid)
+        harness_before = harness_cpu()
+        total = int(args.rate * args.duration)
+        started = time.monotonic()
+        for sent in range(total):
+            senders[sent % len(senders)].write(protocol.encode_text(protocol.CHAT, f"bench:{time.monotonic_ns()}"))
+            ahead = started + (sent + 1) / args.rate - time.monotonic()
+            if ahead > 0.005:
+                await asyncio.sleep(ahead)
+        send_seconds = time.monotonic() - started
+
+        expected = total * listeners
+        deadline = time.monotonic() + args.timeout
+        while len(latencies) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - started
+        cpu_used = cpu_seconds(server.pid) - cpu_before
+        metrics_after = server.call('metrics.summary')
+        deliveries = (metrics_after['chat_deliveries_total']['total'] -
+                      metrics_before['chat_deliveries_total']['total'])
+        return {
+            'bots': args.bots,
+            'failed_connects': bots.failed,
+            'senders': len(senders),
+            'messages_sent': total,
+            'send_rate_per_s': round(total / send_seconds, 1),
+            'deliveries_per_s': round(deliveries / elapsed, 1),
+            'sampled_deliveries_expected': expected,
+            'sampled_deliveries': len(latencies),
+            **latency_stats('fanout_latency', latencies),
+            'server_cpu_ms_per_message': round(cpu_used * 1000 / total, 3) if total else None,
+            'server_rss_kb': rss_kb(server.pid),
+            'harness_cpu_percent': round((harness_cpu() - harness_before) / elapsed * 100, 1),
+        }
+    finally:
+        await bots.close()
+
+
+async def file_relay(server, args):
+    bots = Bots(server.port, args)
+    counters = []
+    finished = []
+
+    def receiver(reader):
+        counter = FrameCounter()
+        counters.append(counter)
+        return count_file(reader, counter, finished)
+
+    try:
+        await bots.connect_all('receiver', args.file_receivers, receiver)
+        sender = await bots.connect('uploader')
+        if sender is None:
+            return {'receivers': args.file_receivers, 'failed_connects': bots.failed,
+                    'error': "the uploader could not connect"}
+        await asyncio.sleep(args.settle)
+
+        size = args.file_mb * 1024 * 1024
+        chunk = b'\0' * args.chunk
+        cpu_before = cpu_seconds(server.pid)
+        started = time.monotonic()
+        sender.write(protocol.encode_json(protocol.FILE_OFFER, {'id': 1, 'name': 'bench.bin', 'size': size}))
+        for offset in range(0, size, args.chunk):
+            sender.write(protocol.encode_file_data(1, offset, chunk[:min(args.chunk, size - offset)]))
+            await sender.drain()
+        upload_seconds = time.monotonic() - started
+
+        deadline = time.monotonic() + args.timeout
+        while len(finished) < len(counters) and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        elapsed = time.monotonic() - started
+        received = sum(counter.file_bytes for counter in counters)
+        completions = [(done - started) * 1000 for done in finished]
+        return {
+            'receivers': len(counters),
+            'failed_connects': bots.failed,
+            'file_mb': args.file_mb,
+            'file_relay': args.file_relay,
+            'complete': len(finished),
+            'upload_mb_per_s': round(size / upload_seconds / 1e6, 1),
+            'delivered_mb_per_s': round(received / elapsed / 1e6, 1),
+            **latency_stats('completion', completions),
+            'server_cpu_s': round(cpu_seconds(server.pid) - cpu_before, 3),
+            'server_rss_kb': rss_kb(server.pid),
+        }
+    finally:
+        await bots.close()
+
+
+async def churn(server, args):
+    bots = Bots(server.port, args)
+    cycles = []  # ms from connect until the bot has joined, spoken and hung up
+    errors = 0
+
+    async def cycle(worker, count):
+        nonlocal errors
+        started = time.monotonic()
+        try:
+            reader, writer = await asyncio.wait_for(join(server.port, f"churn{worker}-{count}"), args.timeout)
+            writer.write(protocol.encode_json(protocol.JOIN, {'channel': f"churn{worker % 10}"}))
+            writer.write(protocol.encode_json(protocol.CHANNEL_MESSAGE, {'channel': f"churn{worker % 10}", 'text': 'hi'}))
+            writer.write(protocol.encode_json(protocol.PART, {'channel': f"churn{worker % 10}"}))
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError, OSError):
+            errors += 1
+            return
+        cycles.append((time.monotonic() - started) * 1000)
+
+    async def worker(worker_id, deadline):
+        count = 0
+        while time.monotonic() < deadline:
+            await cycle(worker_id, count)
+            count += 1
+
+    try:
+        await bots.connect_all('member', args.bots)  # The churning bots come and go among these
+        await asyncio.sleep(args.settle)
+        metrics_before = server.call('metrics.summary')
+        cpu_before = cpu_seconds(server.pid)
+        started = time.monotonic()
+        await asyncio.gather(*(worker(i, started + args.duration) for i in range(args.churn_bots)))
+        elapsed = time.monotonic() - started
+        metrics_after = server.call('metrics.summary')
+        return {
+            'members': args.bots,
+            'failed_connects': bots.failed,
+            'churn_bots': args.churn_bots,
+            'cycles': len(cycles),
+            'errors': errors,
+            'cycles_per_s': round(len(cycles) / elapsed, 1),
+            **latency_stats('cycle', cycles),
+            'server_connections': (metrics_after['chat_connections_total']['total'] -
+                                   metrics_before['chat_connections_total']['total']),
+            'server_cpu_ms_per_cycle': round((cpu_seconds(server.pid) - cpu_before) * 1000 / len(cycles), 3)
+            if cycles else None,
+            'server_rss_kb': rss_kb(server.pid),
+        }
+    finally:
+        await bots.close()
+
+
+SCENARIOS = {'idle': idle, 'storm': storm, 'file': file_relay, 'churn': churn}
+
+
+class BenchServer:
+    def __init__(self, engine, options):
+        self.port = free_port()
+        self.proc, self.pipe = start_server_process(self.port, engine, options)
+        self.pid = self.proc.pid
+
+    def call(self, method):
+        return server_call(self.pipe, method)
+
+    def stop(self):
+        stop_server_process(self.proc, self.pipe)
+
+
+# Which way is better for each kind of number; anything else isn't compared
+HIGHER_IS_BETTER = ('_per_s',)
+LOWER_IS_BETTER = ('_ms_p50', '_ms_p99', '_ms_p999', 'kb_per_connection', 'cpu_ms_per_message',
+                   'cpu_ms_per_cycle', 'server_cpu_s', 'idle_server_cpu_percent')
+
+
+def compare(results, baseline, tolerance):
+    """Numbers that got worse than the baseline by more than tolerance percent"""
+    previous = {(result['scenario'], result['engine']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = previous.get((result['scenario'], result['engine']))
+        if old is None:
+            continue
+        for key, value in result.items():
+            before = old.get(key)
+            if not isinstance(value, (int, float)) or not isinstance(before, (int, float)) or not before:
+                continue
+            change = (value - before) / before * 100
+            if key.endswith(HIGHER_IS_BETTER):
+                worse = change < -tolerance
+            elif key.endswith(LOWER_IS_BETTER):
+                worse = change > tolerance
+            else:
+                continue
+            if worse:
+                regressions.append({'scenario': result['scenario'], 'engine': result['engine'], 'metric': key,
+                                    'baseline': before, 'value': value, 'change_percent': round(change, 1)})
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_options(specs):
+    """Server keyword arguments from key=value pairs, e.g. batch_delay=0.0005"""
+    options = {}
+    for spec in specs:
+        key, _, value = spec.partition('=')
+        try:
+            options[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            options[key] = value
+    return options
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--engines', nargs='+', default=['threads', 'eventloop'])
+    parser.add_argument('--bots', type=int, default=1000, help="connected bots in every scenario")
+    parser.add_argument('--senders', type=int, default=4, help="bots sending lines in the storm")
+    parser.add_argument('--rate', type=float, default=500, help="lines per second in the storm")
+    parser.add_argument('--latency-bots', type=int, default=20, help="storm listeners that time every line")
+    parser.add_argument('--file-receivers', type=int, default=50)
+    parser.add_argument('--file-mb', type=int, default=16)
+    parser.add_argument('--file-relay', default='spool', choices=['broadcast', 'spool'])
+    parser.add_argument('--chunk', type=int, default=1024 * 1024, help="upload frame size")
+    parser.add_argument('--churn-bots', type=int, default=20, help="bots connecting and leaving concurrently")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds of storm, churn or idle time")
+    parser.add_argument('--concurrency', type=int, default=5,
+                        help="simultaneous connection attempts; the server's accept backlog is 5 by default")
+    parser.add_argument('--settle', type=float, default=1.0, help="seconds to wait after connecting")
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help="seconds to wait for a connect, or for deliveries to finish")
+    parser.add_argument('--server-option', action='append', default=[], metavar='KEY=VALUE',
+                        help="extra Server argument, e.g. batch_delay=0.0005")
+    parser.add_argument('--output', default=None, help="write the results here as JSON")
+    parser.add_argument('--compare', default=None, metavar='BASELINE', help="JSON from an earlier run")
+    parser.add_argument('--tolerance', type=float, default=10.0, help="percent a number may get worse")
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    options = {'file_relay': args.file_relay, 'log_interval': 1.0, **parse_options(args.server_option)}
+    results = []
+    for engine in args.engines:
+        for scenario in args.scenarios:
+            server = BenchServer(engine, options)
+            try:
+                result = {'scenario': scenario, 'engine': engine}
+                result.update(await SCENARIOS[scenario](server, args))
+            finally:
+                server.stop()
+            print(json.dumps(result))
+            results.append(result)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'arguments': vars(args),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(json.dumps({'regression': regression}))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,151 @@
+"""Idle-connection and broadcast-latency load test for the server engines.
+
+Opens a large number of idle clients plus a few active chatters against each
+engine and reports server memory per connection and broadcast latency:
+
+    python bench/load_test.py --idle 10000 --active 20 --messages 50
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from common import (cpu_seconds, free_port, percentile, raise_fd_limit,
+                    rss_kb, start_server, stop_server)
+import protocol
+
+
+async def join(port, nickname):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    header = await reader.readexactly(protocol.HEADER.size)
+    await reader.readexactly(protocol.HEADER.unpack(header)[1])  # NICK request; compression is left off
+    writer.write(protocol.encode_text(protocol.NICK, nickname))
+    await writer.drain()
+    return reader, writer
+
+
+async def drain(reader):
+    try:
+        while await reader.read(65536):
+            pass
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def listen_for_markers(reader, latencies):
+    decoder = protocol.FrameDecoder()
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            now = time.monotonic_ns()
+            decoder.feed(data)
+            for frame_type, payload in decoder:
+                # Chat lines arrive as "<nickname>: bench:<send time>"
+                if frame_type == protocol.CHAT and b': bench:' in payload:
+                    sent = int(payload.rsplit(b':', 1)[1])
+                    latencies.append((now - sent) / 1e6)
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def run_engine(engine, args):
+    port = free_port()
+    proc = start_server(port, engine)
+    tasks = []
+    writers = []
+    try:
+        await asyncio.sleep(0.2)
+        rss_start = rss_kb(proc.pid)
+
+        # Idle clients: complete the handshake, then only read
+        limiter = asyncio.Semaphore(args.concurrency)
+
+        async def idle_client(i):
+            async with limiter:
+                reader, writer = await join(port, f"idle{i}")
+            writers.append(writer)
+            tasks.append(asyncio.ensure_future(drain(reader)))
+
+        started = time.monotonic()
+        await asyncio.gather(*(idle_client(i) for i in range(args.idle)))
+        connect_seconds = time.monotonic() - started
+        await asyncio.sleep(args.settle)
+        rss_idle = rss_kb(proc.pid)
+
+        # Active chatters: everyone measures the latency of everyone else's lines
+        latencies = []
+        chatters = []
+        for i in range(args.active):
+            reader, writer = await join(port, f"chatter{i}")
+            writers.append(writer)
+            chatters.append(writer)
+            tasks.append(asyncio.ensure_future(listen_for_markers(reader, latencies)))
+        await asyncio.sleep(args.settle)
+
+        cpu_before = cpu_seconds(proc.pid)
+        send_started = time.monotonic()
+        for _ in range(args.messages):
+            for writer in chatters:
+                writer.write(protocol.encode_text(protocol.CHAT, f"bench:{time.monotonic_ns()}"))
+            await asyncio.sleep(1 / args.rate)
+
+        expected = args.active * (args.active - 1) * args.messages
+        deadline = time.monotonic() + args.timeout
+        while len(latencies) < expected and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.monotonic() - send_started
+        cpu_used = cpu_seconds(proc.pid) - cpu_before
+
+        connections = args.idle + args.active
+        return {
+            'engine': engine,
+            'idle_clients': args.idle,
+            'active_clients': args.active,
+            'connect_rate_per_s': round(args.idle / connect_seconds, 1) if connect_seconds else None,
+            'rss_start_kb': rss_start,
+            'rss_idle_kb': rss_idle,
+            'rss_end_kb': rss_kb(proc.pid),
+            'kb_per_connection': round((rss_idle - rss_start) / args.idle, 2) if args.idle else None,
+            'messages_expected': expected,
+            'messages_delivered': len(latencies),
+            'latency_ms_p50': round(percentile(latencies, 50), 3),
+            'latency_ms_p99': round(percentile(latencies, 99), 3),
+            'latency_ms_max': round(max(latencies, default=0), 3),
+            'server_cpu_s': round(cpu_used, 3),
+            'elapsed_s': round(elapsed, 3),
+            'connections': connections,
+        }
+    finally:
+        for writer in writers:
+            writer.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        stop_server(proc)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engines', nargs='+', default=['threads', 'eventloop'])
+    parser.add_argument('--idle', type=int, default=10000, help="idle connections")
+    parser.add_argument('--active', type=int, default=10, help="active chatters")
+    parser.add_argument('--messages', type=int, default=20, help="lines per chatter")
+    parser.add_argument('--rate', type=float, default=20, help="rounds of messages per second")
+    parser.add_argument('--concurrency', type=int, default=5, help="simultaneous connection attempts")
+    parser.add_argument('--settle', type=float, default=1.0, help="seconds to wait after connecting")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    results = []
+    for engine in args.engines:
+        result = await run_engine(engine, args)
+        print(json.dumps(result))
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
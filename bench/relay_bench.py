@@ -0,0 +1,154 @@
+"""File relay benchmark: chunk broadcast versus spooled sendfile relay.
+
+One sender uploads a file while N receivers download it; reports delivered
+MB/s and server CPU for each relay mode and receiver count:
+
+    python bench/relay_bench.py --receivers 1 10 100 --size-mb 32
+"""
+import argparse
+import json
+import os
+import selectors
+import socket
+import time
+
+from common import cpu_seconds, free_port, raise_fd_limit, start_server, stop_server
+import protocol
+
+
+class FrameCounter:
+    """Counts file bytes per receiver without copying payloads"""
+
+    def __init__(self):
+        self.header = bytearray()
+        self.frame_type = None
+        self.left = 0  # Payload bytes of the current frame still to come
+        self.file_bytes = 0
+        self.complete = False
+
+    def consume(self, view):
+        while view:
+            if self.left:
+                taken = min(self.left, len(view))
+                if self.frame_type == protocol.FILE_DATA:
+                    self.file_bytes += taken
+                self.left -= taken
+                view = view[taken:]
+                continue
+            needed = protocol.HEADER.size - len(self.header)
+            self.header += view[:needed]
+            view = view[needed:]
+            if len(self.header) == protocol.HEADER.size:
+                self.frame_type, self.left = protocol.HEADER.unpack(self.header)
+                self.header.clear()
+                if self.frame_type == protocol.FILE_DATA:
+                    self.file_bytes -= protocol.FILE_CHUNK.size
+                elif self.frame_type == protocol.FILE_COMPLETE:
+                    self.complete = True
+
+
+def join(port, nickname):
+    sock = socket.create_connection(('127.0.0.1', port))
+    protocol.FrameReader(sock, 64).read_frame()  # NICK request; compression is left off
+    sock.sendall(protocol.encode_text(protocol.NICK, nickname))
+    return sock
+
+
+def run(mode, receivers, args):
+    port = free_port()
+    proc = start_server(port, args.engine, ['--file-relay', mode])
+    sockets = []
+    try:
+        selector = selectors.DefaultSelector()
+        counters = []
+        for i in range(receivers):
+            sock = join(port, f"receiver{i}")
+            sock.setblocking(False)
+            counter = FrameCounter()
+            selector.register(sock, selectors.EVENT_READ, counter)
+            sockets.append(sock)
+            counters.append(counter)
+        sender = join(port, "sender")
+        sockets.append(sender)
+        time.sleep(0.5)
+
+        size = args.size_mb * 1024 * 1024
+        chunk = os.urandom(args.chunk)
+        buffer = bytearray(1024 * 1024)
+        view = memoryview(buffer)
+        cpu_before = cpu_seconds(proc.pid)
+        started = time.monotonic()
+
+        sender.sendall(protocol.encode_json(protocol.FILE_OFFER, {'id': 1, 'name': 'bench.bin', 'size': size}))
+        sender.setblocking(False)
+        pending = memoryview(b'')
+        sent = 0
+        upload_done = None
+        selector.register(sender, selectors.EVENT_WRITE)
+        done = 0
+        while done < receivers:
+            if time.monotonic() - started > args.timeout:
+                break
+            for key, mask in selector.select(1.0):
+                if key.fileobj is sender:
+                    if not pending:
+                        if sent >= size:
+                            selector.unregister(sender)
+                            upload_done = time.monotonic() - started
+                            continue
+                        count = min(len(chunk), size - sent)
+                        pending = memoryview(protocol.encode_file_data(1, sent, chunk[:count]))
+                        sent += count
+                    try:
+                        pending = pending[sender.send(pending):]
+                    except BlockingIOError:
+                        pass
+                    continue
+                counter = key.data
+                try:
+                    received = key.fileobj.recv_into(buffer)
+                except BlockingIOError:
+                    continue
+                counter.consume(view[:received])
+                if counter.complete:
+                    selector.unregister(key.fileobj)
+                    done += 1
+
+        elapsed = time.monotonic() - started
+        cpu_used = cpu_seconds(proc.pid) - cpu_before
+        delivered = sum(counter.file_bytes for counter in counters)
+        return {
+            'mode': mode,
+            'engine': args.engine,
+            'receivers': receivers,
+            'file_mb': args.size_mb,
+            'upload_s': round(upload_done, 3) if upload_done else None,
+            'elapsed_s': round(elapsed, 3),
+            'delivered_mb_per_s': round(delivered / elapsed / 1e6, 1),
+            'server_cpu_percent': round(cpu_used / elapsed * 100, 1),
+            'receivers_complete': done,
+        }
+    finally:
+        for sock in sockets:
+            sock.close()
+        stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=['broadcast', 'spool'])
+    parser.add_argument('--receivers', nargs='+', type=int, default=[1, 10, 100])
+    parser.add_argument('--engine', default='eventloop', choices=['threads', 'eventloop'])
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--chunk', type=int, default=64 * 1024, help="upload frame size")
+    parser.add_argument('--timeout', type=float, default=300.0)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for receivers in args.receivers:
+        for mode in args.modes:
+            print(json.dumps(run(mode, receivers, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Parallel upload benchmark.
+
+Uploads a file from one Client to another through a local server with 1, 2,
+4 and 8 upload connections, and reports upload and end-to-end MB/s. The sender
+keeps chatting during the upload; the chat latency the receiver sees shows
+whether file data is holding up the chat connection:
+
+    python bench/stream_bench.py --size-mb 256 --streams 1 2 4 8
+"""
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from common import free_port, percentile, start_server, stop_server
+import protocol
+from chat_client import Client
+
+
+def run(streams, port, path, size, args):
+    done = threading.Event()
+    latencies = []
+
+    def on_progress(direction, file_name, transferred, total):
+        if direction == 'Receiving' and transferred >= total:
+            done.set()
+
+    receiver = Client('127.0.0.1', port, on_progress=on_progress)
+    receiver.nickname = f"receiver-{streams}"
+    receiver.download_dir = f"downloads-{streams}"
+    handle_frame = receiver.handle_frame
+
+    def timed_handle_frame(frame_type, payload):
+        if frame_type == protocol.CHAT and b': ping ' in payload:
+            sent_at = float(payload.rsplit(b' ', 1)[1])
+            latencies.append((time.monotonic() - sent_at) * 1000)
+        else:
+            handle_frame(frame_type, payload)
+
+    receiver.handle_frame = timed_handle_frame
+    sender = Client('127.0.0.1', port, streams=streams, range_size=args.range_size_mb * 1024 * 1024)
+    sender.nickname = f"sender-{streams}"
+    for client in (receiver, sender):
+        client.connect()
+        threading.Thread(target=client.receive_messages, daemon=True).start()
+    time.sleep(0.3)
+
+    uploading = threading.Event()
+    uploading.set()
+
+    def chat():
+        while uploading.is_set():
+            sender.send_message(f"ping {time.monotonic()}")
+            time.sleep(args.chat_interval)
+
+    chatter = threading.Thread(target=chat, daemon=True)
+    started = time.monotonic()
+    chatter.start()
+    sender.send_file(path)
+    upload = time.monotonic() - started
+    uploading.clear()
+    chatter.join()
+    done.wait(args.timeout)
+    total = time.monotonic() - started
+
+    sender.close()
+    receiver.close()
+    return {
+        'streams': streams,
+        'file_mb': args.size_mb,
+        'upload_mb_per_s': round(size / upload / 1e6, 1),
+        'end_to_end_mb_per_s': round(size / total / 1e6, 1),
+        'chat_p50_ms': round(percentile(latencies, 50), 2),
+        'chat_p99_ms': round(percentile(latencies, 99), 2),
+        'chat_lines': len(latencies),
+        'received': done.is_set(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--streams', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--range-size-mb', type=int, default=8)
+    parser.add_argument('--engine', default='eventloop', choices=['threads', 'eventloop'])
+    parser.add_argument('--file-relay', default='broadcast', choices=['broadcast', 'spool'])
+    parser.add_argument('--chat-interval', type=float, default=0.02)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        path = os.path.join(workdir, 'upload.bin')
+        with open(path, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        port = free_port()
+        # The file cache would turn every run after the first into a cache hit
+        proc = start_server(port, args.engine, ['--file-relay', args.file_relay,
+                                                '--cache-disk', '0', '--cache-memory', '0'])
+        try:
+            for streams in args.streams:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    result = run(streams, port, path, size, args)
+                print(json.dumps(result))
+        finally:
+            stop_server(proc)
+
+
+if __name__ == '__main__':
+    main()
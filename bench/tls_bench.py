@@ -0,0 +1,156 @@
+"""TLS cost benchmark.
+
+Measures what TLS adds to connecting and to moving files, on each engine:
+
+    connect  connections opened one after another, each until the server's
+             NICK request arrives: plain TCP, a full TLS handshake, and a
+             TLS handshake that resumes the session of an earlier connection
+    file     one Client uploads a file that another Client receives, in the
+             clear and over TLS
+
+A self-signed certificate for localhost is made with the openssl command:
+
+    python bench/tls_bench.py --connections 500 --size-mb 64
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from common import cpu_seconds, free_port, percentile, start_server, stop_server
+from chat_client import Client
+import protocol
+import tls
+
+
+def make_certificate(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                    '-days', '1', '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost'],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def connect_once(port, context, session):
+    """Seconds until the NICK request arrived, and the TLS session (None in the clear)"""
+    started = time.perf_counter()
+    sock = socket.create_connection(('127.0.0.1', port))
+    if context is not None:
+        sock = context.wrap_socket(sock, server_hostname='localhost', session=session)
+    protocol.FrameReader(sock, 1024).read_frame()
+    elapsed = time.perf_counter() - started
+    session = sock.session if context is not None else None
+    resumed = context is not None and sock.session_reused
+    sock.close()
+    return elapsed, session, resumed
+
+
+def bench_connect(mode, proc, port, context, args):
+    session = None
+    if mode == 'tls-resumed':
+        session = connect_once(port, context, None)[1]
+    times = []
+    resumed = 0
+    cpu_before = cpu_seconds(proc.pid)
+    started = time.monotonic()
+    for _ in range(args.connections):
+        elapsed, new_session, was_resumed = connect_once(port, context, session)
+        times.append(elapsed * 1000)
+        resumed += was_resumed
+        if mode == 'tls-resumed':
+            session = new_session
+    wall = time.monotonic() - started
+    return {
+        'scenario': 'connect',
+        'mode': mode,
+        'connections': args.connections,
+        'resumed': resumed,
+        'connects_per_s': round(args.connections / wall, 1),
+        'connect_ms_p50': round(percentile(times, 50), 3),
+        'connect_ms_p99': round(percentile(times, 99), 3),
+        'server_cpu_ms_per_connect': round((cpu_seconds(proc.pid) - cpu_before) * 1000 / args.connections, 3),
+    }
+
+
+def bench_file(engine, mode, proc, port, context, path, size, args):
+    done = threading.Event()
+
+    def on_progress(direction, file_name, transferred, total):
+        if direction == 'Receiving' and transferred >= total:
+            done.set()
+
+    options = {'tls_context': context, 'server_hostname': 'localhost', 'on_message': lambda line: None}
+    receiver = Client('127.0.0.1', port, on_progress=on_progress, **options)
+    receiver.nickname = f"receiver-{mode}"
+    receiver.download_dir = f"downloads-{engine}-{mode}"  # A fresh one, or the file would already be there
+    sender = Client('127.0.0.1', port, on_progress=lambda *progress: None, **options)
+    sender.nickname = f"sender-{mode}"
+    for client in (receiver, sender):
+        client.connect()
+        threading.Thread(target=client.receive_messages, daemon=True).start()
+    time.sleep(0.3)
+
+    cpu_before = cpu_seconds(proc.pid)
+    started = time.monotonic()
+    sender.send_file(path)
+    upload = time.monotonic() - started
+    done.wait(args.timeout)
+    total = time.monotonic() - started
+    sender.close()
+    receiver.close()
+    return {
+        'scenario': 'file',
+        'mode': mode,
+        'file_mb': args.size_mb,
+        'upload_mb_per_s': round(size / upload / 1e6, 1),
+        'end_to_end_mb_per_s': round(size / total / 1e6, 1),
+        'server_cpu_s': round(cpu_seconds(proc.pid) - cpu_before, 3),
+        'received': done.is_set(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--engines', nargs='+', default=['threads', 'eventloop'])
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--file-relay', default='spool', choices=['broadcast', 'spool'])
+    parser.add_argument('--timeout', type=float, default=300.0)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)  # Clients save into ./downloads-<engine>-<mode>
+        cert, key = make_certificate(workdir)
+        context = tls.client_context(cert)
+        path = os.path.join(workdir, 'upload.bin')
+        with open(path, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        for engine in args.engines:
+            for mode in ('plain', 'tls'):
+                port = free_port()
+                extra = ['--file-relay', args.file_relay, '--cache-disk', '0', '--cache-memory', '0',
+                         '--log-interval', '60']
+                if mode == 'tls':
+                    extra += ['--tls-cert', cert, '--tls-key', key]
+                proc = start_server(port, engine, extra)
+                try:
+                    for connect_mode in (['plain'] if mode == 'plain' else ['tls-full', 'tls-resumed']):
+                        result = bench_connect(connect_mode, proc, port, context if mode == 'tls' else None, args)
+                        print(json.dumps({'engine': engine, **result}))
+                    result = bench_file(engine, mode, proc, port, context if mode == 'tls' else None, path, size, args)
+                    print(json.dumps({'engine': engine, **result}))
+                finally:
+                    stop_server(proc)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Client file transfer throughput benchmark.
+
+Uploads a file from one Client to another through a local server and compares
+the legacy settings (4 KiB chunks, progress on every chunk) with the tuned
+path (large chunks, sendfile uploads, throttled progress), both without
+compression. A raw loopback
+sendfile run gives the line rate to compare against:
+
+    python bench/transfer_bench.py --size-mb 256
+"""
+import argparse
+import contextlib
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from common import free_port, start_server, stop_server
+from chat_client import Client
+
+# Compression is off in both: this measures the transfer path, not the codec (see compression_bench.py)
+CONFIGS = {
+    'legacy': {'chunk_size': 4096, 'progress_interval': 0, 'compression_codec': 'off'},
+    'tuned': {'chunk_size': 1024 * 1024, 'progress_interval': 0.1, 'compression_codec': 'off'},
+}
+
+
+def loopback_rate(path, size):
+    """MB/s of a bare sendfile over loopback into a recv_into loop"""
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    received = [0]
+
+    def drain():
+        conn, _ = listener.accept()
+        buffer = bytearray(1024 * 1024)
+        while True:
+            count = conn.recv_into(buffer)
+            if not count:
+                break
+            received[0] += count
+        conn.close()
+
+    thread = threading.Thread(target=drain)
+    thread.start()
+    started = time.monotonic()
+    with socket.create_connection(('127.0.0.1', port)) as sock, open(path, 'rb') as f:
+        sock.sendfile(f)
+    thread.join()
+    listener.close()
+    return size / (time.monotonic() - started) / 1e6
+
+
+def run(name, config, port, path, size, args):
+    done = threading.Event()
+
+    def on_progress(direction, file_name, transferred, total):
+        if direction == 'Receiving' and transferred >= total:
+            done.set()
+
+    options = dict(config, socket_buffer=args.socket_buffer)
+    receiver = Client('127.0.0.1', port, on_progress=on_progress, **options)
+    receiver.nickname = f"receiver-{name}"
+    receiver.download_dir = f"downloads-{name}"  # Otherwise later runs find the file already downloaded
+    sender = Client('127.0.0.1', port, **options)
+    sender.nickname = f"sender-{name}"
+    for client in (receiver, sender):
+        client.connect()
+        threading.Thread(target=client.receive_messages, daemon=True).start()
+    time.sleep(0.3)
+
+    started = time.monotonic()
+    sender.send_file(path)
+    upload = time.monotonic() - started
+    done.wait(args.timeout)
+    total = time.monotonic() - started
+
+    sender.close()
+    receiver.close()
+    return {
+        'config': name,
+        'chunk_size': config['chunk_size'],
+        'file_mb': args.size_mb,
+        'upload_mb_per_s': round(size / upload / 1e6, 1),
+        'end_to_end_mb_per_s': round(size / total / 1e6, 1),
+        'received': done.is_set(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--engine', default='eventloop', choices=['threads', 'eventloop'])
+    parser.add_argument('--file-relay', default='broadcast', choices=['broadcast', 'spool'])
+    parser.add_argument('--socket-buffer', type=int, default=None)
+    parser.add_argument('--configs', nargs='+', default=list(CONFIGS))
+    parser.add_argument('--timeout', type=float, default=600.0)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)  # Clients save into ./downloads-<config>
+        path = os.path.join(workdir, 'upload.bin')
+        with open(path, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in range(args.size_mb):
+                f.write(block)
+
+        print(json.dumps({'config': 'loopback-sendfile', 'mb_per_s': round(loopback_rate(path, size), 1)}))
+
+        port = free_port()
+        # The file cache would turn every run after the first into a cache hit
+        proc = start_server(port, args.engine, ['--file-relay', args.file_relay,
+                                                '--cache-disk', '0', '--cache-memory', '0'])
+        try:
+            for name in args.configs:
+                # Chat and progress output from the clients is part of the cost, but not of the report
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    result = run(name, CONFIGS[name], port, path, size, args)
+                print(json.dumps(result))
+        finally:
+            stop_server(proc)
+
+
+if __name__ == '__main__':
+    main()
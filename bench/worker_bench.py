@@ -0,0 +1,162 @@
+"""Worker scaling benchmark.
+
+Starts the server with 1, 2 and 4 worker processes and has every client of
+a set of channels send timestamped lines at a fixed rate. Clients land on
+whichever worker the kernel picks, so most channel lines cross the bus.
+Reports delivered messages per second, latency and server CPU; the clients
+can be spread over several driver processes so they don't become the
+bottleneck themselves:
+
+    python bench/worker_bench.py --workers 1 2 4 --clients 200 --drivers 2
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+
+from common import (child_pids, cpu_seconds, free_port, percentile,
+                    raise_fd_limit, start_server, stop_server)
+import protocol
+import sessions
+from load_test import join
+
+
+async def listen(reader, latencies, deliveries):
+    decoder = protocol.FrameDecoder()
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            now = time.monotonic_ns()
+            decoder.feed(data)
+            for frame_type, payload in decoder:
+                if frame_type == protocol.CHAT and b': bench:' in payload:
+                    sent = int(payload.rsplit(b':', 1)[1])
+                    latencies.append((now - sent) / 1e6)
+                    deliveries[0] += 1
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+
+
+async def drive(port, members, args, barrier):
+    """Connect this driver's clients, then send args.messages rounds of lines"""
+    latencies = []
+    deliveries = [0]
+    writers = []
+    tasks = []
+    limiter = asyncio.Semaphore(args.concurrency)
+
+    async def client(i, room):
+        async with limiter:
+            reader, writer = await join(port, f"c{i}")
+            writer.write(protocol.encode_json(protocol.JOIN, {'channel': room}))
+            writer.write(protocol.encode_json(protocol.PART, {'channel': sessions.LOBBY}))
+            await writer.drain()
+        writers.append((room, writer))
+        tasks.append(asyncio.ensure_future(listen(reader, latencies, deliveries)))
+
+    await asyncio.gather(*(client(i, room) for i, room in members))
+    await asyncio.sleep(args.settle)
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+    for _ in range(args.messages):
+        for room, writer in writers:
+            writer.write(protocol.encode_json(protocol.CHANNEL_MESSAGE,
+                                              {'channel': room, 'text': f"bench:{time.monotonic_ns()}"}))
+        await asyncio.sleep(1 / args.rate)
+
+    expected = len(members) * (args.channel_size - 1) * args.messages
+    deadline = time.monotonic() + args.timeout
+    while deliveries[0] < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    finished = time.monotonic()
+
+    for _, writer in writers:
+        writer.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return latencies, finished
+
+
+def run_driver(port, members, args, barrier, results):
+    results.put(asyncio.run(drive(port, members, args, barrier)))
+
+
+def run(workers, args):
+    port = free_port()
+    proc = start_server(port, args.engine, ['--workers', str(workers)])
+    try:
+        # Whole channels go to one driver, so a line and its deliveries are timed in one process
+        members = [[] for _ in range(args.drivers)]
+        for i in range(args.clients):
+            room = i // args.channel_size
+            members[room % args.drivers].append((i, f"room{room}"))
+
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(args.drivers + 1)
+        results = context.Queue()
+        drivers = [context.Process(target=run_driver, args=(port, share, args, barrier, results))
+                   for share in members]
+        for driver in drivers:
+            driver.start()
+        barrier.wait()
+        server_pids = [proc.pid] + child_pids(proc.pid)
+        cpu_before = sum(cpu_seconds(pid) for pid in server_pids)
+        started = time.monotonic()
+
+        latencies = []
+        finished = started
+        for _ in drivers:
+            driver_latencies, driver_finished = results.get()
+            latencies.extend(driver_latencies)
+            finished = max(finished, driver_finished)
+        for driver in drivers:
+            driver.join()
+        cpu_used = sum(cpu_seconds(pid) for pid in server_pids) - cpu_before
+        elapsed = finished - started
+
+        sent = args.clients * args.messages
+        expected = args.clients * (args.channel_size - 1) * args.messages
+        return {
+            'engine': args.engine,
+            'workers': workers,
+            'clients': args.clients,
+            'channel_size': args.channel_size,
+            'messages_sent': sent,
+            'deliveries_expected': expected,
+            'deliveries': len(latencies),
+            'messages_per_s': round(sent / elapsed, 1),
+            'deliveries_per_s': round(len(latencies) / elapsed, 1),
+            'latency_ms_p50': round(percentile(latencies, 50), 3),
+            'latency_ms_p99': round(percentile(latencies, 99), 3),
+            'server_cpu_s': round(cpu_used, 3),
+            'elapsed_s': round(elapsed, 3),
+        }
+    finally:
+        stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--engine', default='eventloop', choices=['threads', 'eventloop'])
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--channel-size', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=50, help="lines per client")
+    parser.add_argument('--rate', type=float, default=20, help="rounds of messages per second")
+    parser.add_argument('--drivers', type=int, default=1, help="client processes")
+    parser.add_argument('--concurrency', type=int, default=5, help="simultaneous connection attempts per driver")
+    parser.add_argument('--settle', type=float, default=1.0, help="seconds to wait after connecting")
+    parser.add_argument('--timeout', type=float, default=60.0)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    for workers in args.workers:
+        print(json.dumps(run(workers, args)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,388 @@
+"""Message bus between chat servers: the worker processes of one server, or
+servers on several hosts.
+
+Each server only has its own clients, so a Bus links it to every other one.
+Channel frames are forwarded, already encoded, only to the servers that have
+members in the channel. Every server tells the others which nicknames its
+clients use and which channels they are in, so private messages find their
+addressee and a nickname stays taken everywhere. Two clients taking the same
+nickname on different servers at the same moment can both get it. Files are
+announced to the other servers, but their data stays on the sender's server.
+
+How the links are made is up to the backend:
+
+- with --workers N the server forks N processes that all listen on the same
+  port with SO_REUSEPORT, and every pair of workers is joined by a Unix
+  socket made before the fork (start_workers)
+- PeerMesh, the built-in clustering backend, joins servers on several hosts:
+  each listens on a cluster address and connects to the peers it is given
+
+Other backends subclass Bus, register in BACKENDS and call add_link() for
+every peer they reach.
+"""
+import json
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import threading
+import time
+
+import outbox
+import protocol
+
+# Bus frame types; the payload is a JSON header, a newline, then (for frames
+# to clients) the encoded frame itself
+CHANNEL_FRAME = 1  # {"channels", "droppable"}: a frame for every local member of these channels;
+                   # chat lines also carry "history" so the receiving server logs them
+PRIVATE_FRAME = 2  # {"to"}: a frame for one client
+SUBSCRIBE = 3      # {"channel"}: one more client of the sending server joined it
+UNSUBSCRIBE = 4    # {"channel"}: one client of the sending server left it
+JOINED = 5         # {"nickname"} connected to the sending server
+LEFT = 6           # {"nickname", "channels"} disconnected, leaving its channels
+FILE_ANNOUNCE = 7  # {"name", "size", "sha256", "sender"}: a notice for every local client
+HELLO = 8          # {"name"}: first frame each end of a PeerMesh link sends
+
+
+def encode_event(event_type, meta, frame=b''):
+    return protocol.encode_frame(event_type, json.dumps(meta).encode('utf-8') + b'\n' + frame)
+
+
+def decode_event(payload):
+    meta, frame = bytes(payload).split(b'\n', 1)
+    return json.loads(meta), frame
+
+
+def parse_address(address):
+    """'host:port' -> (host, port)"""
+    host, _, port = address.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+
+class Bus:
+    def __init__(self, name, queue_bytes=16 * 1024 * 1024, queue_frames=100000):
+        self.name = name  # How the other servers know this one
+        self.links = {}  # peer name -> connected socket
+        self.outbox_options = {'max_bytes': queue_bytes, 'max_frames': queue_frames}
+        self.outboxes = {}  # peer name -> outbox.ThreadedOutbox
+        self.deliver = None  # Called as deliver(event_type, meta, frame) on a reader thread
+        self.presence = None  # Returns (nicknames, {channel: members}) of this server's clients
+        self.members = {}  # channel -> {peer name: members there}
+        self.nicknames = {}  # nickname -> peer it is connected to
+        self.lock = threading.Lock()
+
+    def start(self, deliver, presence):
+        self.deliver = deliver
+        self.presence = presence
+
+    def add_link(self, peer, sock, reader=None):
+        """Carry events over a connected socket; reader is a FrameReader that already read from it"""
+        with self.lock:
+            self.links[peer] = sock
+            self.outboxes[peer] = outbox.ThreadedOutbox(sock, self.link_lost, **self.outbox_options)
+        # Bring the new peer up to date with this server's clients
+        nicknames, channels = self.presence()
+        for nickname in nicknames:
+            self.send([peer], encode_event(JOINED, {'nickname': nickname}))
+        for channel, count in channels.items():
+            for _ in range(count):
+                self.send([peer], encode_event(SUBSCRIBE, {'channel': channel}))
+        thread = threading.Thread(target=self.read_link, args=(peer, sock, reader), daemon=True)
+        thread.start()
+
+    def send(self, peers, event, droppable=False):
+        """Queue an event for the given peers, or for all of them if peers is None"""
+        for peer in list(self.outboxes) if peers is None else peers:
+            link_outbox = self.outboxes.get(peer)
+            if link_outbox is not None:
+                link_outbox.put(event, droppable)
+
+    def publish_channels(self, names, frame, droppable=False, history=False):
+        """Forward a frame to the servers with members in any of the channels; history marks chat lines to log"""
+        with self.lock:
+            peers = set()
+            for name in names:
+                peers.update(self.members.get(name, ()))
+        if peers:
+            meta = {'channels': list(names), 'droppable': droppable}
+            if history:
+                meta['history'] = True
+            self.send(peers, encode_event(CHANNEL_FRAME, meta, frame), droppable)
+
+    def publish_private(self, nickname, frame):
+        """Forward a frame to the server a nickname is connected to; False if no server has it"""
+        peer = self.nicknames.get(nickname)
+        if peer is None:
+            return False
+        self.send([peer], encode_event(PRIVATE_FRAME, {'to': nickname}, frame), droppable=True)
+        return True
+
+    def announce_file(self, info, frame):
+        """Show the clients of every other server a notice about a file shared here"""
+        self.send(None, encode_event(FILE_ANNOUNCE, info, frame), droppable=True)
+
+    def has_nickname(self, nickname):
+        return nickname in self.nicknames
+
+    def remote_nicknames(self):
+        """nickname -> server, for the clients of the other servers"""
+        with self.lock:
+            return dict(self.nicknames)
+
+    def subscribe(self, channel):
+        self.send(None, encode_event(SUBSCRIBE, {'channel': channel}))
+
+    def unsubscribe(self, channel):
+        self.send(None, encode_event(UNSUBSCRIBE, {'channel': channel}))
+
+    def joined(self, nickname):
+        self.send(None, encode_event(JOINED, {'nickname': nickname}))
+
+    def left(self, nickname, channels):
+        self.send(None, encode_event(LEFT, {'nickname': nickname, 'channels': sorted(channels)}))
+
+    def channel_sizes(self):
+        """Member count per channel on the other servers"""
+        with self.lock:
+            return {name: sum(peers.values()) for name, peers in self.members.items()}
+
+    def count_member(self, peer, channel, delta):
+        # Called with the lock held
+        peers = self.members.setdefault(channel, {})
+        peers[peer] = peers.get(peer, 0) + delta
+        if peers[peer] <= 0:
+            del peers[peer]
+            if not peers:
+                del self.members[channel]
+
+    def handle_event(self, peer, event_type, meta, frame):
+        if event_type in (CHANNEL_FRAME, PRIVATE_FRAME, FILE_ANNOUNCE):
+            self.deliver(event_type, meta, frame)
+            return
+        with self.lock:
+            if event_type == SUBSCRIBE:
+                self.count_member(peer, meta['channel'], 1)
+            elif event_type == UNSUBSCRIBE:
+                self.count_member(peer, meta['channel'], -1)
+            elif event_type == JOINED:
+                self.nicknames[meta['nickname']] = peer
+            elif event_type == LEFT:
+                if self.nicknames.get(meta['nickname']) == peer:
+                    del self.nicknames[meta['nickname']]
+                for channel in meta['channels']:
+                    self.count_member(peer, channel, -1)
+
+    def read_link(self, peer, sock, reader=None):
+        reader = reader or protocol.FrameReader(sock)
+        try:
+            for event_type, payload in reader:
+                if self.links.get(peer) is not sock:
+                    break  # Replaced by a newer link to the same peer
+                meta, frame = decode_event(payload)
+                self.handle_event(peer, event_type, meta, frame)
+        except OSError:
+            pass
+        except Exception as e:
+            print(f"Error on the bus link to {peer}: {e}")
+        self.link_lost(sock)
+
+    def link_lost(self, sock):
+        # Called by the link's reader or writer thread, whichever notices first
+        with self.lock:
+            peer = next((peer for peer, link in self.links.items() if link is sock), None)
+            link_outbox = self.outboxes.pop(peer, None)
+            if link_outbox is None:
+                return
+            del self.links[peer]
+            for nickname in [nickname for nickname, owner in self.nicknames.items() if owner == peer]:
+                del self.nicknames[nickname]
+            for channel in list(self.members):
+                self.count_member(peer, channel, -self.members[channel].get(peer, 0))
+        print(f"Lost the bus link to {peer}")
+        link_outbox.close()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
+        self.link_closed(peer)
+
+    def link_closed(self, peer):
+        """Called once a link is gone; backends that reconnect hook in here"""
+        pass
+
+
+class PeerMesh(Bus):
+    """Joins servers on several hosts with one TCP connection per pair.
+
+    Each server accepts links on its cluster address and keeps connecting to
+    every peer it was given, with jittered backoff while a peer is down. When
+    two servers list each other, both keep the link opened by the one with
+    the smaller name.
+    """
+
+    def __init__(self, name=None, listen=None, peers=(), retry_interval=1.0, **options):
+        super().__init__(name or listen or f"{socket.gethostname()}:{os.getpid()}", **options)
+        self.listen_address = parse_address(listen) if listen else None
+        self.peer_addresses = [parse_address(peer) for peer in peers]
+        self.retry_interval = retry_interval
+        self.changed = threading.Condition(self.lock)  # Notified when a link goes away
+        self.registering = threading.Lock()  # One new link at a time, so two can't both be kept
+
+    def start(self, deliver, presence):
+        super().start(deliver, presence)
+        if self.listen_address is not None:
+            listener = socket.create_server(self.listen_address)
+            print(f"Cluster node {self.name} listening on {self.listen_address[0]}:{self.listen_address[1]}")
+            threading.Thread(target=self.accept_links, args=(listener,), daemon=True).start()
+        for address in self.peer_addresses:
+            threading.Thread(target=self.keep_connected, args=(address,), daemon=True).start()
+
+    def handshake(self, sock):
+        """Exchange names with the other end; returns (peer name, reader)"""
+        sock.sendall(encode_event(HELLO, {'name': self.name}))
+        reader = protocol.FrameReader(sock)
+        frame = reader.read_frame()
+        if frame is None or frame[0] != HELLO:
+            raise ConnectionError("peer did not introduce itself")
+        return decode_event(frame[1])[0]['name'], reader
+
+    def accept_links(self, listener):
+        while True:
+            sock, _ = listener.accept()
+            threading.Thread(target=self.accept_link, args=(sock,), daemon=True).start()
+
+    def accept_link(self, sock):
+        try:
+            sock.settimeout(10)
+            peer, reader = self.handshake(sock)
+            sock.settimeout(None)
+        except (OSError, ValueError) as e:
+            print(f"Rejected a cluster link: {e}")
+            sock.close()
+            return
+        self.register(peer, sock, reader, initiated=False)
+
+    def keep_connected(self, address):
+        delay = self.retry_interval
+        while True:
+            try:
+                sock = socket.create_connection(address, timeout=10)
+                peer, reader = self.handshake(sock)
+                sock.settimeout(None)
+            except (OSError, ValueError):
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, 30)
+                continue
+            delay = self.retry_interval
+            self.register(peer, sock, reader, initiated=True)
+            # Whichever link to the peer was kept, connect again once it is gone
+            with self.changed:
+                self.changed.wait_for(lambda: peer not in self.links)
+
+    def register(self, peer, sock, reader, initiated):
+        """Use a new link unless the one already there is the one to keep"""
+        with self.registering:
+            existing = self.links.get(peer)
+            if peer == self.name or (existing is not None and initiated != (self.name < peer)):
+                sock.close()
+                return
+            if existing is not None:
+                self.link_lost(existing)
+            print(f"Linked to cluster node {peer}")
+            self.add_link(peer, sock, reader)
+
+    def link_closed(self, peer):
+        with self.changed:
+            self.changed.notify_all()
+
+
+BACKENDS = {'tcp': PeerMesh}
+
+
+def create_backend(kind, **options):
+    return BACKENDS[kind](**options)
+
+
+def run_worker(worker_id, links, create_server, ready, lifeline):
+    for peer_links in links:
+        for peer, sock in peer_links.items():
+            if peer_links is not links[worker_id]:
+                sock.close()  # The other workers' ends
+    # Exit along with the parent, even if it is killed; a worker left behind
+    # would keep taking connections on the shared port
+    lifeline_read, lifeline_write = lifeline
+    os.close(lifeline_write)
+    threading.Thread(target=watch_parent, args=(lifeline_read,), daemon=True).start()
+    worker_bus = Bus(f"worker-{worker_id}")
+    server = create_server(worker_bus)
+    worker_bus.start(server.deliver_remote, server.local_presence)
+    for peer, sock in links[worker_id].items():
+        worker_bus.add_link(f"worker-{peer}", sock)
+    os.write(ready, b'.')
+    os.close(ready)
+    server.receive()
+
+
+def watch_parent(lifeline):
+    # The parent holds the write end open; reading returns once it is gone
+    os.read(lifeline, 1)
+    os._exit(1)
+
+
+def start_workers(count, create_server):
+    """Fork count workers joined by a bus; returns them once every one is listening.
+
+    create_server(bus) runs in each worker and returns its Server.
+    """
+    links = [{} for _ in range(count)]  # worker id -> {peer worker id: socket}
+    for worker_id in range(count):
+        for peer in range(worker_id + 1, count):
+            links[worker_id][peer], links[peer][worker_id] = socket.socketpair()
+
+    context = multiprocessing.get_context('fork')
+    ready_read, ready_write = os.pipe()
+    lifeline_read, lifeline_write = os.pipe()
+    workers = []
+    for worker_id in range(count):
+        worker = context.Process(target=run_worker,
+                                 args=(worker_id, links, create_server, ready_write, (lifeline_read, lifeline_write)),
+                                 name=f"worker-{worker_id}", daemon=True)
+        worker.start()
+        workers.append(worker)
+    for peer_links in links:
+        for sock in peer_links.values():
+            sock.close()
+    os.close(ready_write)
+    os.close(lifeline_read)
+
+    # Every worker writes a byte once it listens; a worker that fails to start closes its end unwritten
+    started = 0
+    while started < count:
+        signals = os.read(ready_read, count - started)
+        if not signals:
+            break
+        started += len(signals)
+    os.close(ready_read)
+    if started < count:
+        print(f"Only {started} of {count} workers started")
+    return workers
+
+
+def wait_for_workers(workers):
+    """Block until the workers exit; stopping this process stops them too"""
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for worker in workers:
+            worker.join()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            worker.join()
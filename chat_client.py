@@ -1,216 +1,688 @@
-import socket
-import threading
-import os
-import time
-
-class Client:
-    def __init__(self, host='192.168.0.19', port=5555):
-        self.host = host
-        self.port = port
-        self.nickname = ""
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.receiving_file = False
-        self.current_file = None
-        self.file_name = ""
-        self.file_size = 0
-        self.bytes_received = 0
-        self.sending_file = False
-        self.last_sent_file = ""
-    
-    def connect(self):
-        try:
-            self.client.connect((self.host, self.port))
-            return True
-        except Exception as e:
-            print(f"Connection error: {e}")
-            return False
-    
-    def handle_file_receive(self, sock, filename, filesize):
-        # Create downloads directory if it doesn't exist
-        os.makedirs('downloads', exist_ok=True)
-        
-        download_path = os.path.join('downloads', filename)
-        received_bytes = 0
-        
-        with open(download_path, 'wb') as f:
-            while received_bytes < filesize:
-                data = sock.recv(1024)
-                if not data:
-                    break
-                f.write(data)
-                received_bytes += len(data)
-        
-        print(f"File received and saved to {download_path}")
-
-    def receive_messages(self):
-        while True:
-            try:
-                data = self.client.recv(4096)
-                if not data:
-                    print("Connection to server lost")
-                    if self.current_file:
-                        self.current_file.close()
-                    break
-                
-                # Check if this is a text control message or binary file data
-                try:
-                    # Try to decode as UTF-8, which would work for control messages
-                    message = data.decode('utf-8')
-                    
-                    # Process control message
-                    if message == "NICK":
-                        self.client.send(self.nickname.encode('utf-8'))
-                    
-                    elif message.startswith("FILE_INCOMING:"):
-                        # Format: FILE_INCOMING:filename:filesize:sender
-                        parts = message.split(':')
-                        self.file_name = parts[1]
-                        self.file_size = int(parts[2])
-                        sender = parts[3]
-                        
-                        # Check if this is a file we just sent
-                        if sender == self.nickname and self.file_name == self.last_sent_file:
-                            print(f"\nYour file '{self.file_name}' is being distributed to other clients")
-                            # Skip receiving our own file
-                            self.receiving_file = False
-                        else:
-                            print(f"\nReceiving file '{self.file_name}' from {sender} ({self.file_size} bytes)")
-                            
-                            # Send acknowledgment
-                            self.client.send("READY".encode())
-                            
-                            # Handle the file receive
-                            self.handle_file_receive(self.client, self.file_name, self.file_size)
-                            self.receiving_file = False
-                            self.current_file = None
-                    
-                    elif message.startswith("FILE_TRANSFER_COMPLETE:"):
-                        parts = message.split(':')
-                        completed_file = parts[1]
-                        
-                        # Only process if we're receiving this file
-                        if self.receiving_file and completed_file == self.file_name and self.current_file:
-                            self.current_file.flush()
-                            self.current_file.close()
-                            print(f"\nFile received and saved to downloads/{self.file_name}")
-                            self.receiving_file = False
-                            self.current_file = None
-                        elif completed_file == self.last_sent_file:
-                            print(f"\nYour file '{completed_file}' was successfully sent to all clients")
-                            self.sending_file = False
-                            self.last_sent_file = ""
-                    
-                    else:
-                        # Regular text message
-                        print(message)
-                
-                except UnicodeDecodeError:
-                    # This is binary data, likely file content
-                    if self.receiving_file and self.current_file:
-                        self.current_file.write(data)
-                        self.bytes_received += len(data)
-                        
-                        # Print progress
-                        progress = (self.bytes_received / self.file_size) * 100
-                        print(f"\rReceiving: {progress:.1f}% complete", end="")
-                    else:
-                        # Unexpected binary data - ignore
-                        pass
-            
-            except Exception as e:
-                print(f"Error in receive_messages: {e}")
-                if self.current_file:
-                    self.current_file.close()
-                break
-    
-    def send_file(self, file_path):
-        try:
-            if not os.path.exists(file_path):
-                print(f"File not found: {file_path}")
-                return False
-            
-            file_size = os.path.getsize(file_path)
-            file_name = os.path.basename(file_path)
-            
-            self.sending_file = True
-            self.last_sent_file = file_name
-            
-            self.client.send(f"FILE_TRANSFER:{file_name}:{file_size}".encode('utf-8'))
-            time.sleep(0.5)
-            
-            with open(file_path, 'rb') as file:
-                bytes_sent = 0
-                chunk_size = 4096
-                
-                while bytes_sent < file_size:
-                    chunk = file.read(chunk_size)
-                    if not chunk:
-                        break
-                    
-                    self.client.send(chunk)
-                    bytes_sent += len(chunk)
-                    
-                    # Update progress on same line
-                    progress = (bytes_sent / file_size) * 100
-                    print(f"\rSending: {progress:.1f}% complete", end='', flush=True)
-                
-                # Print newline after transfer completes
-                print("\nFile uploaded to server, distributing to clients...")
-                return True
-            
-        except Exception as e:
-            print(f"\nError sending file: {e}")
-            self.sending_file = False
-            self.last_sent_file = ""
-            return False
-    
-    def send_message(self, message):
-        try:
-            self.client.send(message.encode('utf-8'))
-            return True
-        except Exception as e:
-            print(f"Error sending message: {e}")
-            return False
-    
-    def start(self):
-        print("=== Chat Client ===")
-        self.nickname = input("Enter your nickname: ")
-        
-        if not self.connect():
-            print("Failed to connect to server.")
-            return
-        
-        receive_thread = threading.Thread(target=self.receive_messages)
-        receive_thread.daemon = True
-        receive_thread.start()
-        
-        print("Connected to the server! Type 'file:path/to/file' to send a file.")
-        
-        while True:
-            try:
-                message = input()
-                
-                if message.lower() == 'quit':
-                    break
-                
-                elif message.startswith('file:'):
-                    file_path = message[5:].strip()
-                    self.send_file(file_path)
-                
-                else:
-                    self.send_message(message)
-            
-            except KeyboardInterrupt:
-                break
-            except Exception as e:
-                print(f"Error: {e}")
-                break
-        
-        print("Disconnecting from server...")
-        if self.current_file:
-            self.current_file.close()
-        self.client.close()
-
-if __name__ == "__main__":
-    client = Client()
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import socket
+import threading
+import os
+import random
+import time
+
+import compression
+import protocol
+import tls
+import transfer
+
+# Events the receive engine reports to Client.on_event as (kind, info)
+EVENT_CHAT = 'chat'                  # info: the chat line
+EVENT_FILE_OFFER = 'file-offer'      # info: the FILE_INCOMING offer of a file someone else sends
+EVENT_FILE_CHUNK = 'file-chunk'      # info: (transfer id, offset, byte count) written to a download
+EVENT_PROGRESS = 'progress'          # info: (direction, file name, done, total), at most every progress_interval
+EVENT_COMPLETE = 'complete'          # info: the FILE_COMPLETE dict plus "path", None for a file this client sent
+EVENT_RECONNECTING = 'reconnecting'  # info: (attempt, seconds until it is made) after the connection dropped
+EVENT_RECONNECTED = 'reconnected'    # info: the SESSION reply; "resumed" is false for a new session
+EVENT_DISCONNECTED = 'disconnected'  # info: the error, or None when the server closed the connection; final
+
+class Client:
+    def __init__(self, host='192.168.0.19', port=5555, chunk_size=1024 * 1024, socket_buffer=None,
+                 progress_interval=0.1, on_progress=None, streams=4, range_size=8 * 1024 * 1024,
+                 compression_codec='auto', compress_thresholds=None, history_lines=20, on_message=None,
+                 on_event=None, tls_context=None, server_hostname=None, reconnect_attempts=10, reconnect_delay=0.5,
+                 reconnect_max_delay=30.0):
+        self.host = host
+        self.port = port
+        self.nickname = ""
+        self.socket_buffer = socket_buffer
+        self.client = self.new_socket()
+        self.chunk_size = min(chunk_size, protocol.MAX_PAYLOAD - protocol.FILE_CHUNK.size)  # File bytes per frame
+        self.receive_buffer_size = 256 * 1024
+        self.progress_interval = progress_interval  # Minimum seconds between progress reports
+        self.on_progress = on_progress or self.print_progress
+        self.on_message = on_message or print  # Shows a line to the user; called from the receive and upload threads
+        self.on_event = on_event or self.show_event  # Called from the receive thread, and the upload threads for progress
+        self.progress_times = {}  # (direction, file name) -> time of the last report
+        self.send_lock = threading.Lock()  # Keeps frames from different threads whole
+        self.incoming_files = {}  # transfer id -> transfer.Download
+        self.download_dir = 'downloads'
+        self.sent_files = {}  # sha256 -> (path, manifest, (size, mtime)) of files offered, for resends
+        self.offer_replies = {}  # transfer id -> [event, FILE_ACCEPT reply] while an offer is waiting
+        self.accept_timeout = 30.0  # Seconds to wait for the server to accept an offer
+        self.streams = streams  # Parallel upload connections for files bigger than range_size
+        self.range_size = range_size  # Bytes each upload connection takes at a time
+        self.compression_codec = compression_codec  # 'auto', 'off' or a codec name
+        self.compressor = compression.FrameCompressor(compress_thresholds)
+        self.codec = None  # Set if the server agreed to compression
+        self.history_lines = history_lines  # Lobby lines to ask for on connecting
+        self.tls_context = tls_context  # ssl.SSLContext; None connects in the clear
+        self.server_hostname = server_hostname or host  # Name the server's certificate is checked against
+        self.tls_session = None  # Resumed by the upload connections instead of a full handshake each
+        self.session_token = None  # From the server's SESSION frame; presented to resume the session after a drop
+        self.reconnect_attempts = reconnect_attempts  # Tries after a drop before giving up; 0 doesn't reconnect
+        self.reconnect_delay = reconnect_delay  # Seconds before the first try, doubled after each failed one
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnecting = False  # Connected again, waiting to hear whether the session was resumed
+        self.reconnect_attempt = 0
+        self.closed = threading.Event()  # Set by close(); the receive engine doesn't reconnect after it
+        self.next_transfer_id = 0
+        self.sending_file = False
+        self.last_sent_file = ""
+    
+    def new_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.socket_buffer:
+            # Fixed kernel buffers; left unset, Linux autotunes them, which suits most links
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer)
+        return sock
+    
+    def connect(self):
+        try:
+            self.client.connect((self.host, self.port))
+            if self.tls_context is not None:
+                self.client = self.wrap_tls(self.client)
+            return True
+        except Exception as e:
+            self.on_message(f"Connection error: {e}")
+            return False
+    
+    def wrap_tls(self, sock):
+        return self.tls_context.wrap_socket(sock, server_hostname=self.server_hostname, session=self.tls_session)
+    
+    def print_progress(self, direction, file_name, done, total):
+        progress = (done / total) * 100 if total else 100.0
+        print(f"\r{direction}: {progress:.1f}% complete", end='', flush=True)
+    
+    def report_progress(self, direction, file_name, done, total):
+        # Throttled by time so multi-GB transfers don't spend their time reporting
+        key = (direction, file_name)
+        now = time.monotonic()
+        if done < total:
+            if now - self.progress_times.get(key, 0) < self.progress_interval:
+                return
+            self.progress_times[key] = now
+        else:
+            self.progress_times.pop(key, None)
+        self.on_event(EVENT_PROGRESS, (direction, file_name, done, total))
+    
+    def show_event(self, kind, info):
+        """The default on_event: chat lines go to on_message and progress to on_progress.
+
+        Handlers of their own can pass the events they don't handle on to this.
+        """
+        if kind == EVENT_CHAT:
+            self.on_message(info)
+        elif kind == EVENT_PROGRESS:
+            self.on_progress(*info)
+        elif kind == EVENT_RECONNECTING:
+            attempt, delay = info
+            self.on_message(f"\nConnection to server lost, reconnecting in {delay:.1f} s (attempt {attempt})")
+        elif kind == EVENT_RECONNECTED:
+            if not info.get('resumed'):
+                self.on_message("Reconnected as a new session")
+            elif info['lost']:
+                self.on_message(f"Reconnected: {info['replayed']} missed frames replayed, {info['lost']} older ones lost")
+            else:
+                self.on_message(f"Reconnected: {info['replayed']} missed frames replayed")
+        elif kind == EVENT_DISCONNECTED:
+            self.on_message("Connection to server lost" if info is None else f"Error in receive_messages: {info}")
+    
+    def send_frame(self, frame):
+        if self.codec is not None:
+            frame = self.compressor.compress(frame, self.codec)
+        with self.send_lock:
+            self.client.sendall(frame)
+    
+    def handle_file_incoming(self, info):
+        # Check if this is a file we just sent
+        if info['sender'] == self.nickname and info['name'] == self.last_sent_file:
+            self.on_message(f"\nYour file '{info['name']}' is being distributed to other clients")
+            return
+        
+        self.on_event(EVENT_FILE_OFFER, info)
+        self.on_message(f"\nReceiving file '{info['name']}' from {info['sender']} ({info['size']} bytes)")
+        
+        # Create downloads directory if it doesn't exist
+        os.makedirs(self.download_dir, exist_ok=True)
+        
+        existing = transfer.find_download(self.download_dir, info.get('sha256'), info['size'])
+        if existing is not None:
+            self.on_message(f"Already have it as {existing}, skipping the download")
+            transfer.remove_partial(self.download_dir, info['name'])
+            self.send_frame(protocol.encode_json(protocol.FILE_SKIP, {'id': info['id']}))
+            return
+        
+        # Picks up a .part file left by an earlier attempt at the same content
+        download = transfer.Download.open(self.download_dir, info)
+        if download.have:
+            self.on_message(f"Resuming with {len(download.have)} of {len(download.chunks)} chunks already received")
+        self.incoming_files[info['id']] = download
+    
+    def handle_file_data(self, payload):
+        transfer_id, offset, data = protocol.decode_file_data(payload)
+        download = self.incoming_files.get(transfer_id)
+        if download is None:
+            return
+        
+        download.write(offset, data)
+        self.on_event(EVENT_FILE_CHUNK, (transfer_id, offset, len(data)))
+        self.report_progress('Receiving', download.name, download.received, download.size)
+    
+    def handle_file_complete(self, info):
+        download = self.incoming_files.pop(info['id'], None)
+        if download is not None:
+            if download.close():
+                self.on_message(f"\nFile received and saved to {download.path}")
+                self.on_event(EVENT_COMPLETE, dict(info, path=download.path))
+            else:
+                # Some chunks failed their checksum; ask for just those again
+                self.on_message(f"\n{len(download.missing())} chunks of '{download.name}' are missing or corrupt, requesting them again")
+                self.send_frame(protocol.encode_json(protocol.FILE_RESUME, transfer.resume_request(download.state())))
+        elif info['name'] == self.last_sent_file:
+            self.on_message(f"\nYour file '{info['name']}' was successfully sent to all clients")
+            self.sending_file = False
+            self.last_sent_file = ""
+            self.on_event(EVENT_COMPLETE, dict(info, path=None))
+    
+    def handle_file_abort(self, info):
+        download = self.incoming_files.pop(info['id'], None)
+        if download is not None:
+            download.close()
+            self.on_message(f"\nThe sender of '{download.name}' disconnected; {len(download.have)} of "
+                  f"{len(download.chunks)} chunks kept. Type 'resume' to continue later.")
+    
+    def handle_file_resend(self, request):
+        # Runs on its own thread so the receive loop keeps going while the file is read
+        thread = threading.Thread(target=self.resend_file, args=(request,))
+        thread.daemon = True
+        thread.start()
+    
+    def resend_file(self, request):
+        sent = self.sent_files.get(request['sha256'])
+        if sent is not None:
+            path, manifest, signature = sent
+            try:
+                stat = os.stat(path)
+                size = stat.st_size
+                if (size, stat.st_mtime_ns) == signature and all(
+                        offset >= 0 and length >= 0 and offset + length <= size
+                        for offset, length in request['ranges']):
+                    self.send_file(path, request)
+                    return
+            except OSError:
+                pass
+        # Not sent from here this session, or changed since
+        self.send_frame(protocol.encode_json(protocol.FILE_UNAVAILABLE, {
+            'request': request['request'],
+            'sha256': request['sha256']
+        }))
+    
+    def resume_downloads(self):
+        """Ask for the missing chunks of every interrupted download"""
+        active = {download.sha256 for download in self.incoming_files.values()}
+        for state in transfer.unfinished_downloads(self.download_dir):
+            if state['sha256'] in active:
+                continue
+            self.on_message(f"Resuming '{state['name']}' from {state['sender']}")
+            self.send_frame(protocol.encode_json(protocol.FILE_RESUME, transfer.resume_request(state)))
+    
+    def close_incoming_files(self):
+        for download in self.incoming_files.values():
+            download.close()  # Saves which chunks arrived so the download can resume
+        self.incoming_files.clear()
+    
+    def handle_frame(self, frame_type, payload):
+        if frame_type == protocol.NICK:
+            if self.tls_context is not None:
+                # TLS 1.3 session tickets arrive right after the handshake, before this request
+                self.tls_session = self.client.session
+            offered = protocol.decode_json(payload).get('compression', []) if payload else []
+            self.codec = compression.choose(offered, self.compression_codec)
+            if self.codec is not None:
+                self.send_frame(protocol.encode_json(protocol.COMPRESSION, {'codec': self.codec.name}))
+            if self.session_token is not None:
+                # The server answers with the frames sent while this client was away, then SESSION
+                self.send_frame(protocol.encode_json(protocol.RESUME, {'token': self.session_token,
+                                                                       'nickname': self.nickname}))
+                return
+            self.send_frame(protocol.encode_text(protocol.NICK, self.nickname))
+            self.joined()
+            if self.reconnecting:
+                # A server without sessions; this is a new one
+                self.reconnecting = False
+                self.on_event(EVENT_RECONNECTED, {'resumed': False})
+        
+        elif frame_type == protocol.SESSION:
+            info = protocol.decode_json(payload)
+            self.session_token = info['token']
+            if self.reconnecting:
+                self.reconnecting = False
+                if info.get('resumed'):
+                    self.resume_downloads()
+                else:
+                    self.joined()  # The session had expired
+                self.on_event(EVENT_RECONNECTED, info)
+        
+        elif frame_type == protocol.PING:
+            # A quiet client is still here; the server drops connections that don't answer
+            self.send_frame(protocol.encode_frame(protocol.PONG))
+        
+        elif frame_type == protocol.CHAT:
+            self.on_event(EVENT_CHAT, payload.decode('utf-8'))
+        
+        elif frame_type == protocol.FILE_INCOMING:
+            self.handle_file_incoming(protocol.decode_json(payload))
+        
+        elif frame_type == protocol.FILE_DATA:
+            self.handle_file_data(payload)
+        
+        elif frame_type == protocol.FILE_COMPLETE:
+            self.handle_file_complete(protocol.decode_json(payload))
+        
+        elif frame_type == protocol.FILE_ACCEPT:
+            reply = protocol.decode_json(payload)
+            waiting = self.offer_replies.get(reply['id'])
+            if waiting is not None:
+                waiting[1] = reply
+                waiting[0].set()
+        
+        elif frame_type == protocol.FILE_ABORT:
+            self.handle_file_abort(protocol.decode_json(payload))
+        
+        elif frame_type == protocol.FILE_RESEND:
+            self.handle_file_resend(protocol.decode_json(payload))
+        
+        elif frame_type == protocol.FILE_UNAVAILABLE:
+            info = protocol.decode_json(payload)
+            self.on_message(f"\n'{info['name']}' can't be resumed right now: its sender is not connected")
+        
+        elif frame_type == protocol.CHANNELS:
+            info = protocol.decode_json(payload)
+            self.on_message("Channels: " + ", ".join(f"#{name} ({members})" for name, members in sorted(info['channels'].items())))
+            self.on_message("Joined: " + ", ".join(f"#{name}" for name in info['joined']))
+        
+        elif frame_type == protocol.WHO:
+            users = protocol.decode_json(payload)['users']
+            self.on_message(f"Online ({len(users)}): " + ", ".join(
+                f"{nickname}@{server}" if server else nickname for nickname, server in sorted(users.items())))
+        
+        elif frame_type == protocol.HISTORY:
+            reply = protocol.decode_json(payload)
+            for seq, when, line in reply['messages']:
+                self.on_message(f"[{time.strftime('%H:%M', time.localtime(when))}] {line}")
+            if reply['next'] is not None:
+                self.on_message(f"More history: 'history:{reply['channel']} since {reply['next']}'")
+        
+        elif frame_type == protocol.STATS:
+            stats = protocol.decode_json(payload)
+            self.on_message(f"Server stats (up {stats.pop('uptime_s')} s):")
+            for name, value in stats.items():
+                if not isinstance(value, dict):
+                    self.on_message(f"  {name}: {value}")
+                elif 'per_s' in value:
+                    self.on_message(f"  {name}: {value['total']} ({value['per_s']}/s)")
+                elif value['count']:
+                    self.on_message(f"  {name}: {value['count']} observed, p50 <= {value['p50']}, p99 <= {value['p99']}")
+    
+    def joined(self):
+        # A new session: the lobby's last lines, then whatever downloads an earlier one left unfinished
+        if self.history_lines:
+            self.request_history(last=self.history_lines)
+        self.resume_downloads()
+    
+    def receive_messages(self):
+        """The receive engine, shared by the command-line client and the GUI; run it on its own thread.
+
+        Frames are read through one reused buffer and reported to on_event. When the connection
+        drops, it reconnects and resumes the session; it returns once the client is closed or
+        reconnecting fails.
+        """
+        while True:
+            error = self.receive_frames()
+            self.close_incoming_files()
+            if self.closed.is_set() or not self.reconnect():
+                self.on_event(EVENT_DISCONNECTED, error)
+                return
+    
+    def receive_frames(self):
+        """Handle frames until the connection ends; returns the error, or None if the server closed it"""
+        reader = protocol.FrameReader(self.client, self.receive_buffer_size, compression.DECODERS)
+        while True:
+            try:
+                frame = reader.read_frame()
+                if frame is None:
+                    return None
+                
+                self.handle_frame(*frame)
+            
+            except Exception as e:
+                return e
+    
+    def reconnect(self):
+        """Connect again with jittered exponential backoff, so clients dropped together don't all come back at once.
+
+        Returns False if every attempt failed or the client was closed meanwhile.
+        """
+        if not self.reconnecting:
+            # A drop before the server answered the last reconnect keeps counting from there
+            self.reconnect_attempt = 0
+        while self.reconnect_attempt < self.reconnect_attempts:
+            delay = min(self.reconnect_delay * 2 ** self.reconnect_attempt, self.reconnect_max_delay)
+            self.reconnect_attempt += 1
+            wait = delay * random.uniform(0.5, 1.5)
+            self.on_event(EVENT_RECONNECTING, (self.reconnect_attempt, wait))
+            if self.closed.wait(wait):
+                return False
+            self.client.close()
+            self.client = self.new_socket()
+            self.codec = None  # Negotiated again in reply to the NICK request
+            try:
+                self.client.settimeout(self.accept_timeout)
+                self.client.connect((self.host, self.port))
+                if self.tls_context is not None:
+                    self.client = self.wrap_tls(self.client)
+                self.client.settimeout(None)
+            except OSError:
+                continue
+            self.reconnecting = True
+            return True
+        return False
+    
+    def close(self):
+        """Leave the chat; the server ends the session at once instead of keeping it for a resume"""
+        self.closed.set()
+        try:
+            self.send_frame(protocol.encode_frame(protocol.QUIT))
+        except OSError:
+            pass
+        self.client.close()
+    
+    def send_file(self, file_path, request=None):
+        """Offer a file to the chat, or with a FILE_RESEND request, just the ranges it asks for"""
+        try:
+            if not os.path.exists(file_path):
+                self.on_message(f"File not found: {file_path}")
+                return False
+            
+            file_size = os.path.getsize(file_path)
+            file_name = os.path.basename(file_path)
+            
+            if request is None:
+                # Hash the chunks up front so receivers can verify and resume
+                manifest = transfer.build_manifest(file_path)
+                stat = os.stat(file_path)
+                self.sent_files[manifest['sha256']] = (file_path, manifest, (stat.st_size, stat.st_mtime_ns))
+                ranges = [[0, file_size]]
+                self.sending_file = True
+                self.last_sent_file = file_name
+            else:
+                manifest = self.sent_files[request['sha256']][1]
+                ranges = request['ranges']
+            self.next_transfer_id += 1
+            transfer_id = self.next_transfer_id
+            
+            offer = {
+                'id': transfer_id,
+                'name': file_name,
+                'size': file_size
+            }
+            offer.update(manifest)
+            if request is not None:
+                offer['request'] = request['request']
+                offer['ranges'] = ranges
+            total = sum(length for _, length in ranges)
+            if self.streams > 1 and total > self.range_size:
+                offer['streams'] = self.streams
+            waiting = self.offer_replies[transfer_id] = [threading.Event(), None]
+            self.send_frame(protocol.encode_json(protocol.FILE_OFFER, offer))
+            waiting[0].wait(self.accept_timeout)
+            self.offer_replies.pop(transfer_id, None)
+            if waiting[1] is not None and not waiting[1]['upload']:
+                # The server relays its own copy
+                self.on_message(f"\nThe server already has '{file_name}', no upload needed")
+                return True
+            
+            progress_lock = threading.Lock()
+            bytes_sent = [0]
+            
+            def on_sent(count):
+                with progress_lock:
+                    bytes_sent[0] += count
+                    self.report_progress('Sending', file_name, bytes_sent[0], total)
+            
+            token = waiting[1].get('token') if waiting[1] is not None else None
+            if token is not None:
+                # Byte ranges go over extra connections, leaving this one free for chat
+                self.upload_parallel(file_path, transfer_id, token, ranges, on_sent)
+            else:
+                with open(file_path, 'rb') as file:
+                    self.upload_ranges(self.client, self.send_lock, file, transfer_id, ranges, on_sent)
+            
+            if request is None:
+                # Print newline after transfer completes
+                self.on_message("\nFile uploaded to server, distributing to clients...")
+            return True
+            
+        except Exception as e:
+            self.on_message(f"\nError sending file: {e}")
+            if request is None:
+                self.sending_file = False
+                self.last_sent_file = ""
+            return False
+    
+    def upload_ranges(self, sock, lock, file, transfer_id, ranges, on_sent):
+        for offset, length in ranges:
+            end = offset + length
+            while offset < end:
+                count = min(self.chunk_size, end - offset)
+                
+                # The frame header goes out first, then the kernel copies the
+                # file body straight to the socket (sendfile where available)
+                with lock:
+                    sock.sendall(protocol.file_data_header(transfer_id, offset, count))
+                    sent = sock.sendfile(file, offset, count)
+                if sent < count:
+                    raise IOError(f"{os.path.basename(file.name)} shrank while it was being sent")
+                offset += count
+                on_sent(count)
+    
+    def upload_parallel(self, file_path, transfer_id, token, ranges, on_sent):
+        pieces = collections.deque(transfer.split_ranges(ranges, self.range_size))
+        workers = min(self.streams, len(pieces))
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(self.upload_stream, file_path, transfer_id, token, pieces, on_sent)
+                       for _ in range(workers)]
+            for future in futures:
+                future.result()
+    
+    def upload_stream(self, file_path, transfer_id, token, pieces, on_sent):
+        # One data connection, taking ranges off the shared queue until it is empty
+        sock = self.open_data_channel(token)
+        try:
+            with open(file_path, 'rb') as file:
+                while True:
+                    try:
+                        piece = pieces.popleft()
+                    except IndexError:
+                        break
+                    self.upload_ranges(sock, contextlib.nullcontext(), file, transfer_id, [piece], on_sent)
+        finally:
+            sock.close()
+    
+    def open_data_channel(self, token):
+        sock = socket.create_connection((self.host, self.port), timeout=self.accept_timeout)
+        if self.socket_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer)
+        if self.tls_context is not None:
+            sock = self.wrap_tls(sock)
+        # Every connection is greeted with a NICK request; a data connection answers with its token
+        if protocol.FrameReader(sock, 64).read_frame() is None:
+            raise ConnectionError("Server closed the data connection")
+        sock.settimeout(None)
+        sock.sendall(protocol.encode_json(protocol.DATA_CHANNEL, {'token': token}))
+        return sock
+    
+    def send_message(self, message):
+        try:
+            self.send_frame(protocol.encode_text(protocol.CHAT, message))
+            return True
+        except Exception as e:
+            self.on_message(f"Error sending message: {e}")
+            return False
+    
+    def send_control(self, frame_type, obj):
+        try:
+            self.send_frame(protocol.encode_json(frame_type, obj))
+            return True
+        except Exception as e:
+            self.on_message(f"Error sending message: {e}")
+            return False
+    
+    def send_channel_message(self, channel, message):
+        return self.send_control(protocol.CHANNEL_MESSAGE, {'channel': channel, 'text': message})
+    
+    def send_private_message(self, nickname, message):
+        return self.send_control(protocol.PRIVATE_MESSAGE, {'to': nickname, 'text': message})
+    
+    def join_channel(self, channel):
+        return self.send_control(protocol.JOIN, {'channel': channel})
+    
+    def part_channel(self, channel):
+        return self.send_control(protocol.PART, {'channel': channel})
+    
+    def list_channels(self):
+        return self.send_request(protocol.CHANNELS)
+    
+    def list_users(self):
+        return self.send_request(protocol.WHO)
+    
+    def request_history(self, channel=None, last=None, since=None):
+        """Ask for a channel's (by default the lobby's) last lines, or for its lines from sequence number since on"""
+        request = {'channel': channel} if channel else {}
+        if since is not None:
+            request['since'] = since
+        else:
+            request['last'] = last or 20
+        return self.send_control(protocol.HISTORY, request)
+    
+    def send_request(self, frame_type):
+        try:
+            self.send_frame(protocol.encode_frame(frame_type))
+            return True
+        except Exception as e:
+            self.on_message(f"Error sending message: {e}")
+            return False
+    
+    def handle_command(self, message):
+        """Run a channel or private message command; returns False for a plain chat line"""
+        if message.startswith('join:'):
+            self.join_channel(message[5:].strip())
+        elif message.startswith('part:'):
+            self.part_channel(message[5:].strip())
+        elif message.lower() == 'channels':
+            self.list_channels()
+        elif message.lower() == 'who':
+            self.list_users()
+        elif message.lower() == 'stats':
+            self.send_request(protocol.STATS)
+        elif message.lower() == 'history' or message.startswith('history:'):
+            # history, history:name, history:name 50 or history:name since 1200
+            channel, _, count = message[8:].strip().partition(' ')
+            count = count.split()
+            if len(count) == 2 and count[0] == 'since' and count[1].isdigit():
+                self.request_history(channel, since=int(count[1]))
+            elif not count or (len(count) == 1 and count[0].isdigit()):
+                self.request_history(channel, last=int(count[0]) if count else None)
+            else:
+                self.on_message("Usage: 'history:name [count]' or 'history:name since number'")
+        elif message.startswith('msg:') and ' ' in message:
+            nickname, text = message[4:].split(' ', 1)
+            self.send_private_message(nickname, text)
+        elif message.startswith('#') and ' ' in message:
+            channel, text = message[1:].split(' ', 1)
+            self.send_channel_message(channel, text)
+        else:
+            return False
+        return True
+    
+    def start(self):
+        print("=== Chat Client ===")
+        self.nickname = input("Enter your nickname: ")
+        
+        if not self.connect():
+            print("Failed to connect to server.")
+            return
+        
+        receive_thread = threading.Thread(target=self.receive_messages)
+        receive_thread.daemon = True
+        receive_thread.start()
+        
+        print("Connected to the server! Type 'file:path/to/file' to send a file, 'resume' to retry interrupted downloads.")
+        print("Channels: 'join:name', 'part:name', 'channels', '#name message'; private messages: 'msg:nickname message'; 'who' lists users, 'stats' shows server metrics.")
+        print("History: 'history:name [count]' shows a channel's last lines, 'history:name since number' pages through it.")
+        
+        while True:
+            try:
+                message = input()
+                
+                if message.lower() == 'quit':
+                    break
+                
+                elif message.startswith('file:'):
+                    file_path = message[5:].strip()
+                    self.send_file(file_path)
+                
+                elif message.lower() == 'resume':
+                    self.resume_downloads()
+                
+                elif not self.handle_command(message):
+                    self.send_message(message)
+            
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                print(f"Error: {e}")
+                break
+        
+        print("Disconnecting from server...")
+        self.close()
+        self.close_incoming_files()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument('--host', default='192.168.0.19')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--chunk-size', type=int, default=1024 * 1024,
+                        help="file bytes per frame when sending")
+    parser.add_argument('--socket-buffer', type=int, default=None,
+                        help="SO_SNDBUF/SO_RCVBUF size; left to the OS by default")
+    parser.add_argument('--streams', type=int, default=4,
+                        help="parallel upload connections for files larger than --range-size; 1 sends on the chat connection")
+    parser.add_argument('--range-size', type=int, default=8 * 1024 * 1024,
+                        help="bytes each upload connection sends at a time")
+    parser.add_argument('--compression', choices=['auto', 'off'] + list(compression.CODECS), default='auto',
+                        help="codec to use if the server offers it; auto picks the best one both sides have")
+    parser.add_argument('--compress-threshold', action='append', default=[], metavar='GROUP=BYTES',
+                        help="smallest text, control or file payload to compress, or 'off'; e.g. text=128")
+    parser.add_argument('--history', type=int, default=20,
+                        help="lobby lines to show on connecting; 0 shows none")
+    parser.add_argument('--tls', action='store_true', help="connect over TLS")
+    parser.add_argument('--tls-ca', default=None,
+                        help="PEM file of the certificates to trust; the system's by default")
+    parser.add_argument('--tls-no-verify', action='store_true',
+                        help="accept any server certificate, e.g. a self-signed one while testing")
+    parser.add_argument('--server-name', default=None,
+                        help="name the server certificate must be issued for; --host by default")
+    parser.add_argument('--reconnect-attempts', type=int, default=10,
+                        help="tries to reconnect after the connection drops; 0 doesn't reconnect")
+    args = parser.parse_args()
+    try:
+        thresholds = compression.parse_thresholds(args.compress_threshold)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    client = Client(args.host, args.port, chunk_size=args.chunk_size, socket_buffer=args.socket_buffer,
+                    streams=args.streams, range_size=args.range_size, compression_codec=args.compression,
+                    compress_thresholds=thresholds, history_lines=args.history,
+                    tls_context=tls.client_context(args.tls_ca, not args.tls_no_verify) if args.tls else None,
+                    server_hostname=args.server_name, reconnect_attempts=args.reconnect_attempts)
     client.start()
\ No newline at end of file
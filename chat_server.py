@@ -1,171 +1,1241 @@
-import socket
-import threading
-import os
-import time
-import struct
-
-class Server:
-    def __init__(self, host='0.0.0.0', port=5555):
-        self.host = host
-        self.port = port
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((self.host, self.port))
-        self.server.listen(5)
-        self.clients = []
-        self.nicknames = []
-        self.file_transfers = {}  # Track active file transfers
-        
-        print(f"Server started on {self.host}:{self.port}")
-        
-    def broadcast(self, message, sender_socket=None):
-        for client in self.clients:
-            if client != sender_socket:  # Don't send back to sender
-                try:
-                    client.send(message)
-                except:
-                    self.remove_client(client)
-    
-    def broadcast_to_all(self, message):
-        """Send to all clients including sender"""
-        for client in self.clients:
-            try:
-                client.send(message)
-            except:
-                self.remove_client(client)
-    
-    def handle_file_transfer(self, client, file_name, file_size, sender_nickname):
-        try:
-            # Notify all clients about the incoming file
-            file_notice = f"FILE_INCOMING:{file_name}:{file_size}:{sender_nickname}".encode('utf-8')
-            self.broadcast_to_all(file_notice)
-            time.sleep(0.5)  # Give clients time to prepare
-            
-            # Track this client as being in file transfer mode
-            self.file_transfers[client] = {
-                'file_name': file_name,
-                'file_size': file_size,
-                'bytes_received': 0
-            }
-            
-            # Now let the main client handler receive the file data
-            # We'll return here and let the main loop handle the actual data
-        
-        except Exception as e:
-            print(f"Error setting up file transfer: {e}")
-            if client in self.file_transfers:
-                del self.file_transfers[client]
-    
-    def handle_client(self, client, nickname):
-        while True:
-            try:
-                # Check if this client is currently transferring a file
-                if client in self.file_transfers:
-                    transfer_info = self.file_transfers[client]
-                    remaining = transfer_info['file_size'] - transfer_info['bytes_received']
-                    
-                    if remaining <= 0:
-                        # We've received all the expected data
-                        del self.file_transfers[client]
-                        continue
-                    
-                    # Receive file chunk (binary data)
-                    chunk_size = min(4096, remaining)
-                    chunk = client.recv(chunk_size)
-                    
-                    if not chunk:
-                        print(f"Connection lost during file transfer from {nickname}")
-                        del self.file_transfers[client]
-                        break
-                    
-                    # Update bytes received
-                    transfer_info['bytes_received'] += len(chunk)
-                    
-                    # Forward chunk to all other clients without processing
-                    self.broadcast(chunk, client)
-                    
-                    # Show progress
-                    progress = (transfer_info['bytes_received'] / transfer_info['file_size']) * 100
-                    print(f"\rFile transfer progress: {progress:.1f}%", end="")
-                    
-                    # Check if transfer is complete
-                    if transfer_info['bytes_received'] >= transfer_info['file_size']:
-                        print(f"\nFile transfer complete: {transfer_info['file_name']} ({transfer_info['file_size']} bytes)")
-                        complete_notice = f"FILE_TRANSFER_COMPLETE:{transfer_info['file_name']}".encode('utf-8')
-                        self.broadcast_to_all(complete_notice)
-                        del self.file_transfers[client]
-                
-                else:
-                    # Normal message handling mode
-                    message = client.recv(4096)
-                    
-                    if not message:
-                        break
-                    
-                    if message.startswith(b'FILE_TRANSFER:'):
-                        # Parse file info: FILE_TRANSFER:filename:filesize
-                        parts = message.decode('utf-8').split(':')
-                        file_name = parts[1]
-                        file_size = int(parts[2])
-                        
-                        print(f"File transfer initiated by {nickname}: {file_name} ({file_size} bytes)")
-                        
-                        # Set up the file transfer
-                        self.handle_file_transfer(client, file_name, file_size, nickname)
-                    
-                    else:
-                        # Regular chat message, broadcast to all
-                        try:
-                            msg_with_nickname = f"{nickname}: {message.decode('utf-8')}"
-                            print(msg_with_nickname)
-                            self.broadcast(msg_with_nickname.encode('utf-8'), client)
-                        except UnicodeDecodeError:
-                            # This might be binary data that's not properly framed as a file transfer
-                            print(f"Received binary data outside file transfer mode from {nickname}")
-                            # Just ignore it
-            
-            except Exception as e:
-                print(f"Error handling client {nickname}: {e}")
-                if client in self.file_transfers:
-                    del self.file_transfers[client]
-                self.remove_client(client)
-                break
-    
-    def remove_client(self, client):
-        if client in self.clients:
-            index = self.clients.index(client)
-            nickname = self.nicknames[index]
-            self.broadcast(f"{nickname} left the chat!".encode('utf-8'))
-            self.clients.remove(client)
-            self.nicknames.pop(index)
-            if client in self.file_transfers:
-                del self.file_transfers[client]
-            client.close()
-    
-    def receive(self):
-        while True:
-            try:
-                client, address = self.server.accept()
-                print(f"Connected with {address}")
-                
-                client.send("NICK".encode('utf-8'))
-                nickname = client.recv(1024).decode('utf-8')
-                
-                self.nicknames.append(nickname)
-                self.clients.append(client)
-                
-                print(f"Nickname of the client is {nickname}")
-                self.broadcast(f"{nickname} joined the chat!".encode('utf-8'))
-                client.send("Connected to the server!".encode('utf-8'))
-                
-                thread = threading.Thread(target=self.handle_client, args=(client, nickname))
-                thread.daemon = True
-                thread.start()
-            
-            except Exception as e:
-                print(f"Error in receive: {e}")
-                break
-
-if __name__ == "__main__":
-    server = Server()
-    server.receive()
\ No newline at end of file
+import argparse
+import itertools
+import secrets
+import socket
+import threading
+import time
+import os
+
+import bus
+import compression
+import filecache
+import history
+import limits
+import metrics
+import outbox
+import protocol
+import relay
+import sessions
+import tls
+
+class Server:
+    def __init__(self, host='0.0.0.0', port=5555, queue_bytes=1024 * 1024, queue_frames=1000,
+                 slow_consumer_policy=outbox.DROP_OLDEST, file_send_timeout=30.0,
+                 file_relay='broadcast', spool_memory=1024 * 1024, cache_dir=None,
+                 cache_disk=1024 * 1024 * 1024, cache_memory=64 * 1024 * 1024, bus=None,
+                 reuse_port=False, batch_delay=0, batch_bytes=64 * 1024, compression_codecs=None,
+                 compress_thresholds=None, history_dir=None, history_ring=1000,
+                 history_segment_bytes=64 * 1024 * 1024, history_retention_bytes=1024 * 1024 * 1024,
+                 history_fsync_interval=1.0, metrics_port=None, metrics_host='127.0.0.1', log_interval=1.0,
+                 tls_context=None, session_grace=30.0, session_backlog_bytes=1024 * 1024,
+                 session_backlog_frames=1000, listen_backlog=128, max_connections=0, handshake_timeout=10.0,
+                 heartbeat_interval=30.0, idle_timeout=90.0, message_rate=0, message_burst=0, byte_rate=0,
+                 byte_burst=0):
+        self.host = host
+        self.port = port
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.bus = bus  # Links to the other workers or cluster nodes, if there are any
+        self.tls_context = tls_context  # ssl.SSLContext for client connections; None serves plain TCP
+        if reuse_port:
+            # Every worker listens on the same port; the kernel spreads connections over them
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(listen_backlog)
+        self.sessions = sessions.SessionRegistry()  # Connected clients by socket and by nickname
+        self.outboxes = {}  # client -> bounded queue of frames waiting to be sent
+        self.outbox_options = {
+            'max_bytes': queue_bytes,
+            'max_frames': queue_frames,
+            'policy': slow_consumer_policy,
+            'batch_delay': batch_delay,
+            'batch_bytes': batch_bytes
+        }
+        self.batch_delay = batch_delay  # Seconds frames wait to be written together; 0 writes each at once
+        self.batch_bytes = batch_bytes
+        # Codecs offered in the NICK request, every installed one by default
+        self.compression_codecs = list(compression.CODECS) if compression_codecs is None else compression_codecs
+        self.nick_request = protocol.encode_frame(protocol.NICK)
+        if self.compression_codecs:
+            self.nick_request = protocol.encode_json(protocol.NICK, {'compression': self.compression_codecs})
+        self.compressor = compression.FrameCompressor(compress_thresholds)
+        self.codecs = {}  # client -> codec it negotiated
+        self.session_grace = session_grace  # Seconds a dropped client's session waits for a resume; 0 ends it at once
+        self.session_backlog_bytes = session_backlog_bytes  # Frames kept for a dropped client, at most
+        self.session_backlog_frames = session_backlog_frames
+        self.max_connections = max_connections  # Open connections, handshakes and uploads included; 0 is no cap
+        self.handshake_timeout = handshake_timeout  # Seconds a new connection has to register; 0 waits forever
+        self.heartbeat_interval = heartbeat_interval  # A client quiet this long gets a PING; 0 sends none
+        self.idle_timeout = idle_timeout  # A connection quiet this long is dropped; 0 keeps it
+        self.message_rate = message_rate  # Frames a second each client may send, 0 for no limit
+        self.message_burst = message_burst or message_rate
+        self.byte_rate = byte_rate  # Payload bytes a second each client may send, uploads included
+        self.byte_burst = byte_burst or byte_rate
+        self.activity = {}  # socket -> limits.Activity, for every open connection
+        self.wheel = limits.TimerWheel()  # Activity records by when the sweeper looks at them next
+        self.ping = protocol.encode_frame(protocol.PING)
+        self.file_send_timeout = file_send_timeout  # How long a file sender waits for a full queue
+        self.file_relay = file_relay  # 'broadcast' forwards chunks as they arrive, 'spool' relays from a temp file
+        self.spool_memory = spool_memory  # Uploads up to this size stay in memory when spooling
+        self.file_transfers = {}  # (client, client's transfer id) -> active file transfer
+        self.transfer_ids = itertools.count(1)
+        self.resend_requests = {}  # resend request id -> (client resuming a download, file name)
+        self.request_ids = itertools.count(1)
+        self.data_tokens = {}  # token -> (client, client's transfer id) that data connections upload for
+        # Files that were relayed before, so offering them again needs no upload
+        self.file_cache = None
+        if cache_disk or cache_memory:
+            self.file_cache = filecache.FileCache(cache_dir, cache_disk, cache_memory, spool_memory)
+        # Channel lines for HISTORY requests; kept on disk when there is a directory
+        if history_dir is not None and bus is not None:
+            history_dir = os.path.join(history_dir, bus.name.replace(':', '_'))  # One log per worker or node
+        self.history = history.MessageLog(history_dir, history_ring, history_segment_bytes,
+                                          history_retention_bytes, history_fsync_interval)
+        self.metrics = metrics.ServerMetrics()
+        self.metrics.gauge('chat_clients', "Connected clients", lambda: len(self.sessions))
+        self.metrics.gauge('chat_connections_open', "Open connections, handshakes and uploads included",
+                           lambda: len(self.activity))
+        self.metrics.gauge('chat_file_transfers_active', "Uploads in progress", lambda: len(self.file_transfers))
+        self.metrics.gauge('chat_queue_frames', "Frames waiting in each client's send queue",
+                           lambda: {(('client', session.nickname),): len(session.outbox.frames)
+                                    for session in self.sessions.all()})
+        self.metrics.gauge('chat_queue_bytes', "Bytes waiting in each client's send queue",
+                           lambda: {(('client', session.nickname),): session.outbox.bytes
+                                    for session in self.sessions.all()})
+        self.log = metrics.SampledLog(log_interval)  # Chat lines, progress and connections, at most one a second each
+        
+        if bus is None:
+            print(f"Server started on {self.host}:{self.port}")
+        else:
+            print(f"{bus.name} listening on {self.host}:{self.port}")
+        if metrics_port is not None:
+            self.metrics_server = metrics.MetricsServer(self.metrics, metrics_host, metrics_port)
+        
+    def create_outbox(self, client):
+        return outbox.ThreadedOutbox(client, self.drop_client, **self.outbox_options)
+    
+    def call_later(self, delay, callback, *args):
+        timer = threading.Timer(delay, callback, args)
+        timer.daemon = True
+        timer.start()
+    
+    def configure_client(self, client):
+        if self.batch_delay or self.tls_context is not None:
+            # Frames are already coalesced here, and TLS writes whole records; Nagle's algorithm
+            # would only hold them back (after a handshake, for a delayed ACK of the session tickets)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    def tls_established(self, client):
+        self.metrics.tls_handshakes.inc()
+        if client.session_reused:
+            self.metrics.tls_resumed.inc()
+    
+    def at_capacity(self):
+        return self.max_connections and len(self.activity) >= self.max_connections
+    
+    def refuse(self, client):
+        self.metrics.connections_refused.inc()
+        self.log.log('refused', f"Refusing connections: {self.max_connections} are open")
+        if self.tls_context is None:
+            try:
+                # A TLS client only sees the connection close; it can't be told anything before a handshake
+                client.send(protocol.encode_text(protocol.CHAT, "The server is full, try again later"))
+            except OSError:
+                pass
+        client.close()
+    
+    def watch(self, client):
+        """Put a new connection on the timer wheel, for the handshake timeout, heartbeats and the idle timeout"""
+        activity = self.activity[client] = limits.Activity(client)
+        first_check = self.handshake_timeout or self.heartbeat_interval or self.idle_timeout
+        if first_check:
+            self.check_at(activity, activity.last_heard + first_check)
+        return activity
+    
+    def check_at(self, activity, deadline):
+        # Entries can't be taken off the wheel; the latest one for a connection counts
+        activity.due = deadline
+        self.wheel.schedule(deadline, (deadline, activity))
+    
+    def registered(self, client):
+        # Past the handshake: from now on heartbeats and the idle timeout apply instead
+        activity = self.activity.get(client)
+        if activity is not None:
+            activity.registered = True
+            activity.last_heard = time.monotonic()
+            if self.heartbeat_interval or self.idle_timeout:
+                self.check_at(activity, activity.last_heard)
+    
+    def start_sweeper(self):
+        if self.handshake_timeout or self.heartbeat_interval or self.idle_timeout:
+            # One thread for every connection's deadlines
+            thread = threading.Thread(target=self.sweep_forever)
+            thread.daemon = True
+            thread.start()
+    
+    def sweep_forever(self):
+        while True:
+            time.sleep(self.wheel.tick)
+            self.sweep()
+    
+    def sweep(self):
+        now = time.monotonic()
+        for deadline, activity in self.wheel.expire(now):
+            if deadline != activity.due:
+                continue
+            try:
+                deadline = self.check_idle(activity, now)
+            except Exception as e:
+                print(f"Error checking connection of {self.nickname_of(activity.sock)}: {e}")
+                continue
+            if deadline is not None:
+                self.check_at(activity, deadline)
+    
+    def check_idle(self, activity, now):
+        """Close a connection that went quiet for too long, or ping it; returns when to look at it again"""
+        client = activity.sock
+        if self.activity.get(client) is not activity:
+            return None  # Closed since
+        silent = now - activity.last_heard
+        if not activity.registered and self.handshake_timeout:
+            if silent < self.handshake_timeout:
+                return activity.last_heard + self.handshake_timeout
+            self.log.log('connect', f"Closing a connection that didn't finish its handshake in {silent:.0f} s")
+            self.metrics.handshake_timeouts.inc()
+            self.remove_client(client)
+            return None
+        if self.idle_timeout and silent >= self.idle_timeout:
+            self.log.log('connect', f"Dropping {self.nickname_of(client)}: nothing heard for {silent:.0f} s")
+            self.metrics.idle_evictions.inc()
+            self.drop_client(client)
+            return None
+        deadlines = []
+        if self.idle_timeout:
+            deadlines.append(activity.last_heard + self.idle_timeout)
+        if self.heartbeat_interval and client in self.sessions:
+            # Upload connections are never pinged; they only send FILE_DATA
+            last = max(activity.last_heard, activity.pinged_at)
+            if now - last >= self.heartbeat_interval:
+                activity.pinged_at = last = now
+                self.send_to(client, self.ping)
+            deadlines.append(last + self.heartbeat_interval)
+        return min(deadlines) if deadlines else None
+    
+    def rate_limit(self, client, frame_type, size, source=None):
+        """Seconds to stop reading from a client that went over its message or byte rate; 0 if it didn't"""
+        if not (self.message_rate or self.byte_rate):
+            return 0
+        session = self.sessions.get(client)
+        if session is None:
+            return 0
+        delay = 0
+        if session.message_bucket is not None and frame_type != protocol.FILE_DATA:
+            delay = session.message_bucket.spend(1)
+        if session.byte_bucket is not None:
+            delay = max(delay, session.byte_bucket.spend(size))
+        if delay:
+            self.metrics.rate_limited.inc()
+            activity = self.activity.get(source or client)  # source: the upload connection it came in on
+            if activity is not None:
+                # Its frames wait in the socket meanwhile; that isn't silence
+                activity.last_heard = time.monotonic() + delay
+        return delay
+    
+    def send_to(self, client, message, droppable=False, compress=True):
+        client_outbox = self.outboxes.get(client)
+        if client_outbox is None:
+            self.hold(client, message)
+            return
+        codec = self.codecs.get(client)
+        if codec is not None and compress:
+            message = self.compressor.encode(message, codec)
+        if not client_outbox.put(message, droppable):
+            print(f"Disconnecting slow client {self.nickname_of(client)}: send queue full")
+            self.remove_client(client)
+    
+    def hold(self, client, message):
+        # Kept uncompressed: the client may pick another codec when it comes back
+        session = self.sessions.get(client)
+        if session is not None and session.dropped_at is not None:
+            session.backlog.add([message])
+    
+    def broadcast(self, message, sender_socket=None, droppable=False):
+        # The frame is encoded once by the caller; every queue holds a reference to the same bytes
+        started = time.perf_counter()
+        recipients = 0
+        for session in self.sessions.all():
+            if session.sock != sender_socket:  # Don't send back to sender
+                self.send_to(session.sock, message, droppable)
+                recipients += 1
+        self.metrics.broadcast(started, recipients, message)
+    
+    def broadcast_to_all(self, message, droppable=False):
+        """Send to all clients including sender"""
+        started = time.perf_counter()
+        recipients = 0
+        for session in self.sessions.all():
+            self.send_to(session.sock, message, droppable)
+            recipients += 1
+        self.metrics.broadcast(started, recipients, message)
+    
+    def broadcast_to_channel(self, name, message, sender_socket=None, droppable=False, publish=True, history=False):
+        # Only the channel's members are visited, however many clients are connected
+        started = time.perf_counter()
+        recipients = 0
+        for session in self.sessions.members(name):
+            if session.sock != sender_socket:
+                self.send_to(session.sock, message, droppable)
+                recipients += 1
+        self.metrics.broadcast(started, recipients, message)
+        if publish and self.bus is not None:
+            self.bus.publish_channels([name], message, droppable, history)
+    
+    def broadcast_to_channels(self, names, message, droppable=False, publish=True):
+        """Send once to everyone who shares at least one of the channels"""
+        started = time.perf_counter()
+        notified = set()
+        for name in names:
+            for session in self.sessions.members(name):
+                if session.sock not in notified:
+                    notified.add(session.sock)
+                    self.send_to(session.sock, message, droppable)
+        self.metrics.broadcast(started, len(notified), message)
+        if publish and self.bus is not None:
+            self.bus.publish_channels(names, message, droppable)
+    
+    def deliver_remote(self, event_type, meta, frame):
+        """A frame another worker or cluster node forwarded for this server's clients"""
+        if event_type == bus.CHANNEL_FRAME:
+            if meta.get('history'):
+                self.history.append(meta['channels'][0], bytes(frame[protocol.HEADER.size:]).decode('utf-8'))
+            if len(meta['channels']) == 1:
+                self.broadcast_to_channel(meta['channels'][0], frame, droppable=meta['droppable'], publish=False)
+            else:
+                self.broadcast_to_channels(meta['channels'], frame, meta['droppable'], publish=False)
+        elif event_type == bus.PRIVATE_FRAME:
+            session = self.sessions.find(meta['to'])
+            if session is not None:
+                self.send_to(session.sock, frame, droppable=True)
+        elif event_type == bus.FILE_ANNOUNCE:
+            self.broadcast(frame, droppable=True)
+    
+    def who(self):
+        """nickname -> server it is connected to, across every linked server"""
+        name = self.bus.name if self.bus is not None else None
+        users = {session.nickname: name for session in self.sessions.all()}
+        if self.bus is not None:
+            users.update(self.bus.remote_nicknames())
+        return users
+    
+    def local_presence(self):
+        """Nicknames and channel member counts of this server's clients, for a new bus link"""
+        return [session.nickname for session in self.sessions.all()], self.sessions.channel_sizes()
+    
+    def throttle_sender(self, client, source=None):
+        # File data is never dropped: the sender waits until every receiver has room again.
+        # Here that is simply the calling thread blocking, so source (the connection the
+        # chunk came in on) is not used; the event loop's override pauses reads from it
+        for session in self.sessions.all():
+            if session.sock == client:
+                continue
+            if not session.outbox.wait_for_room(self.file_send_timeout):
+                print(f"Disconnecting slow client {session.nickname}: file data not drained")
+                self.remove_client(session.sock)
+    
+    def nickname_of(self, client):
+        session = self.sessions.get(client)
+        return session.nickname if session is not None else None
+    
+    def client_by_nickname(self, nickname):
+        session = self.sessions.find(nickname)
+        return session.sock if session is not None else None
+    
+    def queue_stats(self):
+        """Send queue metrics per nickname"""
+        return {session.nickname: session.outbox.stats() for session in self.sessions.all()}
+    
+    def session_stats(self):
+        """Connection time and traffic counters per nickname"""
+        return {session.nickname: session.stats() for session in self.sessions.all()}
+    
+    def compression_stats(self):
+        """Frames, bytes before and after, ratio and CPU time per codec"""
+        return compression.stats()
+    
+    def history_stats(self):
+        return self.history.stats()
+    
+    def cache_stats(self):
+        return self.file_cache.stats() if self.file_cache is not None else None
+    
+    def channel_stats(self):
+        """Member count per channel, on every worker"""
+        sizes = self.sessions.channel_sizes()
+        if self.bus is not None:
+            for name, members in self.bus.channel_sizes().items():
+                sizes[name] = sizes.get(name, 0) + members
+        return sizes
+    
+    def reply(self, client, text):
+        self.send_to(client, protocol.encode_text(protocol.CHAT, text))
+    
+    def join_channel(self, client, name):
+        session = self.sessions.get(client)
+        channel = sessions.channel_name(name)
+        if session is None:
+            return
+        if channel is None:
+            self.reply(client, f"Invalid channel name: {name}")
+        elif not self.sessions.join(session, channel):
+            self.reply(client, f"You are already in #{channel}")
+        else:
+            if self.bus is not None:
+                self.bus.subscribe(channel)
+            self.broadcast_to_channel(channel, protocol.encode_text(protocol.CHAT, f"{session.nickname} joined #{channel}"),
+                                      droppable=True)
+    
+    def part_channel(self, client, name):
+        session = self.sessions.get(client)
+        channel = sessions.channel_name(name)
+        if session is None:
+            return
+        if channel is None or not self.sessions.part(session, channel):
+            self.reply(client, f"You are not in #{channel or name}")
+            return
+        if self.bus is not None:
+            self.bus.unsubscribe(channel)
+        notice = protocol.encode_text(protocol.CHAT, f"{session.nickname} left #{channel}")
+        self.send_to(client, notice)
+        self.broadcast_to_channel(channel, notice, droppable=True)
+    
+    def channel_message(self, client, nickname, name, text):
+        session = self.sessions.get(client)
+        channel = sessions.channel_name(name)
+        if session is None:
+            return
+        if channel not in session.channels:
+            self.reply(client, f"You are not in #{channel or name}")
+            return
+        line = f"{nickname}: {text}" if channel == sessions.LOBBY else f"[#{channel}] {nickname}: {text}"
+        self.metrics.messages.inc()
+        self.log.log('chat', line)
+        self.history.append(channel, line)
+        self.broadcast_to_channel(channel, protocol.encode_text(protocol.CHAT, line), client, droppable=True,
+                                  history=True)
+    
+    def send_history(self, client, request):
+        session = self.sessions.get(client)
+        channel = sessions.channel_name(request.get('channel', sessions.LOBBY))
+        if session is None:
+            return
+        if channel not in session.channels:
+            self.reply(client, f"You are not in #{channel or request['channel']}")
+            return
+        limit = min(request.get('limit', history.MAX_REPLY), history.MAX_REPLY)
+        lines, next_seq = self.history.read(channel, request.get('last'), request.get('since'), limit)
+        self.send_to(client, protocol.encode_json(protocol.HISTORY, {
+            'channel': channel,
+            'messages': lines,
+            'next': next_seq
+        }))
+    
+    def private_message(self, client, nickname, message):
+        self.metrics.messages.inc()
+        recipient = self.sessions.find(message['to'])
+        frame = protocol.encode_text(protocol.CHAT, f"[private] {nickname}: {message['text']}")
+        if recipient is not None:
+            self.send_to(recipient.sock, frame, droppable=True)
+        elif self.bus is None or not self.bus.publish_private(message['to'], frame):
+            self.reply(client, f"No user named {message['to']}")
+    
+    def handle_file_transfer(self, client, offer, sender_nickname):
+        client_transfer_id = offer['id']
+        file_name = os.path.basename(offer['name'])
+        file_size = int(offer['size'])
+        try:
+            transfer_info = {
+                'id': next(self.transfer_ids),
+                'file_name': file_name,
+                'file_size': file_size,
+                'expected': file_size,  # Bytes the sender is going to upload
+                'ranges': None,  # [offset, length] ranges a resend covers; None is the whole file
+                'bytes_received': 0,
+                'relay': None,
+                'recipients': None,  # None sends to everyone else
+                'skipped': set(),  # Receivers that already have the file
+                'incompressible': False,  # Set once a chunk did not compress; the rest is forwarded as is
+                'cache': None,  # filecache.CacheWriter keeping a copy of the upload
+                'token': None,  # Lets parallel data connections upload to this transfer
+                'lock': threading.Lock(),  # Data connections deliver chunks concurrently
+                'started': time.monotonic()
+            }
+            notice = {
+                'id': transfer_info['id'],
+                'name': file_name,
+                'size': file_size,
+                'sender': sender_nickname
+            }
+            # The manifest lets receivers check each chunk and resume a broken download
+            manifest = {key: offer[key] for key in ('sha256', 'chunk_size', 'chunks') if key in offer}
+            notice.update(manifest)
+            transfer_info['notice'] = protocol.encode_json(protocol.FILE_INCOMING, notice)
+            
+            if 'request' not in offer and self.bus is not None:
+                # The data stays here; clients of the other servers only hear about the file
+                self.bus.announce_file(
+                    {'name': file_name, 'size': file_size, 'sha256': manifest.get('sha256'), 'sender': sender_nickname},
+                    protocol.encode_text(protocol.CHAT,
+                                         f"{sender_nickname} is sharing {file_name} ({file_size} bytes) on {self.bus.name}"))
+            
+            if 'request' not in offer and self.file_cache is not None and manifest.get('sha256'):
+                entry = self.file_cache.get(manifest['sha256'])
+                if entry is not None and entry.size == file_size:
+                    if self.relay_cached(client, client_transfer_id, entry, transfer_info, notice):
+                        return
+                transfer_info['cache'] = self.file_cache.writer(file_size, manifest)
+            
+            accept = {'id': client_transfer_id, 'upload': True}
+            if offer.get('streams', 1) > 1:
+                # The sender may upload byte ranges over several extra connections
+                transfer_info['token'] = accept['token'] = secrets.token_hex(16)
+                self.data_tokens[transfer_info['token']] = (client, client_transfer_id)
+            self.send_to(client, protocol.encode_json(protocol.FILE_ACCEPT, accept))
+            
+            if 'request' in offer:
+                # Missing ranges sent again for one client that is resuming a download
+                requester, _ = self.resend_requests.pop(offer['request'], (None, None))
+                transfer_info['recipients'] = [requester] if requester in self.sessions else []
+                transfer_info['expected'] = sum(length for _, length in offer['ranges'])
+                transfer_info['ranges'] = offer['ranges']
+            
+            # Track the transfer; its FILE_DATA frames arrive through the normal frame loop
+            self.file_transfers[(client, client_transfer_id)] = transfer_info
+            self.sessions.get(client).transfers[client_transfer_id] = transfer_info
+            
+            if transfer_info['recipients'] is not None:
+                for recipient in transfer_info['recipients']:
+                    self.send_to(recipient, transfer_info['notice'])
+            elif self.file_relay == 'spool':
+                # Every receiver reads the spooled upload at its own pace
+                transfer_info['relay'] = relay.SpoolRelay(transfer_info['id'], file_name, file_size,
+                                                          sender_nickname, self.spool_memory)
+                self.send_to(client, transfer_info['notice'])
+                for session in self.sessions.all():
+                    if session.sock != client:
+                        self.start_relay(session.sock, transfer_info)
+            else:
+                # Notify all clients about the incoming file
+                self.broadcast_to_all(transfer_info['notice'])
+            
+            if transfer_info['expected'] == 0:
+                self.complete_file_transfer(client, client_transfer_id)
+        
+        except Exception as e:
+            print(f"Error setting up file transfer: {e}")
+            self.file_transfers.pop((client, client_transfer_id), None)
+            session = self.sessions.get(client)
+            if session is not None:
+                session.transfers.pop(client_transfer_id, None)
+    
+    def relay_cached(self, client, client_transfer_id, entry, transfer_info, notice):
+        """Send everyone the server's copy of an offered file instead of taking the upload"""
+        try:
+            cached = relay.CachedRelay(transfer_info['id'], transfer_info['file_name'], entry, notice['sender'])
+        except OSError:
+            return False  # Evicted just now; take the upload instead
+        
+        print(f"Cache hit: {transfer_info['file_name']} ({entry.size} bytes) relayed without an upload")
+        self.file_cache.record_saved(entry.size)
+        self.send_to(client, protocol.encode_json(protocol.FILE_ACCEPT, {'id': client_transfer_id, 'upload': False}))
+        self.send_to(client, transfer_info['notice'])
+        transfer_info['relay'] = cached
+        for session in self.sessions.all():
+            if session.sock != client:
+                self.start_relay(session.sock, transfer_info)
+        self.send_to(client, protocol.encode_json(protocol.FILE_COMPLETE, {
+            'id': transfer_info['id'],
+            'name': transfer_info['file_name']
+        }))
+        cached.finish()
+        return True
+    
+    def start_relay(self, client, transfer_info):
+        self.send_to(client, transfer_info['notice'])
+        client_outbox = self.outboxes.get(client)
+        if client_outbox is not None:
+            transfer_info['relay'].stream_to(client_outbox, codec=self.codecs.get(client), compressor=self.compressor)
+    
+    def handle_file_chunk(self, client, payload, source=None):
+        """FILE_DATA from client, received on its own socket or on one of its data connections (source)"""
+        client_transfer_id, offset, chunk = protocol.decode_file_data(payload)
+        transfer_info = self.file_transfers.get((client, client_transfer_id))
+        if transfer_info is None:
+            print(f"Received data for unknown file transfer {client_transfer_id}")
+            return
+        if not self.chunk_in_offer(transfer_info, offset, offset + len(chunk)):
+            # The spool and cache buffers would grow to whatever offset the sender names
+            print(f"Disconnecting {self.nickname_of(client)}: file data outside the offered file")
+            self.remove_client(client)
+            return
+        self.metrics.file_bytes.inc(len(chunk))
+        
+        if transfer_info['relay'] is not None:
+            # Receivers pick the data up from the spool; the sender never waits for them
+            transfer_info['relay'].write(offset, chunk)
+        else:
+            # Forward chunk to the receivers under the server-wide transfer id
+            frame = protocol.encode_file_data(transfer_info['id'], offset, chunk)
+            if transfer_info['recipients'] is not None:
+                recipients = transfer_info['recipients']
+            else:
+                recipients = [session.sock for session in self.sessions.all()
+                              if session.sock != client and session.sock not in transfer_info['skipped']]
+            compress = not transfer_info['incompressible']
+            for recipient in recipients:
+                self.send_to(recipient, frame, compress=compress)
+            if compress and self.compressor.skipped(frame):
+                # Compressed or random data; trying every chunk would cost more than the relay itself
+                transfer_info['incompressible'] = True
+        
+        with transfer_info['lock']:
+            if transfer_info['cache'] is not None:
+                transfer_info['cache'].write(offset, chunk)
+            
+            # Update bytes received; chunks are forwarded before they are counted
+            transfer_info['bytes_received'] += len(chunk)
+            received = transfer_info['bytes_received']
+        
+        if transfer_info['relay'] is None:
+            self.throttle_sender(client, source)
+        
+        # Show progress; once a second at most, not once per chunk
+        progress = (received / transfer_info['expected']) * 100
+        self.log.log(('progress', transfer_info['id']),
+                     f"File transfer progress: {transfer_info['file_name']} {progress:.1f}%")
+        
+        # Check if transfer is complete
+        if received >= transfer_info['expected'] and received - len(chunk) < transfer_info['expected']:
+            self.complete_file_transfer(client, client_transfer_id)
+    
+    def chunk_in_offer(self, transfer_info, offset, end):
+        if transfer_info['ranges'] is None:
+            return end <= transfer_info['file_size']
+        return any(start <= offset and end <= start + length for start, length in transfer_info['ranges'])
+    
+    def set_codec(self, client, payload):
+        """Handle a COMPRESSION frame; returns False if the client picked a codec that wasn't offered"""
+        name = protocol.decode_json(payload).get('codec')
+        if name not in self.compression_codecs:
+            return False
+        self.codecs[client] = compression.CODECS[name]
+        return True
+    
+    def attach_data_channel(self, sock, payload):
+        """Returns the client a new upload connection belongs to, or None for an unknown token"""
+        token = protocol.decode_json(payload).get('token')
+        key = self.data_tokens.get(token)
+        session = self.sessions.get(key[0]) if key is not None else None
+        if session is None:
+            return None
+        session.data_channels.add(sock)
+        self.registered(sock)
+        return key[0]
+    
+    def handle_data_channel(self, sock, owner, reader):
+        activity = self.activity.get(sock) or limits.Activity(sock)
+        while True:
+            try:
+                frame = reader.read_frame()
+                if frame is None or frame[0] != protocol.FILE_DATA:
+                    break
+                activity.last_heard = time.monotonic()
+                metrics.PROFILER.run(self.handle_file_chunk, owner, frame[1], sock)
+                delay = self.rate_limit(owner, protocol.FILE_DATA, len(frame[1]), sock)
+                if delay:
+                    time.sleep(delay)
+            except OSError:
+                break  # Closed along with its client
+            except Exception as e:
+                print(f"Error on data connection of {self.nickname_of(owner)}: {e}")
+                break
+        session = self.sessions.get(owner)
+        if session is not None:
+            session.data_channels.discard(sock)
+        self.remove_client(sock)
+    
+    def complete_file_transfer(self, client, client_transfer_id):
+        transfer_info = self.file_transfers.pop((client, client_transfer_id))
+        session = self.sessions.get(client)
+        if session is not None:
+            session.transfers.pop(client_transfer_id, None)
+        self.data_tokens.pop(transfer_info['token'], None)
+        print(f"File transfer complete: {transfer_info['file_name']} ({transfer_info['bytes_received']} bytes)")
+        self.log.forget(('progress', transfer_info['id']))
+        elapsed = time.monotonic() - transfer_info['started']
+        self.metrics.file_transfers.inc()
+        self.metrics.file_transfer_seconds.observe(elapsed)
+        if elapsed > 0:
+            self.metrics.file_throughput.observe(transfer_info['bytes_received'] / elapsed)
+        complete_notice = protocol.encode_json(protocol.FILE_COMPLETE, {
+            'id': transfer_info['id'],
+            'name': transfer_info['file_name']
+        })
+        if transfer_info['cache'] is not None:
+            transfer_info['cache'].commit()
+        if transfer_info['relay'] is not None:
+            # Each receiver's stream sends its own completion notice once it has caught up
+            transfer_info['relay'].finish()
+            self.send_to(client, complete_notice)
+        elif transfer_info['recipients'] is not None:
+            for recipient in transfer_info['recipients'] + [client]:
+                self.send_to(recipient, complete_notice)
+        else:
+            self.broadcast_to_all(complete_notice)
+    
+    def abort_file_transfer(self, transfer_info):
+        self.data_tokens.pop(transfer_info['token'], None)
+        abort_notice = protocol.encode_json(protocol.FILE_ABORT, {
+            'id': transfer_info['id'],
+            'name': transfer_info['file_name']
+        })
+        if transfer_info['cache'] is not None:
+            transfer_info['cache'].discard()
+        if transfer_info['relay'] is not None:
+            # Streams tell their receivers once they have sent what was uploaded
+            transfer_info['relay'].abort()
+        elif transfer_info['recipients'] is not None:
+            for recipient in transfer_info['recipients']:
+                self.send_to(recipient, abort_notice)
+        else:
+            self.broadcast(abort_notice)
+    
+    def request_resend(self, client, nickname, resume):
+        """Send the chunks a client is still missing from the cache, or ask the original sender for them"""
+        entry = self.file_cache.get(resume['sha256']) if self.file_cache is not None else None
+        if entry is not None:
+            transfer_id = next(self.transfer_ids)
+            try:
+                cached = relay.CachedRelay(transfer_id, resume['name'], entry, resume['sender'])
+            except OSError:
+                cached = None
+            if cached is not None:
+                print(f"{nickname} is resuming {resume['name']} from the cache")
+                self.file_cache.record_saved(sum(length for _, length in resume['ranges']))
+                notice = {'id': transfer_id, 'name': resume['name'], 'size': entry.size, 'sender': resume['sender']}
+                notice.update(entry.manifest)
+                self.send_to(client, protocol.encode_json(protocol.FILE_INCOMING, notice))
+                client_outbox = self.outboxes.get(client)
+                if client_outbox is not None:
+                    cached.stream_to(client_outbox, resume['ranges'], self.codecs.get(client), self.compressor)
+                cached.finish()
+                return
+        
+        sender = self.client_by_nickname(resume['sender'])
+        if sender is None or sender == client:
+            self.send_to(client, protocol.encode_json(protocol.FILE_UNAVAILABLE, {
+                'name': resume['name'],
+                'sha256': resume['sha256']
+            }))
+            return
+        
+        print(f"{nickname} is resuming {resume['name']} from {resume['sender']}")
+        request_id = next(self.request_ids)
+        self.resend_requests[request_id] = (client, resume['name'])
+        self.send_to(sender, protocol.encode_json(protocol.FILE_RESEND, {
+            'request': request_id,
+            'sha256': resume['sha256'],
+            'ranges': resume['ranges']
+        }))
+    
+    def handle_frame(self, client, nickname, frame_type, payload):
+        session = self.sessions.get(client)
+        if session is not None:
+            session.frames_received += 1
+            session.bytes_received += len(payload)
+        self.metrics.frames_received.inc()
+        self.metrics.bytes_received.inc(len(payload))
+        
+        if frame_type == protocol.CHAT:
+            # Regular chat message, sent to everyone in the lobby
+            self.channel_message(client, nickname, sessions.LOBBY, payload.decode('utf-8'))
+        
+        elif frame_type == protocol.CHANNEL_MESSAGE:
+            message = protocol.decode_json(payload)
+            self.channel_message(client, nickname, message['channel'], message['text'])
+        
+        elif frame_type == protocol.PRIVATE_MESSAGE:
+            self.private_message(client, nickname, protocol.decode_json(payload))
+        
+        elif frame_type == protocol.JOIN:
+            self.join_channel(client, protocol.decode_json(payload)['channel'])
+        
+        elif frame_type == protocol.PART:
+            self.part_channel(client, protocol.decode_json(payload)['channel'])
+        
+        elif frame_type == protocol.CHANNELS:
+            self.send_to(client, protocol.encode_json(protocol.CHANNELS, {
+                'channels': self.channel_stats(),
+                'joined': sorted(session.channels) if session is not None else []
+            }))
+        
+        elif frame_type == protocol.WHO:
+            self.send_to(client, protocol.encode_json(protocol.WHO, {'users': self.who()}))
+        
+        elif frame_type == protocol.HISTORY:
+            self.send_history(client, protocol.decode_json(payload))
+        
+        elif frame_type == protocol.STATS:
+            self.send_to(client, protocol.encode_json(protocol.STATS, self.metrics.summary()))
+        
+        elif frame_type == protocol.QUIT:
+            # Leaving for good; nothing to keep for a resume
+            self.remove_client(client)
+        
+        elif frame_type == protocol.PONG:
+            pass  # Hearing it was the point
+        
+        elif frame_type == protocol.FILE_OFFER:
+            offer = protocol.decode_json(payload)
+            
+            print(f"File transfer initiated by {nickname}: {os.path.basename(offer['name'])} ({offer['size']} bytes)")
+            
+            # Set up the file transfer
+            self.handle_file_transfer(client, offer, nickname)
+        
+        elif frame_type == protocol.FILE_DATA:
+            self.handle_file_chunk(client, payload)
+        
+        elif frame_type == protocol.FILE_RESUME:
+            self.request_resend(client, nickname, protocol.decode_json(payload))
+        
+        elif frame_type == protocol.FILE_SKIP:
+            # The receiver already has this file
+            transfer_id = protocol.decode_json(payload)['id']
+            for transfer_info in list(self.file_transfers.values()):
+                if transfer_info['id'] == transfer_id:
+                    transfer_info['skipped'].add(client)
+            client_outbox = self.outboxes.get(client)
+            if client_outbox is not None:
+                client_outbox.cancel_stream(transfer_id)
+        
+        elif frame_type == protocol.FILE_UNAVAILABLE:
+            # The sender no longer has the file that was asked for
+            reply = protocol.decode_json(payload)
+            requester, name = self.resend_requests.pop(reply['request'], (None, None))
+            if requester is not None:
+                self.send_to(requester, protocol.encode_json(protocol.FILE_UNAVAILABLE, {
+                    'name': name,
+                    'sha256': reply['sha256']
+                }))
+        
+        else:
+            print(f"Ignoring unexpected frame type {frame_type} from {nickname}")
+    
+    def handle_client(self, client, nickname, reader):
+        activity = self.activity.get(client) or limits.Activity(client)  # A stand-in if it was closed already
+        while True:
+            try:
+                frame = reader.read_frame()
+                if frame is None:
+                    self.drop_client(client)
+                    break
+                
+                activity.last_heard = time.monotonic()
+                metrics.PROFILER.run(self.handle_frame, client, nickname, *frame)
+                delay = self.rate_limit(client, frame[0], len(frame[1]))
+                if delay:
+                    # Not reading holds the client back: its frames wait in the socket buffers
+                    time.sleep(delay)
+            
+            except OSError:
+                self.drop_client(client)
+                break
+            except Exception as e:
+                print(f"Error handling client {nickname}: {e}")
+                self.remove_client(client)
+                break
+    
+    def add_client(self, client, nickname):
+        """Register a client that finished the NICK handshake; returns False if it was turned away"""
+        nickname = nickname.strip()  # Stripped as the GUI does, so a blank nickname can't register
+        token = secrets.token_urlsafe(16) if self.session_grace else None
+        backlog = sessions.Backlog(self.session_backlog_bytes, self.session_backlog_frames)
+        session = sessions.Session(client, nickname, self.outboxes.get(client), token, backlog)
+        if not nickname:
+            refusal = "Nickname can't be empty"
+        elif (self.bus is not None and self.bus.has_nickname(nickname)) or not self.sessions.add(session):
+            refusal = f"Nickname {nickname} is already in use"
+        else:
+            refusal = None
+        if refusal is not None:
+            try:
+                # Written directly: closing the outbox below would discard a queued frame
+                client.send(protocol.encode_text(protocol.CHAT, refusal))
+            except OSError:
+                pass
+            self.remove_client(client)
+            return False
+        
+        self.metrics.connections.inc()
+        self.log.log('nickname', f"Nickname of the client is {nickname}")
+        self.registered(client)
+        if self.message_rate:
+            session.message_bucket = limits.TokenBucket(self.message_rate, self.message_burst)
+        if self.byte_rate:
+            session.byte_bucket = limits.TokenBucket(self.byte_rate, self.byte_burst)
+        self.sessions.join(session, sessions.LOBBY)
+        if self.bus is not None:
+            self.bus.joined(nickname)
+            self.bus.subscribe(sessions.LOBBY)
+        self.broadcast_to_channel(sessions.LOBBY, protocol.encode_text(protocol.CHAT, f"{nickname} joined the chat!"),
+                                  droppable=True)
+        self.send_to(client, protocol.encode_text(protocol.CHAT, "Connected to the server!"))
+        if token is not None:
+            self.send_to(client, protocol.encode_json(protocol.SESSION, {'token': token, 'grace': self.session_grace}))
+        self.start_relays(client)
+        return True
+    
+    def start_relays(self, client):
+        # Late joiners still get files that are being spooled
+        for transfer_info in list(self.file_transfers.values()):
+            if transfer_info['relay'] is not None:
+                self.start_relay(client, transfer_info)
+    
+    def resume_session(self, client, request):
+        """Handle a RESUME frame: move the client's session to this connection and replay what it missed.
+
+        An unknown or expired token registers the nickname afresh. Returns False if the client was turned away.
+        """
+        session = self.sessions.find_token(request.get('token'))
+        if session is not None and session.dropped_at is None:
+            # The old connection broke without the server noticing yet
+            self.drop_client(session.sock)
+        session = self.sessions.resume(request.get('token'), client)
+        if session is None:
+            nickname = request.get('nickname')
+            if not isinstance(nickname, str):
+                raise protocol.ProtocolError("RESUME of an unknown session without a nickname")
+            return self.add_client(client, nickname)
+        
+        session.outbox = self.outboxes.get(client)
+        self.registered(client)
+        frames, lost = session.backlog.take()
+        self.log.log('connect', f"{session.nickname} resumed its session, {len(frames)} frames replayed")
+        self.metrics.sessions_resumed.inc()
+        self.metrics.frames_replayed.inc(len(frames))
+        for frame in frames:
+            self.send_to(client, frame)
+        self.send_to(client, protocol.encode_json(protocol.SESSION, {
+            'token': session.token,
+            'grace': self.session_grace,
+            'resumed': True,
+            'replayed': len(frames),
+            'lost': lost
+        }))
+        self.start_relays(client)
+        return True
+    
+    def drop_client(self, client):
+        """The connection to a client broke: keep its session for a resume if it has a token, else remove it"""
+        self.activity.pop(client, None)
+        session = self.sessions.get(client)
+        if session is None or session.token is None:
+            self.remove_client(client)
+            return
+        if not self.sessions.detach(session):
+            return  # Already waiting for a resume
+        
+        self.log.log('connect', f"Lost the connection to {session.nickname}, keeping the session for "
+                                f"{self.session_grace:g} s")
+        self.codecs.pop(client, None)
+        self.end_uploads(client, session)
+        client_outbox = self.outboxes.pop(client, None)
+        if client_outbox is not None:
+            # Frames that never went out are replayed first; held frames follow them
+            session.backlog.add(client_outbox.take_unsent(), front=True)
+            self.close_socket(client)
+        self.call_later(self.session_grace, self.expire_session, session, session.dropped_at)
+    
+    def expire_session(self, session, dropped_at):
+        if self.sessions.expire(session, dropped_at):
+            print(f"Session of {session.nickname} expired")
+            self.metrics.sessions_expired.inc()
+            self.remove_client(session.sock)
+    
+    def remove_client(self, client):
+        self.activity.pop(client, None)
+        # Only the caller that takes the session out of the registry cleans up after it
+        session = self.sessions.remove(client)
+        self.codecs.pop(client, None)
+        if session is not None:
+            nickname = session.nickname
+            self.metrics.disconnections.inc()
+            if self.bus is not None:
+                self.bus.left(nickname, session.channels)
+            self.end_uploads(client, session)
+            # Everyone who shared a channel with the client hears that it left
+            self.broadcast_to_channels(session.channels, protocol.encode_text(protocol.CHAT, f"{nickname} left the chat!"),
+                                       droppable=True)
+        client_outbox = self.outboxes.pop(client, None)
+        if client_outbox is not None:
+            client_outbox.close()
+            self.close_socket(client)
+    
+    def end_uploads(self, client, session):
+        # Uploads and resend requests go with the connection they came in on
+        for client_transfer_id, transfer_info in list(session.transfers.items()):
+            print(f"Connection lost during file transfer from {session.nickname}")
+            self.file_transfers.pop((client, client_transfer_id), None)
+            self.abort_file_transfer(transfer_info)
+        session.transfers.clear()
+        for request_id in [request_id for request_id, (requester, _) in self.resend_requests.items()
+                           if requester is client]:
+            del self.resend_requests[request_id]
+        for sock in list(session.data_channels):
+            self.remove_client(sock)
+    
+    def close_socket(self, client):
+        try:
+            # Wakes up the handler thread if it is blocked in recv
+            client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.close()
+    
+    def receive(self):
+        self.start_sweeper()
+        while True:
+            try:
+                client, address = self.server.accept()
+            except Exception as e:
+                print(f"Error in receive: {e}")
+                break
+            
+            if self.at_capacity():
+                self.refuse(client)
+                continue
+            self.watch(client)
+            # The handshake runs on the client's own thread, so a client that never sends its
+            # nickname or never finishes TLS holds up nobody else's connection
+            thread = threading.Thread(target=self.admit, args=(client, address))
+            thread.daemon = True
+            thread.start()
+    
+    def admit(self, client, address):
+        """The TLS and NICK handshakes, each read bounded by --handshake-timeout, then the client's handler"""
+        try:
+            client.settimeout(self.handshake_timeout or None)
+            if self.tls_context is not None:
+                raw, client = client, self.tls_context.wrap_socket(client, server_side=True)
+                activity = self.activity.pop(raw, None)
+                if activity is None:
+                    raise TimeoutError("timed out")  # The sweeper gave up on it meanwhile
+                activity.sock = client
+                self.activity[client] = activity
+                self.tls_established(client)
+            handler = self.handshake(client, address)
+        except (OSError, ValueError, TypeError, AttributeError, KeyError, protocol.ProtocolError) as e:
+            # A client that sends garbage while connecting costs only its own connection
+            print(f"Handshake failed with {address}: {e}")
+            self.remove_client(client)
+            client.close()  # Not registered yet if the TLS handshake failed
+            return
+        if handler is not None:
+            handler()
+    
+    def handshake(self, client, address):
+        """Register a new connection; returns the function that serves it from then on, or None if it was turned away"""
+        self.log.log('connect', f"Connected with {address}")
+        
+        self.configure_client(client)
+        self.outboxes[client] = self.create_outbox(client)
+        self.send_to(client, self.nick_request)
+        reader = protocol.FrameReader(client, codecs=compression.DECODERS)
+        frame = reader.read_frame()
+        if frame is not None and frame[0] == protocol.COMPRESSION:
+            if not self.set_codec(client, frame[1]):
+                self.remove_client(client)
+                return None
+            frame = reader.read_frame()
+        client.settimeout(None)  # Registered or turned away below; the idle timeout takes over
+        if frame is not None and frame[0] == protocol.DATA_CHANNEL:
+            # An extra connection a client opened to upload part of a file
+            owner = self.attach_data_channel(client, frame[1])
+            if owner is None:
+                self.remove_client(client)
+                return None
+            return lambda: self.handle_data_channel(client, owner, reader)
+        if frame is not None and frame[0] == protocol.RESUME:
+            if not self.resume_session(client, protocol.decode_json(frame[1])):
+                return None
+            nickname = self.nickname_of(client)
+        elif frame is None or frame[0] != protocol.NICK:
+            self.remove_client(client)
+            return None
+        else:
+            if not self.add_client(client, frame[1].decode('utf-8')):
+                return None
+            nickname = self.nickname_of(client)
+        
+        return lambda: self.handle_client(client, nickname, reader)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5555)
+    parser.add_argument('--engine', choices=['threads', 'eventloop'], default='threads',
+                        help="threads: one handler thread per client; eventloop: all clients on one selectors loop")
+    parser.add_argument('--queue-bytes', type=int, default=1024 * 1024,
+                        help="per-client send queue limit in bytes")
+    parser.add_argument('--queue-frames', type=int, default=1000,
+                        help="per-client send queue limit in frames")
+    parser.add_argument('--slow-consumer-policy', choices=outbox.POLICIES, default=outbox.DROP_OLDEST,
+                        help="what to do with chat lines for a client whose queue is full")
+    parser.add_argument('--file-send-timeout', type=float, default=30.0,
+                        help="seconds a file sender waits for a full queue before that receiver is dropped")
+    parser.add_argument('--file-relay', choices=['broadcast', 'spool'], default='broadcast',
+                        help="broadcast: forward file chunks as they arrive; spool: upload to a temp file "
+                             "and stream it to each receiver with sendfile")
+    parser.add_argument('--spool-memory', type=int, default=1024 * 1024,
+                        help="uploads up to this many bytes are spooled in memory instead of on disk")
+    parser.add_argument('--cache-dir', default=None,
+                        help="directory for the relayed-file cache; a temporary directory by default")
+    parser.add_argument('--cache-disk', type=int, default=1024 * 1024 * 1024,
+                        help="bytes of relayed files kept in the cache directory")
+    parser.add_argument('--cache-memory', type=int, default=64 * 1024 * 1024,
+                        help="bytes of small relayed files kept in memory; 0 for both limits disables the cache")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker processes sharing the port with SO_REUSEPORT, joined by a message bus")
+    parser.add_argument('--cluster-backend', default='tcp', choices=sorted(bus.BACKENDS),
+                        help="how cluster nodes reach each other")
+    parser.add_argument('--cluster-listen', default=None, metavar='HOST:PORT',
+                        help="address other cluster nodes connect to")
+    parser.add_argument('--peers', nargs='*', default=[], metavar='HOST:PORT',
+                        help="cluster addresses of the other nodes")
+    parser.add_argument('--node-name', default=None,
+                        help="name of this node in the cluster; the cluster address by default")
+    parser.add_argument('--batch-delay', type=int, default=0, metavar='MICROSECONDS',
+                        help="hold outgoing frames this long and write them with one sendmsg; 0 disables batching")
+    parser.add_argument('--batch-bytes', type=int, default=64 * 1024,
+                        help="write a batch as soon as this many bytes are queued for a client")
+    parser.add_argument('--compression', nargs='*', choices=list(compression.CODECS), default=None,
+                        help="codecs offered to clients, every installed one by default; none to turn compression off")
+    parser.add_argument('--compress-threshold', action='append', default=[], metavar='GROUP=BYTES',
+                        help="smallest text, control or file payload to compress, or 'off'; e.g. text=128")
+    parser.add_argument('--history-dir', default=None,
+                        help="directory for the channel history log; without it history is kept in memory only")
+    parser.add_argument('--history-ring', type=int, default=1000,
+                        help="most recent channel lines kept in memory")
+    parser.add_argument('--history-segment-bytes', type=int, default=64 * 1024 * 1024,
+                        help="size at which the history log starts a new segment file")
+    parser.add_argument('--history-retention-bytes', type=int, default=1024 * 1024 * 1024,
+                        help="history kept on disk; the oldest segments are deleted past it")
+    parser.add_argument('--history-fsync-interval', type=float, default=1.0,
+                        help="seconds between fsyncs of the history log")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve Prometheus metrics, stats, profiles and tracemalloc snapshots over HTTP on this port; "
+                             "worker N uses the port plus N")
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help="address the metrics endpoint listens on")
+    parser.add_argument('--log-interval', type=float, default=1.0,
+                        help="seconds between log lines of the same kind (chat lines, progress, connections); 0 logs all")
+    parser.add_argument('--tls-cert', default=None,
+                        help="PEM certificate chain; serves clients over TLS instead of plain TCP")
+    parser.add_argument('--tls-key', default=None,
+                        help="PEM private key, if it isn't in the --tls-cert file")
+    parser.add_argument('--session-grace', type=float, default=30.0,
+                        help="seconds a dropped client's session is kept for it to resume; 0 ends it at once")
+    parser.add_argument('--session-backlog-bytes', type=int, default=1024 * 1024,
+                        help="bytes of frames kept for a dropped client to replay when it resumes")
+    parser.add_argument('--session-backlog-frames', type=int, default=1000,
+                        help="frames kept for a dropped client to replay when it resumes")
+    parser.add_argument('--listen-backlog', type=int, default=128,
+                        help="connections the kernel queues until the server accepts them")
+    parser.add_argument('--max-connections', type=int, default=0,
+                        help="open connections per server process, handshakes and uploads included; "
+                             "more are refused at once. 0 for no cap")
+    parser.add_argument('--handshake-timeout', type=float, default=10.0,
+                        help="seconds a new connection has to send its nickname; 0 waits forever")
+    parser.add_argument('--heartbeat-interval', type=float, default=30.0,
+                        help="ping a client that has been quiet this many seconds; 0 sends no pings")
+    parser.add_argument('--idle-timeout', type=float, default=90.0,
+                        help="drop a connection that has been quiet this many seconds; 0 keeps it")
+    parser.add_argument('--rate-messages', type=float, default=0,
+                        help="frames a second each client may send before the server stops reading from it; "
+                             "0 for no limit")
+    parser.add_argument('--burst-messages', type=float, default=0,
+                        help="frames a client may send at once after being quiet; --rate-messages by default")
+    parser.add_argument('--rate-bytes', type=float, default=0,
+                        help="payload bytes a second each client may send, uploads included; 0 for no limit")
+    parser.add_argument('--burst-bytes', type=float, default=0,
+                        help="payload bytes a client may send at once after being quiet; --rate-bytes by default")
+    args = parser.parse_args()
+    try:
+        thresholds = compression.parse_thresholds(args.compress_threshold)
+    except ValueError as e:
+        parser.error(str(e))
+    clustered = args.cluster_listen is not None or bool(args.peers)
+    if clustered and args.workers > 1:
+        parser.error("--workers can't be combined with clustering yet; run one node per worker instead")
+    
+    options = {
+        'queue_bytes': args.queue_bytes,
+        'queue_frames': args.queue_frames,
+        'slow_consumer_policy': args.slow_consumer_policy,
+        'file_send_timeout': args.file_send_timeout,
+        'file_relay': args.file_relay,
+        'spool_memory': args.spool_memory,
+        'cache_dir': args.cache_dir,
+        'cache_disk': args.cache_disk,
+        'cache_memory': args.cache_memory,
+        'batch_delay': args.batch_delay / 1e6,
+        'batch_bytes': args.batch_bytes,
+        'compression_codecs': args.compression,
+        'compress_thresholds': thresholds,
+        'history_dir': args.history_dir,
+        'history_ring': args.history_ring,
+        'history_segment_bytes': args.history_segment_bytes,
+        'history_retention_bytes': args.history_retention_bytes,
+        'history_fsync_interval': args.history_fsync_interval,
+        'metrics_host': args.metrics_host,
+        'log_interval': args.log_interval,
+        # Made before the workers fork, so they share the session ticket key and resume each other's sessions
+        'tls_context': tls.server_context(args.tls_cert, args.tls_key) if args.tls_cert else None,
+        'session_grace': args.session_grace,
+        'session_backlog_bytes': args.session_backlog_bytes,
+        'session_backlog_frames': args.session_backlog_frames,
+        'listen_backlog': args.listen_backlog,
+        'max_connections': args.max_connections,
+        'handshake_timeout': args.handshake_timeout,
+        'heartbeat_interval': args.heartbeat_interval,
+        'idle_timeout': args.idle_timeout,
+        'message_rate': args.rate_messages,
+        'message_burst': args.burst_messages,
+        'byte_rate': args.rate_bytes,
+        'byte_burst': args.burst_bytes
+    }
+    metrics.install_signal_handlers()
+    
+    def create_server(server_bus=None):
+        metrics_port = args.metrics_port
+        if metrics_port is not None and args.workers > 1:
+            metrics_port += int(server_bus.name.rsplit('-', 1)[1])
+        if args.engine == 'eventloop':
+            from event_server import EventLoopServer
+            return EventLoopServer(args.host, args.port, bus=server_bus, reuse_port=args.workers > 1,
+                                   metrics_port=metrics_port, **options)
+        return Server(args.host, args.port, bus=server_bus, reuse_port=args.workers > 1, metrics_port=metrics_port,
+                      **options)
+    
+    if args.workers > 1:
+        workers = bus.start_workers(args.workers, create_server)
+        print(f"Server started on {args.host}:{args.port} with {args.workers} workers")
+        bus.wait_for_workers(workers)
+    elif clustered:
+        cluster = bus.create_backend(args.cluster_backend, name=args.node_name,
+                                     listen=args.cluster_listen, peers=args.peers)
+        server = create_server(cluster)
+        cluster.start(server.deliver_remote, server.local_presence)
+        server.receive()
+    else:
+        create_server().receive()
\ No newline at end of file
@@ -0,0 +1,265 @@
+"""Optional per-frame compression.
+
+The server lists the codecs it offers in its NICK request. A client that
+wants compression answers with a COMPRESSION frame naming one of them before
+it sends its nickname; from then on the server may send it COMPRESSED frames,
+and the client may send them too. A COMPRESSED frame carries the codec id,
+the original frame type and the compressed payload, so a decoder doesn't need
+to know what was negotiated.
+
+Only frame types with a threshold are compressed, only from that payload size
+up, and only when it saves at least MIN_SAVING. zlib is always available;
+zstd and lz4 are used when the zstandard and lz4 packages are installed.
+"""
+import collections
+import threading
+import time
+import zlib
+
+import protocol
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Smallest payload worth compressing, per frame type; other types are sent as they are
+THRESHOLDS = {
+    protocol.CHAT: 256,
+    protocol.CHANNEL_MESSAGE: 256,
+    protocol.PRIVATE_MESSAGE: 256,
+    protocol.FILE_OFFER: 1024,
+    protocol.FILE_INCOMING: 1024,
+    protocol.FILE_RESUME: 1024,
+    protocol.CHANNELS: 1024,
+    protocol.WHO: 1024,
+    protocol.FILE_DATA: 4096,
+}
+
+# Names for --compress-threshold
+THRESHOLD_GROUPS = {
+    'text': (protocol.CHAT, protocol.CHANNEL_MESSAGE, protocol.PRIVATE_MESSAGE),
+    'control': (protocol.FILE_OFFER, protocol.FILE_INCOMING, protocol.FILE_RESUME, protocol.CHANNELS, protocol.WHO),
+    'file': (protocol.FILE_DATA,),
+}
+
+MIN_SAVING = 0.1  # Send the original unless compressing saves at least this fraction
+
+
+class Codec:
+    """One compression algorithm, with counters for everything it has done in this process"""
+
+    id = 0
+    name = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.skipped = 0  # Frames that did not compress well enough and went out as they were
+        self.compress_seconds = 0.0
+        self.expanded = 0
+        self.expand_seconds = 0.0
+
+    def compress(self, data):
+        started = time.thread_time()
+        result = self.compress_bytes(data)
+        elapsed = time.thread_time() - started
+        with self.lock:
+            self.frames += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(result)
+            self.compress_seconds += elapsed
+        return result
+
+    def decompress(self, data, max_size):
+        started = time.thread_time()
+        result = self.decompress_bytes(data, max_size)
+        elapsed = time.thread_time() - started
+        with self.lock:
+            self.expanded += 1
+            self.expand_seconds += elapsed
+        return result
+
+    def compress_bytes(self, data):
+        raise NotImplementedError
+
+    def decompress_bytes(self, data, max_size):
+        raise NotImplementedError
+
+    def stats(self):
+        with self.lock:
+            return {
+                'frames': self.frames,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+                'skipped': self.skipped,
+                'compress_ms': round(self.compress_seconds * 1000, 3),
+                'compress_mb_per_s': round(self.bytes_in / self.compress_seconds / 1e6, 1)
+                if self.compress_seconds else None,
+                'decompressed': self.expanded,
+                'decompress_ms': round(self.expand_seconds * 1000, 3)
+            }
+
+
+class ZlibCodec(Codec):
+    id = 1
+    name = 'zlib'
+
+    def __init__(self, level=1):
+        # Level 1 keeps up with file relays; higher levels save a little more at several times the CPU
+        super().__init__()
+        self.level = level
+
+    def compress_bytes(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress_bytes(self, data, max_size):
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise protocol.ProtocolError(f"Compressed frame expands past {max_size} bytes")
+        return result
+
+
+class ZstdCodec(Codec):
+    id = 2
+    name = 'zstd'
+
+    def __init__(self, level=3):
+        super().__init__()
+        self.level = level
+        self.local = threading.local()  # zstandard contexts can't be shared between threads
+
+    def contexts(self):
+        if not hasattr(self.local, 'compressor'):
+            self.local.compressor = zstandard.ZstdCompressor(level=self.level)
+            self.local.decompressor = zstandard.ZstdDecompressor()
+        return self.local.compressor, self.local.decompressor
+
+    def compress_bytes(self, data):
+        return self.contexts()[0].compress(data)
+
+    def decompress_bytes(self, data, max_size):
+        size = zstandard.frame_content_size(data)
+        if size > max_size:
+            raise protocol.ProtocolError(f"Compressed frame expands past {max_size} bytes")
+        return self.contexts()[1].decompress(data, max_output_size=max_size)
+
+
+class Lz4Codec(Codec):
+    id = 3
+    name = 'lz4'
+
+    def compress_bytes(self, data):
+        return lz4_frame.compress(data)
+
+    def decompress_bytes(self, data, max_size):
+        decompressor = lz4_frame.LZ4FrameDecompressor()
+        result = decompressor.decompress(data, max_length=max_size)
+        if not decompressor.eof:
+            raise protocol.ProtocolError(f"Compressed frame expands past {max_size} bytes")
+        return result
+
+
+# Installed codecs, best first
+CODECS = {}
+if zstandard is not None:
+    CODECS['zstd'] = ZstdCodec()
+if lz4_frame is not None:
+    CODECS['lz4'] = Lz4Codec()
+CODECS['zlib'] = ZlibCodec()
+
+# Codec id -> codec, for protocol.FrameDecoder
+DECODERS = {codec.id: codec for codec in CODECS.values()}
+
+
+def choose(offered, preference='auto'):
+    """The codec to use out of the names a server offered, or None"""
+    if preference == 'off':
+        return None
+    for name in CODECS if preference == 'auto' else [preference]:
+        if name in offered and name in CODECS:
+            return CODECS[name]
+    return None
+
+
+def parse_thresholds(specs):
+    """Thresholds with 'group=bytes' overrides applied, e.g. ['text=128', 'file=off']"""
+    thresholds = dict(THRESHOLDS)
+    for spec in specs or ():
+        group, _, value = spec.partition('=')
+        if group not in THRESHOLD_GROUPS:
+            raise ValueError(f"Unknown frame group {group!r}; use one of {', '.join(THRESHOLD_GROUPS)}")
+        for frame_type in THRESHOLD_GROUPS[group]:
+            if value == 'off':
+                thresholds.pop(frame_type, None)
+            else:
+                thresholds[frame_type] = int(value)
+    return thresholds
+
+
+def stats():
+    return {name: codec.stats() for name, codec in CODECS.items()}
+
+
+class FrameCompressor:
+    """Compresses encoded frames with the thresholds of one server or client.
+
+    Broadcasts put the same frame object in every receiver's queue, so the
+    last few frames are remembered with their compressed forms: each frame is
+    compressed at most once per codec however many receivers it has.
+    """
+
+    def __init__(self, thresholds=None, memo_size=16):
+        self.thresholds = THRESHOLDS if thresholds is None else thresholds
+        self.memo = collections.OrderedDict()  # id(frame) -> (frame, {codec name: frame to send})
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+
+    def wants(self, frame):
+        frame_type, length = protocol.HEADER.unpack_from(frame)
+        threshold = self.thresholds.get(frame_type)
+        return threshold is not None and length >= threshold
+
+    def compress(self, frame, codec):
+        """frame as a COMPRESSED frame if that is worth it, else frame itself"""
+        if not self.wants(frame):
+            return frame
+        frame_type, length = protocol.HEADER.unpack_from(frame)
+        body = codec.compress(memoryview(frame)[protocol.HEADER.size:])
+        if len(body) + 2 > length * (1 - MIN_SAVING):
+            with codec.lock:
+                codec.skipped += 1
+            return frame
+        return protocol.HEADER.pack(protocol.COMPRESSED, len(body) + 2) + bytes((codec.id, frame_type)) + body
+
+    def skipped(self, frame):
+        """True if encode() sent frame as it was to some receiver because it did not compress well enough"""
+        with self.lock:
+            entry = self.memo.get(id(frame))
+        return entry is not None and entry[0] is frame and any(result is frame for result in entry[1].values())
+
+    def encode(self, frame, codec):
+        """compress(), reusing the result if this frame was compressed for another receiver"""
+        if not self.wants(frame):
+            return frame
+        key = id(frame)
+        with self.lock:
+            entry = self.memo.get(key)
+            if entry is None or entry[0] is not frame:
+                # The memo holds the frame, so its id can't be reused while it is in there
+                entry = self.memo[key] = (frame, {})
+                if len(self.memo) > self.memo_size:
+                    self.memo.popitem(last=False)
+            result = entry[1].get(codec.name)
+        if result is None:
+            result = entry[1][codec.name] = self.compress(frame, codec)
+        return result
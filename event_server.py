@@ -0,0 +1,413 @@
+import collections
+import heapq
+import itertools
+import selectors
+import socket
+import time
+
+import compression
+import metrics
+import outbox
+import protocol
+import tls
+from chat_server import Server
+from relay import RelayStream
+
+
+class Connection:
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.nickname = None  # Set once the NICK handshake completes
+        self.data_owner = None  # Client socket this connection uploads file ranges for
+        self.decoder = protocol.FrameDecoder(codecs=compression.DECODERS)
+        self.outbox = None
+        self.events = 0  # Selector events currently registered
+        self.paused = False  # Not reading: a file receiver's queue is full
+        self.rate_limited = False  # Not reading: the client went over its message or byte rate
+        self.pause_deadline = 0
+        self.blocked_by = set()  # Receivers this sender is waiting on
+        self.waiting_senders = set()  # Senders waiting for this receiver to drain
+        self.tls = sock if isinstance(sock, tls.TLSSocket) else None
+        self.tls_established = False  # Handshake finished and counted
+        self.broken = False  # A write failed; the client may still resume its session
+        self.activity = None  # limits.Activity the sweeper checks
+        self.closed = False
+
+
+class LoopOutbox(outbox.Outbox):
+    def __init__(self, server, client, **options):
+        super().__init__(**options)
+        self.server = server
+        self.client = client
+
+    def wake(self):
+        # New upload data for a queued stream: write it out if the socket has room
+        conn = self.server.connections.get(self.client)
+        if conn is not None and not conn.closed:
+            self.server.flush(conn)
+
+
+class EventLoopServer(Server):
+    """Serves every client from a single selectors loop instead of a thread per client"""
+
+    def __init__(self, host='0.0.0.0', port=5555, **options):
+        super().__init__(host, port, **options)
+        self.server.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}  # socket -> Connection
+        self.recv_buffer = bytearray(65536)  # Shared by every connection, the loop reads one at a time
+        self.recv_view = memoryview(self.recv_buffer)
+        self.closing = []  # Connections that failed mid-broadcast, closed after the current event
+        self.paused_senders = set()
+        self.batches = {}  # Connection -> time its held frames must be written by, in deadline order
+        self.timers = []  # Heap of (deadline, sequence number, callback, args) for call_later
+        self.timer_ids = itertools.count()
+        # Other threads (the worker bus) hand work to the loop through call_soon
+        self.pending_calls = collections.deque()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+
+    def create_outbox(self, client):
+        return LoopOutbox(self, client, **self.outbox_options)
+
+    def call_later(self, delay, callback, *args):
+        # Runs on the loop thread like everything else that touches the connections
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timer_ids), callback, args))
+
+    def run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, callback, args = heapq.heappop(self.timers)
+            callback(*args)
+
+    def call_soon(self, callback, *args):
+        """Run callback on the loop thread; safe to call from any thread"""
+        self.pending_calls.append((callback, args))
+        try:
+            self.wakeup_send.send(b'\0')
+        except BlockingIOError:
+            pass  # Plenty of wakeups are pending already
+
+    def run_pending_calls(self):
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.pending_calls:
+            callback, args = self.pending_calls.popleft()
+            callback(*args)
+
+    def deliver_remote(self, event_type, meta, frame):
+        # Called on a bus thread; the connections belong to the loop
+        self.call_soon(super().deliver_remote, event_type, meta, frame)
+
+    def send_to(self, client, message, droppable=False, compress=True):
+        conn = self.connections.get(client)
+        if conn is None or conn.closed:
+            self.hold(client, message)
+            return
+        codec = self.codecs.get(client)
+        if codec is not None and compress:
+            message = self.compressor.encode(message, codec)
+        was_idle = not conn.outbox.frames
+        if not conn.outbox.put(message, droppable):
+            print(f"Disconnecting slow client {conn.nickname}: send queue full")
+            self.closing.append(conn)
+        elif self.batch_delay:
+            # Written together with whatever else is queued by the deadline, or once the batch is full
+            if conn.outbox.bytes >= self.batch_bytes:
+                self.flush(conn)
+            elif conn not in self.batches:
+                self.batches[conn] = time.monotonic() + self.batch_delay
+        elif was_idle:
+            # Fast path: most sends fit in the socket buffer straight away
+            self.flush(conn)
+
+    def update_interest(self, conn):
+        events = 0
+        if not conn.paused and not conn.rate_limited:
+            events |= selectors.EVENT_READ
+        if conn.tls is None:
+            if conn.outbox.ready():
+                events |= selectors.EVENT_WRITE
+        elif conn.tls.wants_write() or (conn.tls.handshake_done and conn.outbox.ready()):
+            # Frames queued during the handshake wait for it; only the client can move it on
+            events |= selectors.EVENT_WRITE
+        if events == conn.events:
+            return
+        if not conn.events:
+            self.selector.register(conn.sock, events, conn)
+        elif not events:
+            # Paused with nothing left to write
+            self.selector.unregister(conn.sock)
+        else:
+            self.selector.modify(conn.sock, events, conn)
+        conn.events = events
+
+    def flush(self, conn):
+        client_outbox = conn.outbox
+        try:
+            if conn.tls is not None:
+                conn.tls.flush()  # Encrypted bytes left over from earlier writes and reads
+            while client_outbox.ready():
+                data = client_outbox.frames[0][0]
+                if isinstance(data, RelayStream):
+                    client_outbox.stream_sent(data, data.send_some(conn.sock))
+                    continue
+                if self.batch_delay:
+                    buffers = client_outbox.batch()
+                    sent = conn.sock.sendmsg(buffers)
+                    client_outbox.consume(sent)
+                    if sent < sum(len(buffer) for buffer in buffers):
+                        break
+                    continue
+                sent = conn.sock.send(memoryview(data)[client_outbox.offset:])
+                client_outbox.writes += 1
+                client_outbox.offset += sent
+                if client_outbox.offset < len(data):
+                    break
+                client_outbox.pop()
+        except BlockingIOError:
+            pass
+        except OSError:
+            conn.broken = True
+            self.closing.append(conn)
+            return
+        self.update_interest(conn)
+
+    def throttle_sender(self, client, source=None):
+        # Stop reading from a file sender (or the data connection the chunk came in on)
+        # while any receiver's queue is full
+        sender = self.connections[source or client]
+        for conn in self.connections.values():
+            if conn.sock is not client and conn.nickname is not None and not conn.outbox.has_room():
+                sender.blocked_by.add(conn)
+                conn.waiting_senders.add(sender)
+        if sender.blocked_by and not sender.paused:
+            sender.paused = True
+            sender.pause_deadline = time.monotonic() + self.file_send_timeout
+            self.paused_senders.add(sender)
+            self.update_interest(sender)
+
+    def release_senders(self, conn, force=False):
+        if not force and not conn.outbox.has_room():
+            return
+        # Taken first: a released sender that reads more may have to wait for this receiver again
+        waiting, conn.waiting_senders = conn.waiting_senders, set()
+        for sender in waiting:
+            sender.blocked_by.discard(conn)
+            if not sender.blocked_by and not sender.closed:
+                sender.paused = False
+                self.paused_senders.discard(sender)
+                self.update_interest(sender)
+                self.read_buffered(sender)
+
+    def read_buffered(self, conn):
+        # Frames that were already buffered when reading stopped
+        self.process_frames(conn)
+        if conn.tls is not None and conn.tls.pending() and not (conn.closed or conn.paused or conn.rate_limited):
+            self.handle_readable(conn)
+
+    def limit_rate(self, conn, delay):
+        # Stop reading from a client over its rate until its bucket is out of debt
+        conn.rate_limited = True
+        self.update_interest(conn)
+        self.call_later(delay, self.end_rate_limit, conn)
+
+    def end_rate_limit(self, conn):
+        conn.rate_limited = False
+        if not conn.closed:
+            self.update_interest(conn)
+            self.read_buffered(conn)
+
+    def drop_stalled_receivers(self):
+        now = time.monotonic()
+        for sender in list(self.paused_senders):
+            if sender.pause_deadline <= now:
+                for conn in list(sender.blocked_by):
+                    print(f"Disconnecting slow client {conn.nickname}: file data not drained")
+                    self.remove_client(conn.sock)
+
+    def accept_clients(self):
+        while True:
+            try:
+                client, address = self.server.accept()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # e.g. out of file descriptors; keep serving the clients we have
+                print(f"Error in receive: {e}")
+                return
+
+            if self.at_capacity():
+                self.refuse(client)
+                continue
+            self.log.log('connect', f"Connected with {address}")
+            client.setblocking(False)
+            self.configure_client(client)
+            if self.tls_context is not None:
+                client = tls.TLSSocket(client, self.tls_context)
+            conn = Connection(client, address)
+            conn.activity = self.watch(client)
+            conn.outbox = self.outboxes[client] = self.create_outbox(client)
+            self.connections[client] = conn
+            self.update_interest(conn)
+            self.send_to(client, self.nick_request)
+
+    def handle_readable(self, conn):
+        client = conn.sock
+        conn.activity.last_heard = time.monotonic()
+        while True:
+            try:
+                received = client.recv_into(self.recv_buffer)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                print(f"Error handling client {conn.nickname}: {e}")
+                self.drop_client(client)
+                return
+            if not received:
+                self.drop_client(client)
+                return
+
+            conn.decoder.feed(self.recv_view[:received])
+            self.process_frames(conn)
+            # TLS can hold decrypted bytes beyond what one read took; the selector won't report those
+            if conn.tls is None or conn.closed or conn.paused or conn.rate_limited or not conn.tls.pending():
+                break
+        if conn.tls is not None and not conn.closed:
+            if conn.tls.handshake_done and not conn.tls_established:
+                conn.tls_established = True
+                self.tls_established(conn.tls)
+            # Writes what waited for the handshake, and anything reading produced
+            self.flush(conn)
+
+    def process_frames(self, conn):
+        client = conn.sock
+        try:
+            while not conn.paused and not conn.rate_limited and not conn.closed:
+                frame = conn.decoder.next_frame()
+                if frame is None:
+                    return
+                frame_type, payload = frame
+                if conn.nickname is not None:
+                    self.handle_frame(client, conn.nickname, frame_type, payload)
+                    delay = self.rate_limit(client, frame_type, len(payload))
+                    if delay and not conn.closed:
+                        self.limit_rate(conn, delay)
+                elif conn.data_owner is not None and frame_type == protocol.FILE_DATA:
+                    self.handle_file_chunk(conn.data_owner, payload, client)
+                    delay = self.rate_limit(conn.data_owner, frame_type, len(payload), client)
+                    if delay and not conn.closed:
+                        self.limit_rate(conn, delay)
+                elif frame_type == protocol.NICK and conn.data_owner is None:
+                    if self.add_client(client, payload.decode('utf-8')):
+                        conn.nickname = self.nickname_of(client)
+                elif frame_type == protocol.RESUME and conn.data_owner is None:
+                    if self.resume_session(client, protocol.decode_json(payload)):
+                        conn.nickname = self.nickname_of(client)
+                elif frame_type == protocol.COMPRESSION and conn.data_owner is None:
+                    if not self.set_codec(client, payload):
+                        self.remove_client(client)
+                elif frame_type == protocol.DATA_CHANNEL and conn.data_owner is None:
+                    conn.data_owner = self.attach_data_channel(client, payload)
+                    if conn.data_owner is None:
+                        self.remove_client(client)
+                else:
+                    self.remove_client(client)
+        except Exception as e:
+            print(f"Error handling client {conn.nickname}: {e}")
+            self.remove_client(client)
+
+    def remove_client(self, client):
+        self.forget_connection(client)
+        super().remove_client(client)
+
+    def drop_client(self, client):
+        self.forget_connection(client)
+        super().drop_client(client)
+
+    def forget_connection(self, client):
+        conn = self.connections.pop(client, None)
+        if conn is None:
+            return
+        conn.closed = True
+        if conn.events:
+            self.selector.unregister(client)
+            conn.events = 0
+        self.paused_senders.discard(conn)
+        for receiver in conn.blocked_by:
+            receiver.waiting_senders.discard(conn)
+        self.release_senders(conn, force=True)
+        owner = self.sessions.get(conn.data_owner) if conn.data_owner is not None else None
+        if owner is not None:
+            owner.data_channels.discard(client)
+
+    def close_failed(self):
+        # Connections that failed mid-broadcast; one whose write failed may still resume its session
+        while self.closing:
+            conn = self.closing.pop()
+            if conn.broken:
+                self.drop_client(conn.sock)
+            else:
+                self.remove_client(conn.sock)
+
+    def flush_batches(self):
+        now = time.monotonic()
+        while self.batches:
+            conn = next(iter(self.batches))
+            if self.batches[conn] > now:
+                return
+            del self.batches[conn]
+            if not conn.closed:
+                self.flush(conn)
+    
+    def next_timeout(self):
+        deadlines = [sender.pause_deadline for sender in self.paused_senders]
+        if self.timers:
+            deadlines.append(self.timers[0][0])
+        if self.batches:
+            deadlines.append(self.batches[next(iter(self.batches))])
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def start_sweeper(self):
+        if self.handshake_timeout or self.heartbeat_interval or self.idle_timeout:
+            self.call_later(self.wheel.tick, self.sweep_tick)
+
+    def sweep_tick(self):
+        self.sweep()
+        self.call_later(self.wheel.tick, self.sweep_tick)
+
+    def receive(self):
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.start_sweeper()
+        while True:
+            metrics.PROFILER.run(self.handle_events, self.selector.select(self.next_timeout()))
+
+    def handle_events(self, events):
+        for key, mask in events:
+            if key.fileobj is self.server:
+                self.accept_clients()
+            elif key.fileobj is self.wakeup_recv:
+                self.run_pending_calls()
+            else:
+                conn = key.data
+                if mask & selectors.EVENT_WRITE and not conn.closed:
+                    self.flush(conn)
+                    if conn.waiting_senders and not conn.closed:
+                        self.release_senders(conn)
+                if mask & selectors.EVENT_READ and not conn.closed and not conn.paused and not conn.rate_limited:
+                    self.handle_readable(conn)
+
+            self.close_failed()
+
+        self.drop_stalled_receivers()
+        self.flush_batches()
+        self.run_timers()
+        self.close_failed()
@@ -0,0 +1,211 @@
+"""Content-addressed store of files the server has relayed.
+
+Files are keyed by the SHA-256 from their manifest. Small files are kept in
+memory and larger ones in a cache directory, each tier with its own byte
+limit; the least recently used files are evicted first. A file offered again
+is then relayed from here instead of being uploaded a second time.
+"""
+import collections
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+
+
+class CacheEntry:
+    def __init__(self, sha256, size, manifest, data=None, path=None):
+        self.sha256 = sha256
+        self.size = size
+        self.manifest = manifest  # {"sha256", "chunk_size", "chunks"}
+        self.data = data  # bytes when held in memory
+        self.path = path  # file in the cache directory otherwise
+
+    @property
+    def on_disk(self):
+        return self.data is None
+
+    def open(self):
+        """A readable file object; on disk it stays readable even if the entry is evicted meanwhile"""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        return open(self.path, 'rb')
+
+
+class CacheWriter:
+    """Collects one upload and adds it to the cache if it matches its manifest"""
+
+    def __init__(self, cache, size, manifest):
+        self.cache = cache
+        self.size = size
+        self.manifest = manifest
+        self.hash = hashlib.sha256()
+        self.hashed = 0  # Bytes hashed so far; data arriving out of order is hashed at commit
+        self.received = 0
+        self.in_memory = size <= cache.memory_file_limit
+        if self.in_memory:
+            self.file = io.BytesIO()
+        else:
+            self.file = tempfile.NamedTemporaryFile('w+b', dir=cache.directory, prefix='upload-', delete=False)
+
+    def write(self, offset, data):
+        if self.file is None:
+            return
+        self.file.seek(offset)
+        self.file.write(data)
+        if self.hash is not None and offset == self.hashed:
+            self.hash.update(data)
+            self.hashed += len(data)
+        else:
+            self.hash = None
+        self.received += len(data)
+
+    def digest(self):
+        if self.hash is not None:
+            return self.hash.hexdigest()
+        whole = hashlib.sha256()
+        self.file.seek(0)
+        while True:
+            data = self.file.read(1024 * 1024)
+            if not data:
+                return whole.hexdigest()
+            whole.update(data)
+
+    def commit(self):
+        if self.file is None:
+            return None
+        if self.received != self.size or self.digest() != self.manifest['sha256']:
+            self.discard()
+            return None
+        if self.in_memory:
+            data = self.file.getvalue()
+            self.file = None
+            return self.cache.add(CacheEntry(self.manifest['sha256'], self.size, self.manifest, data=data))
+        self.file.close()
+        path = self.file.name
+        self.file = None
+        return self.cache.add(CacheEntry(self.manifest['sha256'], self.size, self.manifest, path=path))
+
+    def discard(self):
+        if self.file is None:
+            return
+        self.file.close()
+        if not self.in_memory:
+            try:
+                os.remove(self.file.name)
+            except OSError:
+                pass
+        self.file = None
+
+
+class FileCache:
+    def __init__(self, directory=None, disk_bytes=1024 * 1024 * 1024, memory_bytes=64 * 1024 * 1024,
+                 memory_file_limit=1024 * 1024):
+        self.directory = directory or tempfile.mkdtemp(prefix='chat-cache-')
+        os.makedirs(self.directory, exist_ok=True)
+        self.disk_bytes = disk_bytes
+        self.memory_bytes = memory_bytes
+        self.memory_file_limit = min(memory_file_limit, memory_bytes)  # Files up to this size are kept in memory
+        self.memory = collections.OrderedDict()  # sha256 -> CacheEntry, least recently used first
+        self.disk = collections.OrderedDict()
+        self.memory_used = 0
+        self.disk_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0  # Upload bytes that did not have to be sent again
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        # Entries left by an earlier run of the server, oldest first
+        manifests = []
+        for entry in os.listdir(self.directory):
+            if entry.startswith('upload-'):
+                os.remove(os.path.join(self.directory, entry))  # Interrupted upload
+            elif entry.endswith('.json'):
+                path = os.path.join(self.directory, entry[:-len('.json')])
+                if os.path.exists(path):
+                    manifests.append((os.path.getmtime(path), path))
+        for _, path in sorted(manifests):
+            try:
+                with open(path + '.json') as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            self.add(CacheEntry(manifest['sha256'], os.path.getsize(path), manifest, path=path))
+
+    def accepts(self, size):
+        return size <= self.memory_file_limit or size <= self.disk_bytes
+
+    def writer(self, size, manifest):
+        """A CacheWriter for an upload, or None if it can't be cached"""
+        if not manifest.get('sha256') or not self.accepts(size):
+            return None
+        return CacheWriter(self, size, manifest)
+
+    def get(self, sha256):
+        with self.lock:
+            for tier in (self.memory, self.disk):
+                entry = tier.get(sha256)
+                if entry is not None:
+                    tier.move_to_end(sha256)
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+            return None
+
+    def record_saved(self, count):
+        with self.lock:
+            self.bytes_saved += count
+
+    def add(self, entry):
+        with self.lock:
+            if entry.sha256 in self.memory or entry.sha256 in self.disk:
+                # Another upload of the same content finished first
+                existing = self.memory.get(entry.sha256) or self.disk.get(entry.sha256)
+                if entry.path is not None and entry.path != existing.path:
+                    os.remove(entry.path)
+                return existing
+            if entry.data is not None:
+                self.memory[entry.sha256] = entry
+                self.memory_used += entry.size
+            else:
+                path = os.path.join(self.directory, entry.sha256)
+                if entry.path != path:
+                    os.replace(entry.path, path)
+                    entry.path = path
+                    with open(path + '.json', 'w') as f:
+                        json.dump(entry.manifest, f)
+                self.disk[entry.sha256] = entry
+                self.disk_used += entry.size
+            self.evict()
+            return entry
+
+    def evict(self):
+        while self.memory_used > self.memory_bytes and self.memory:
+            _, entry = self.memory.popitem(last=False)
+            self.memory_used -= entry.size
+            self.evictions += 1
+        while self.disk_used > self.disk_bytes and self.disk:
+            _, entry = self.disk.popitem(last=False)
+            self.disk_used -= entry.size
+            self.evictions += 1
+            for path in (entry.path, entry.path + '.json'):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.memory) + len(self.disk),
+                'memory_bytes': self.memory_used,
+                'disk_bytes': self.disk_used,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes_saved': self.bytes_saved
+            }
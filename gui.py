@@ -1,12 +1,73 @@
 import tkinter as tk
 from tkinter import filedialog, scrolledtext, messagebox
+import queue
 import threading
-from chat_client import Client
+import time
+from chat_client import Client, EVENT_DISCONNECTED, EVENT_FILE_OFFER
 import os
 
+class ChatView:
+    """The chat log. Any thread may post lines; only the Tk loop touches the widget.
+
+    Posted lines wait in a queue that the Tk loop empties every interval_ms,
+    inserting a batch at once and scrolling once. Past max_lines the oldest
+    lines are deleted, so a busy room can't grow the widget without limit.
+    """
+
+    def __init__(self, root, max_lines=5000, interval_ms=50, batch_lines=2000, **options):
+        self.root = root
+        self.max_lines = max_lines
+        self.interval_ms = interval_ms
+        self.batch_lines = batch_lines  # Most lines inserted per tick, so a flood can't stall the window
+        self.lines = queue.SimpleQueue()
+        self.line_count = 0  # Lines in the widget
+        self.render_seconds = 0.0
+        self.rendered = 0  # Lines inserted so far
+        self.text = scrolledtext.ScrolledText(root, **options)
+        self.text.config(state='disabled')
+        self.root.after(self.interval_ms, self.flush)
+
+    def post(self, line):
+        """Queue a line for display; safe from any thread"""
+        self.lines.put(line)
+
+    def flush(self):
+        batch = []
+        while len(batch) < self.batch_lines:
+            try:
+                batch.append(self.lines.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self.render(batch)
+        self.root.after(self.interval_ms, self.flush)
+
+    def render(self, batch):
+        started = time.perf_counter()
+        text = '\n'.join(batch) + '\n'
+        at_bottom = self.text.yview()[1] >= 1.0  # Don't pull someone reading back down
+        self.text.config(state='normal')
+        self.text.insert(tk.END, text)
+        self.line_count += text.count('\n')
+        excess = self.line_count - self.max_lines
+        if excess > 0:
+            self.text.delete('1.0', f"{excess + 1}.0")
+            self.line_count -= excess
+        self.text.config(state='disabled')
+        if at_bottom:
+            self.text.see(tk.END)
+        self.render_seconds += time.perf_counter() - started
+        self.rendered += len(batch)
+
+    def render_ms_per_1000(self):
+        """Time spent inserting, trimming and scrolling per 1,000 lines"""
+        return self.render_seconds * 1000 * 1000 / self.rendered if self.rendered else 0.0
+
 class ClientGUI:
-    def __init__(self):
-        self.client = Client()
+    def __init__(self, max_lines=5000):
+        self.client = Client(on_message=self.gui_print, on_progress=self.update_progress, on_event=self.handle_event)
+        self.progress = None  # Latest (direction, file name, done, total), shown on the next tick
+        self.upload_finished = False  # Set by the upload thread; the Tk loop re-enables the buttons
         
         # Create main window
         self.root = tk.Tk()
@@ -14,9 +75,8 @@ class ClientGUI:
         self.root.geometry("600x800")
         
         # Create chat display area
-        self.chat_area = scrolledtext.ScrolledText(self.root, wrap=tk.WORD, width=70, height=30)
-        self.chat_area.grid(row=0, column=0, columnspan=3, padx=10, pady=10)
-        self.chat_area.config(state='disabled')
+        self.chat_view = ChatView(self.root, max_lines, wrap=tk.WORD, width=70, height=30)
+        self.chat_view.text.grid(row=0, column=0, columnspan=3, padx=10, pady=10)
         
         # Create message input field
         self.msg_entry = tk.Entry(self.root, width=50)
@@ -33,11 +93,7 @@ class ClientGUI:
         # Progress bar for file transfers
         self.progress_label = tk.Label(self.root, text="")
         self.progress_label.grid(row=2, column=0, columnspan=3)
-        
-        # Override print function for GUI display
-        self.original_print = print
-        import builtins
-        builtins.print = self.gui_print
+        self.root.after(100, self.show_progress)
         
         # Get nickname before starting
         self.get_nickname()
@@ -68,28 +124,46 @@ class ClientGUI:
     def connect_to_server(self):
         if self.client.connect():
             # Start message receiving thread
-            threading.Thread(target=self.receive_messages, daemon=True).start()
+            threading.Thread(target=self.client.receive_messages, daemon=True).start()
             self.gui_print("Connected to server!")
         else:
             messagebox.showerror("Error", "Could not connect to server!")
             self.root.quit()
 
-    def gui_print(self, *args, **kwargs):
-        message = ' '.join(map(str, args))
-        self.chat_area.config(state='normal')
-        self.chat_area.insert(tk.END, message + '\n')
-        self.chat_area.see(tk.END)
-        self.chat_area.config(state='disabled')
+    def gui_print(self, message):
+        # The client starts some lines with a newline to end its progress line on a terminal
+        self.chat_view.post(str(message).lstrip('\n'))
+
+    def handle_event(self, kind, info):
+        # Called from the client's receive thread
+        if kind == EVENT_DISCONNECTED:
+            self.gui_print("Disconnected from server" if info is None else f"Disconnected from server: {info}")
+        elif kind == EVENT_FILE_OFFER:
+            self.progress = ('Receiving', info['name'], 0, info['size'])
+        else:
+            self.client.show_event(kind, info)
+
+    def update_progress(self, direction, file_name, done, total):
+        # Called from the transfer threads; the Tk loop picks it up in show_progress
+        self.progress = (direction, file_name, done, total)
 
-    def update_progress(self, progress):
-        self.root.after(0, lambda: self.progress_label.config(
-            text=f"Transfer Progress: {progress:.1f}%"
-        ))
+    def show_progress(self):
+        if self.upload_finished:
+            self.upload_finished = False
+            self.enable_buttons()
+        progress = self.progress
+        if progress is not None:
+            self.progress = None
+            direction, file_name, done, total = progress
+            percent = (done / total) * 100 if total else 100.0
+            self.progress_label.config(text=f"{direction} {file_name}: {percent:.1f}%")
+        self.root.after(100, self.show_progress)
 
     def send_message(self):
         message = self.msg_entry.get().strip()
         if message:
-            if self.client.send_message(message):
+            # Channel commands are answered by the server in the chat itself
+            if not self.client.handle_command(message) and self.client.send_message(message):
                 # Message sent successfully, display in GUI
                 self.gui_print(f"You: {message}")
             self.msg_entry.delete(0, tk.END)
@@ -104,69 +178,22 @@ class ClientGUI:
                 try:
                     filename = os.path.basename(file_path)
                     self.gui_print(f"You: Sending file '{filename}'...")
-                    # Monitor progress
-                    original_print = print
-                    def progress_print(*args, **kwargs):
-                        if args and isinstance(args[0], str):
-                            if args[0].startswith('\rSending:'):
-                                progress = float(args[0].split('%')[0].split(':')[1])
-                                self.update_progress(progress)
-                            elif not args[0].startswith('You:'):  # Avoid duplicate "You:" messages
-                                self.gui_print(*args, **kwargs)
-                    
-                    import builtins
-                    builtins.print = progress_print
                     self.client.send_file(file_path)
-                    builtins.print = original_print
                 finally:
-                    self.root.after(0, self.enable_buttons)
+                    self.upload_finished = True
             
             threading.Thread(target=file_transfer, daemon=True).start()
 
     def enable_buttons(self):
         self.send_btn.config(state='normal')
         self.file_btn.config(state='normal')
+        self.progress = None
         self.progress_label.config(text="")
 
-    def receive_messages(self):
-        while True:
-            try:
-                data = self.client.client.recv(4096)
-                if not data:
-                    self.gui_print("Disconnected from server")
-                    break
-                
-                try:
-                    # Try to decode as text message
-                    message = data.decode('utf-8')
-                    
-                    if message == "NICK":
-                        self.client.client.send(self.client.nickname.encode('utf-8'))
-                    elif message.startswith("FILE_INCOMING:"):
-                        parts = message.split(':')
-                        filename = parts[1]
-                        filesize = int(parts[2])
-                        sender = parts[3]
-                        
-                        if sender != self.client.nickname:
-                            self.gui_print(f"Receiving file '{filename}' from {sender}")
-                            self.client.handle_file_receive(self.client.client, filename, filesize)
-                            self.gui_print(f"File saved to downloads/{filename}")
-                    else:
-                        self.gui_print(message)
-                        
-                except UnicodeDecodeError:
-                    # Binary data for file transfer
-                    pass
-                    
-            except Exception as e:
-                self.gui_print(f"Error: {e}")
-                break
-
     def on_closing(self):
         if messagebox.askokcancel("Quit", "Do you want to quit?"):
             try:
-                self.client.client.close()
+                self.client.close()
             except:
                 pass
             self.root.quit()
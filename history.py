@@ -0,0 +1,284 @@
+"""Message history: an append-only log of channel lines with an in-memory tail.
+
+Every line said in a channel gets the next sequence number and goes into a
+ring buffer holding the most recent lines. With a directory, a writer thread
+also appends the lines to the log on disk, a batch per write, and calls
+fsync every fsync_interval seconds, so the broadcast path never waits for the
+disk. Lines stay in the ring until they are written, so every line is either
+in memory or on disk.
+
+The log is split into segments named after the first sequence number they
+hold (00000000000000000001.log). A record is a header (sequence number, time,
+channel length, line length) followed by the channel and the line in UTF-8.
+Each segment has an .idx file with the 8-byte offset of every record, so a
+record is found from its sequence number with one lookup. Segments are read
+through mmap. On startup only the last segment is checked, and a record cut
+short by a crash is dropped. The oldest segments are deleted once the log is
+bigger than retention_bytes.
+"""
+import array
+import bisect
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+
+RECORD = struct.Struct('!QdHI')  # sequence number, time, channel length, line length
+MAX_REPLY = 500  # Lines per reply; ask again from the returned sequence number for more
+MAX_SCAN = 20000  # Records looked at per request, so a quiet channel can't make one request read everything
+
+
+class Segment:
+    def __init__(self, directory, base):
+        self.base = base  # Sequence number of its first record
+        self.path = os.path.join(directory, f"{base:020d}.log")
+        self.index_path = os.path.join(directory, f"{base:020d}.idx")
+        self.offsets = array.array('Q')  # Record offsets in the file, in native byte order
+        self.size = 0  # Bytes of complete records
+        self.map = None
+
+    @property
+    def end(self):
+        """Sequence number after its last record"""
+        return self.base + len(self.offsets)
+
+    def load(self):
+        """Read the index of a segment that is no longer written to"""
+        self.size = os.path.getsize(self.path)
+        with open(self.index_path, 'rb') as f:
+            self.offsets.frombytes(f.read())
+
+    def recover(self):
+        """Rebuild the index of the segment that was being written, dropping a torn last record"""
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            _, _, channel_length, line_length = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + channel_length + line_length
+            if end > len(data):
+                break
+            self.offsets.append(offset)
+            offset = end
+        self.size = offset
+        os.truncate(self.path, offset)
+        with open(self.index_path, 'wb') as f:
+            f.write(self.offsets.tobytes())
+
+    def view(self):
+        # Called with the log's lock held. A map that was replaced stays valid
+        # for readers still holding it; it is closed once nothing refers to it.
+        if self.map is None or len(self.map) != self.size:
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.map
+
+    def record(self, view, seq):
+        offset = self.offsets[seq - self.base]
+        seq, when, channel_length, line_length = RECORD.unpack_from(view, offset)
+        start = offset + RECORD.size
+        channel = view[start:start + channel_length].decode('utf-8')
+        line = view[start + channel_length:start + channel_length + line_length].decode('utf-8')
+        return seq, when, channel, line
+
+
+class MessageLog:
+    def __init__(self, directory=None, ring_size=1000, segment_bytes=64 * 1024 * 1024,
+                 retention_bytes=1024 * 1024 * 1024, fsync_interval=1.0):
+        self.directory = directory  # None keeps history in memory only
+        self.ring_size = ring_size
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.fsync_interval = fsync_interval
+        self.ring = collections.deque()  # (seq, time, channel, line), newest last
+        self.pending = []  # Records the writer thread hasn't written yet
+        self.segments = []  # Oldest first
+        self.next_seq = 1
+        self.written = 0  # Last sequence number on disk, fsynced or not
+        self.fsyncs = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.closed = False
+        self.log_fd = self.index_fd = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.open_segments()
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def open_segments(self):
+        bases = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log'))
+        for base in bases:
+            segment = Segment(self.directory, base)
+            if base == bases[-1]:
+                segment.recover()
+            else:
+                segment.load()
+            self.segments.append(segment)
+        if self.segments:
+            self.next_seq = self.segments[-1].end
+            self.written = self.next_seq - 1
+            self.open_files(self.segments[-1])
+        else:
+            self.roll(self.next_seq)
+
+    def open_files(self, segment):
+        for fd in (self.log_fd, self.index_fd):
+            if fd is not None:
+                os.fsync(fd)
+                os.close(fd)
+        self.log_fd = os.open(segment.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.index_fd = os.open(segment.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def roll(self, base):
+        """Start a new segment; called by the writer thread, or before it starts"""
+        segment = Segment(self.directory, base)
+        self.open_files(segment)
+        with self.lock:
+            self.segments.append(segment)
+            total = sum(old.size for old in self.segments)
+            while len(self.segments) > 1 and total > self.retention_bytes:
+                old = self.segments.pop(0)
+                total -= old.size
+                for path in (old.path, old.index_path):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+        return segment
+
+    def append(self, channel, line):
+        """Record a line said in a channel; returns its sequence number"""
+        with self.condition:
+            seq = self.next_seq
+            self.next_seq += 1
+            record = (seq, time.time(), channel, line)
+            self.ring.append(record)
+            if self.directory is not None:
+                self.pending.append(record)
+                self.condition.notify()
+            self.trim_ring()
+        return seq
+
+    def trim_ring(self):
+        # Called with the lock held; lines leave memory only once they are on disk
+        while len(self.ring) > self.ring_size and (self.directory is None or self.ring[0][0] <= self.written):
+            self.ring.popleft()
+
+    def run(self):
+        last_sync = time.monotonic()
+        dirty = False
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closed, self.fsync_interval)
+                batch, self.pending = self.pending, []
+                closed = self.closed
+            if batch:
+                self.write(batch)
+                dirty = True
+            now = time.monotonic()
+            if dirty and (closed or now - last_sync >= self.fsync_interval):
+                os.fsync(self.log_fd)
+                os.fsync(self.index_fd)
+                self.fsyncs += 1
+                dirty = False
+                last_sync = now
+            if closed:
+                return
+
+    def write(self, records):
+        segment = self.segments[-1]
+        buffer = bytearray()
+        offsets = array.array('Q')
+        for seq, when, channel, line in records:
+            if offsets and segment.size + len(buffer) >= self.segment_bytes:
+                self.write_batch(segment, buffer, offsets)
+                segment = self.roll(seq)
+                buffer = bytearray()
+                offsets = array.array('Q')
+            channel_bytes = channel.encode('utf-8')
+            line_bytes = line.encode('utf-8')
+            offsets.append(segment.size + len(buffer))
+            buffer += RECORD.pack(seq, when, len(channel_bytes), len(line_bytes))
+            buffer += channel_bytes
+            buffer += line_bytes
+        self.write_batch(segment, buffer, offsets)
+
+    def write_batch(self, segment, buffer, offsets):
+        write_all(self.log_fd, buffer)
+        write_all(self.index_fd, offsets.tobytes())
+        with self.lock:
+            segment.offsets.extend(offsets)
+            segment.size += len(buffer)
+            self.written = segment.end - 1
+            self.trim_ring()
+
+    def close(self):
+        """Write out and fsync everything appended so far"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def read(self, channel, last=None, since=None, limit=MAX_REPLY):
+        """A channel's lines as [(seq, time, line)], oldest first, and where to continue.
+
+        With since, the lines from that sequence number on and the sequence
+        number to ask for next (None once the reply reaches the newest line).
+        Otherwise the last lines, at most `last`, and None.
+        """
+        with self.lock:
+            ring = list(self.ring)
+            segments = list(self.segments)
+            newest = self.next_seq - 1
+        ring_start = ring[0][0] if ring else newest + 1
+        oldest = segments[0].base if segments else ring_start
+        bases = [segment.base for segment in segments]
+        views = {}
+
+        def record(seq):
+            if seq >= ring_start:
+                return ring[seq - ring_start]
+            segment = segments[bisect.bisect_right(bases, seq) - 1]
+            if segment not in views:
+                with self.lock:
+                    views[segment] = segment.view()
+            return segment.record(views[segment], seq)
+
+        lines = []
+        if since is None:
+            count = min(last or limit, limit)
+            seq = newest
+            while seq >= oldest and len(lines) < count and newest - seq < MAX_SCAN:
+                entry = record(seq)
+                if entry[2] == channel:
+                    lines.append((entry[0], entry[1], entry[3]))
+                seq -= 1
+            lines.reverse()
+            return lines, None
+
+        seq = max(since, oldest)
+        stop = min(newest, seq + MAX_SCAN - 1)
+        while seq <= stop and len(lines) < limit:
+            entry = record(seq)
+            if entry[2] == channel:
+                lines.append((entry[0], entry[1], entry[3]))
+            seq += 1
+        return lines, (seq if seq <= newest else None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'next_seq': self.next_seq,
+                'ring': len(self.ring),
+                'pending': len(self.pending),
+                'segments': len(self.segments),
+                'disk_bytes': sum(segment.size for segment in self.segments),
+                'fsyncs': self.fsyncs
+            }
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
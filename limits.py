@@ -0,0 +1,82 @@
+"""Rate limits and idle timeouts for client connections.
+
+TokenBucket meters what a client sends. A client may go over its bucket by
+one frame; the debt is the time the server stops reading from it, so a
+flooding client is held back by TCP instead of having its frames dropped.
+
+TimerWheel keeps one deadline per connection in a ring of one-second slots.
+Scheduling is an append and each tick looks at one slot, however many
+connections are open, so one sweeper (a thread, or a timer on the event loop)
+watches every connection. Handlers only write a timestamp when they hear
+from a client; the sweeper finds the entry due, compares it with that
+timestamp and schedules it again, instead of the entry being moved on every
+frame.
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """rate tokens a second, of which up to burst can be saved up"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()  # A client's data connections spend from the same bucket
+
+    def spend(self, amount):
+        """Take amount tokens; returns the seconds until the bucket is out of debt, 0 within the limit"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Activity:
+    """When a connection was last heard from, for the sweeper"""
+    __slots__ = ('sock', 'last_heard', 'pinged_at', 'registered', 'due')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.last_heard = time.monotonic()
+        self.pinged_at = 0  # When the last PING went out
+        self.registered = False  # Past the handshake: a client or an upload connection
+        self.due = None  # Deadline of its latest wheel entry; earlier entries are stale
+
+
+class TimerWheel:
+    """Items due at deadlines, rounded up to the next tick.
+
+    A deadline further away than the ring reaches comes up early, on the last
+    slot; the caller checks the item anyway and schedules it again.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)  # The last tick whose slot was taken
+        self.lock = threading.Lock()
+
+    def schedule(self, deadline, item):
+        with self.lock:
+            tick = -int(-deadline // self.tick)
+            tick = min(max(tick, self.current + 1), self.current + len(self.slots))
+            self.slots[tick % len(self.slots)].append(item)
+
+    def expire(self, now):
+        """Take the items due by now"""
+        due = []
+        with self.lock:
+            target = int(now / self.tick)
+            # After a stall longer than the ring every slot is due once
+            for tick in range(max(self.current + 1, target - len(self.slots) + 1), target + 1):
+                slot = self.slots[tick % len(self.slots)]
+                if slot:
+                    due.extend(slot)
+                    slot.clear()
+            self.current = max(self.current, target)
+        return due
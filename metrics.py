@@ -0,0 +1,424 @@
+"""Server metrics, sampled logging and runtime profiling.
+
+Counters and histograms are updated in place on the hot paths and cost one
+uncontended lock each; gauges are computed only when someone asks. A
+Registry renders everything in the Prometheus text format for the HTTP
+endpoint (MetricsServer), and as a short JSON summary for the STATS command.
+
+Profiling is off until asked for. cProfile only sees the thread that enables
+it, so Profiler.run() wraps each unit of work (one frame on a client thread,
+one batch of events on the event loop) and profiles it on its own thread
+while a profile is being taken. tracemalloc snapshots are compared with the
+previous one, so growth shows up directly.
+"""
+import bisect
+import cProfile
+import http.server
+import io
+import json
+import pstats
+import signal
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+SECONDS_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+RATE_BUCKETS = (1e5, 1e6, 1e7, 5e7, 1e8, 5e8, 1e9, 5e9, 1e10)  # Bytes per second
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, (), self.value
+
+
+class Gauge:
+    """A value computed when it is read: function returns a number, or {labels: number}"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if isinstance(value, dict):
+            for labels, number in value.items():
+                yield self.name, labels, number
+        else:
+            yield self.name, (), value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets  # Upper bounds; one more count holds everything above the last
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q-th quantile falls in"""
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield self.name + '_bucket', (('le', format_number(bound)),), cumulative
+        yield self.name + '_bucket', (('le', '+Inf'),), count
+        yield self.name + '_sum', (), total
+        yield self.name + '_count', (), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.started = time.monotonic()
+        self.last_summary = (self.started, {})  # For the rates in summary()
+        self.lock = threading.Lock()
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help, function):
+        return self.add(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += '{' + ','.join(f'{key}="{escape_label(label)}"' for key, label in labels) + '}'
+                lines.append(f"{name} {format_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Counter totals with their rate since the last summary, gauge totals and histogram quantiles"""
+        now = time.monotonic()
+        with self.lock:
+            since, previous = self.last_summary
+            totals = {metric.name: metric.value for metric in self.metrics if metric.kind == 'counter'}
+            self.last_summary = (now, totals)
+        elapsed = max(now - since, 1e-9)
+        summary = {'uptime_s': round(now - self.started, 1)}
+        for metric in self.metrics:
+            if metric.kind == 'counter':
+                total = totals[metric.name]
+                summary[metric.name] = {'total': total, 'per_s': round((total - previous.get(metric.name, 0)) / elapsed, 1)}
+            elif metric.kind == 'gauge':
+                summary[metric.name] = sum(value for _, _, value in metric.samples())
+            else:
+                summary[metric.name] = {
+                    'count': metric.count,
+                    'mean': metric.sum / metric.count if metric.count else None,
+                    'p50': metric.quantile(0.5),
+                    'p99': metric.quantile(0.99)
+                }
+        return summary
+
+
+class ServerMetrics(Registry):
+    """The counters and histograms a chat server updates as it works"""
+
+    def __init__(self):
+        super().__init__()
+        self.connections = self.counter('chat_connections_total', "Clients that completed the NICK handshake")
+        self.disconnections = self.counter('chat_disconnections_total', "Clients that left or were dropped")
+        self.frames_received = self.counter('chat_frames_received_total', "Frames read from clients")
+        self.bytes_received = self.counter('chat_bytes_received_total', "Payload bytes read from clients")
+        self.messages = self.counter('chat_messages_total', "Channel and private chat lines")
+        self.deliveries = self.counter('chat_deliveries_total', "Frames queued for clients by broadcasts")
+        self.delivered_bytes = self.counter('chat_delivered_bytes_total',
+                                            "Bytes queued for clients by broadcasts, before compression")
+        self.broadcast_seconds = self.histogram('chat_broadcast_seconds', "Time to queue one broadcast for every recipient",
+                                                SECONDS_BUCKETS)
+        self.broadcast_recipients = self.histogram('chat_broadcast_recipients', "Recipients per broadcast", COUNT_BUCKETS)
+        self.file_bytes = self.counter('chat_file_bytes_total', "File bytes uploaded to the server")
+        self.file_transfers = self.counter('chat_file_transfers_total', "Uploads completed")
+        self.file_transfer_seconds = self.histogram('chat_file_transfer_seconds', "Time from offer to the last byte",
+                                                    (0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800))
+        self.file_throughput = self.histogram('chat_file_throughput_bytes_per_second', "Upload speed per transfer",
+                                              RATE_BUCKETS)
+        self.tls_handshakes = self.counter('chat_tls_handshakes_total', "TLS handshakes completed")
+        self.tls_resumed = self.counter('chat_tls_resumed_total', "TLS handshakes that resumed an earlier session")
+        self.sessions_resumed = self.counter('chat_sessions_resumed_total', "Dropped clients that resumed their session")
+        self.sessions_expired = self.counter('chat_sessions_expired_total', "Dropped clients whose session ran out")
+        self.frames_replayed = self.counter('chat_frames_replayed_total', "Frames kept for dropped clients and replayed")
+        self.connections_refused = self.counter('chat_connections_refused_total',
+                                                "Connections closed at once because --max-connections were open")
+        self.handshake_timeouts = self.counter('chat_handshake_timeouts_total', "Connections that never finished the handshake")
+        self.idle_evictions = self.counter('chat_idle_evictions_total', "Connections closed after --idle-timeout of silence")
+        self.rate_limited = self.counter('chat_rate_limited_total', "Times a client went over its rate and reading paused")
+
+    def broadcast(self, started, recipients, frame):
+        """Record a broadcast that began at perf_counter() time started"""
+        self.broadcast_seconds.observe(time.perf_counter() - started)
+        self.broadcast_recipients.observe(recipients)
+        self.deliveries.inc(recipients)
+        self.delivered_bytes.inc(recipients * len(frame))
+
+
+def format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class SampledLog:
+    """Prints at most one line per key every interval seconds, counting the rest.
+
+    An interval of 0 prints everything.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.last = {}  # key -> (time of the last line printed, lines suppressed since)
+        self.lock = threading.Lock()
+
+    def log(self, key, message):
+        if not self.interval:
+            print(message)
+            return
+        now = time.monotonic()
+        with self.lock:
+            printed, suppressed = self.last.get(key, (0, 0))
+            if now - printed < self.interval:
+                self.last[key] = (printed, suppressed + 1)
+                return
+            self.last[key] = (now, 0)
+        print(f"{message} (+{suppressed} more)" if suppressed else message)
+
+    def forget(self, key):
+        with self.lock:
+            self.last.pop(key, None)
+
+
+class Profiler:
+    """cProfile for a fixed time across every thread that does work through run()"""
+
+    def __init__(self):
+        self.active = False
+        self.profiles = []  # One per thread that ran something while active
+        self.running = 0  # Calls being profiled right now
+        self.generation = 0  # Which profile is being taken; a thread's earlier profile object is not reused
+        self.local = threading.local()
+        self.condition = threading.Condition()
+
+    def run(self, function, *args):
+        if not self.active:
+            return function(*args)
+        with self.condition:
+            if not self.active:
+                profile = None
+            else:
+                generation, profile = getattr(self.local, 'profile', (None, None))
+                if generation != self.generation:
+                    profile = cProfile.Profile()
+                    self.local.profile = (self.generation, profile)
+                    self.profiles.append(profile)
+                self.running += 1
+        if profile is None:
+            return function(*args)
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
+
+    def start(self):
+        with self.condition:
+            if self.active:
+                return False
+            self.profiles = []
+            self.generation += 1
+            self.active = True
+            return True
+
+    def stop(self, sort='cumulative', limit=40):
+        """Stop profiling and return the merged report as text"""
+        with self.condition:
+            self.active = False
+            self.condition.wait_for(lambda: not self.running, 5.0)
+            profiles, self.profiles = self.profiles, []
+        if not profiles:
+            return "Nothing was profiled: no thread did any work\n"
+        output = io.StringIO()
+        stats = pstats.Stats(profiles[0], stream=output)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        output.write(f"{len(profiles)} threads profiled\n")
+        stats.sort_stats(sort).print_stats(limit)
+        return output.getvalue()
+
+    def profile(self, seconds, sort='cumulative', limit=40):
+        if not self.start():
+            return "A profile is already being taken\n"
+        time.sleep(seconds)
+        return self.stop(sort, limit)
+
+
+class MemoryTracer:
+    """tracemalloc snapshots, each compared with the one before"""
+
+    def __init__(self):
+        self.previous = None
+        self.lock = threading.Lock()
+
+    def start(self, frames=10):
+        tracemalloc.start(frames)
+        self.previous = None
+        return f"Tracing allocations with {frames} frames per traceback\n"
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+        return "Stopped tracing allocations\n"
+
+    def snapshot(self, limit=25):
+        if not tracemalloc.is_tracing():
+            return "Not tracing allocations; start first\n"
+        with self.lock:
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+            previous, self.previous = self.previous, snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Traced memory: {current / 1e6:.1f} MB now, {peak / 1e6:.1f} MB peak"]
+        if previous is None:
+            lines.append(f"Top {limit} allocation sites:")
+            lines.extend(str(stat) for stat in snapshot.statistics('lineno')[:limit])
+        else:
+            lines.append(f"Top {limit} changes since the last snapshot:")
+            lines.extend(str(stat) for stat in snapshot.compare_to(previous, 'lineno')[:limit])
+        return '\n'.join(lines) + '\n'
+
+
+PROFILER = Profiler()
+MEMORY = MemoryTracer()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """GET /metrics, /stats, /profile?seconds=10&sort=tottime&limit=40 and
+    /tracemalloc?action=start|snapshot|stop&limit=25"""
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        registry = self.server.registry
+        try:
+            if url.path == '/metrics':
+                self.reply(registry.render(), 'text/plain; version=0.0.4')
+            elif url.path == '/stats':
+                self.reply(json.dumps(registry.summary(), indent=1) + '\n', 'application/json')
+            elif url.path == '/profile':
+                self.reply(PROFILER.profile(float(query.get('seconds', 10)), query.get('sort', 'cumulative'),
+                                            int(query.get('limit', 40))))
+            elif url.path == '/tracemalloc':
+                action = query.get('action', 'snapshot')
+                if action == 'start':
+                    self.reply(MEMORY.start(int(query.get('frames', 10))))
+                elif action == 'stop':
+                    self.reply(MEMORY.stop())
+                else:
+                    self.reply(MEMORY.snapshot(int(query.get('limit', 25))))
+            else:
+                self.send_error(404)
+        except ValueError as e:
+            self.send_error(400, str(e))
+
+    def reply(self, text, content_type='text/plain'):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', f"{content_type}; charset=utf-8")
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown out the server's own output
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, registry, host='127.0.0.1', port=9100):
+        super().__init__((host, port), MetricsHandler)
+        self.registry = registry
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        print(f"Metrics on http://{host}:{self.server_address[1]}/metrics")
+
+
+def install_signal_handlers():
+    """SIGUSR1 starts a profile and prints it on the next SIGUSR1; SIGUSR2 prints a tracemalloc snapshot,
+    starting tracing the first time. Does nothing where the signals don't exist (Windows)"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    def toggle_profile(signum, frame):
+        if not PROFILER.start():
+            # Printed from a thread: stop() waits for calls in progress, possibly on this very thread
+            threading.Thread(target=lambda: print(PROFILER.stop()), daemon=True).start()
+        else:
+            print("Profiling; send SIGUSR1 again for the report")
+
+    def memory_snapshot(signum, frame):
+        print(MEMORY.start() if not tracemalloc.is_tracing() else MEMORY.snapshot())
+
+    signal.signal(signal.SIGUSR1, toggle_profile)
+    signal.signal(signal.SIGUSR2, memory_snapshot)
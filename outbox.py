@@ -0,0 +1,328 @@
+"""Bounded per-client send queues.
+
+Broadcasting encodes a frame once and puts the same bytes object into every
+recipient's Outbox, so a slow reader only ever holds up its own queue.
+
+With a batch delay set, frames are held for up to that long (or until
+batch_bytes are queued) and then written together with one sendmsg call,
+instead of one send per frame.
+"""
+import collections
+import socket
+import ssl
+import threading
+
+from relay import RelayStream
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, DISCONNECT)
+
+# Flag for a send that never blocks; not available on every platform
+NONBLOCKING_SEND = getattr(socket, 'MSG_DONTWAIT', 0)
+
+# Buffers per sendmsg call; Linux refuses more than IOV_MAX (1024)
+MAX_BATCH_FRAMES = 512
+
+
+class Outbox:
+    """Queue of encoded frames waiting to be written to one client.
+
+    When the queue is full, chat frames follow the slow-consumer policy: the
+    oldest queued chat lines are dropped, or the client is disconnected. File
+    frames are never dropped; the sender is expected to wait until
+    has_room() instead (backpressure).
+    """
+
+    def __init__(self, max_bytes=1024 * 1024, max_frames=1000, policy=DROP_OLDEST,
+                 batch_delay=0, batch_bytes=64 * 1024):
+        self.frames = collections.deque()  # (data or RelayStream, droppable)
+        self.offset = 0  # Bytes of the head frame already written
+        self.bytes = 0
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.policy = policy
+        self.batch_delay = batch_delay  # Seconds to hold frames so they are written together; 0 sends at once
+        self.batch_bytes = batch_bytes  # Write a batch as soon as this much is queued
+        self.high_water = 0  # Deepest the queue has been, in bytes
+        self.dropped = 0
+        self.sent = 0
+        self.writes = 0  # Send calls made, one per frame or one per batch
+        self.closed = False
+
+    def has_room(self, size=0):
+        return self.bytes + size <= self.max_bytes and len(self.frames) < self.max_frames
+
+    def put(self, data, droppable=False):
+        """Queue a frame. Returns False if the client should be disconnected."""
+        if self.closed:
+            return True
+        if droppable and len(data) > self.max_bytes:
+            # Would not fit even in an empty queue
+            if self.policy == DISCONNECT:
+                return False
+            self.dropped += 1
+            return True
+        if droppable and not self.has_room(len(data)):
+            if self.policy == DISCONNECT:
+                return False
+            while not self.has_room(len(data)) and self.drop_oldest():
+                pass
+            if not self.has_room(len(data)):
+                # Everything queued is file data; drop the new line instead
+                self.dropped += 1
+                return True
+
+        self.frames.append((data, droppable))
+        self.bytes += len(data)
+        if self.bytes > self.high_water:
+            self.high_water = self.bytes
+        return True
+
+    def put_stream(self, stream):
+        """Queue a spooled file for this client; it is sent a chunk at a time between other frames"""
+        if self.closed:
+            stream.close()
+            return
+        stream.outbox = self
+        self.frames.append((stream, False))
+        self.wake()
+
+    def ready(self):
+        """True if the head of the queue can be written now.
+
+        Streams still waiting for upload data are moved behind frames that can go out.
+        """
+        for _ in range(len(self.frames)):
+            head = self.frames[0][0]
+            if not isinstance(head, RelayStream) or head.ready():
+                return True
+            self.frames.rotate(-1)
+        return False
+
+    def stream_sent(self, stream, finished):
+        # Called with the stream at the head of the queue after it wrote a chunk
+        if not self.frames or self.frames[0][0] is not stream:
+            return
+        if finished:
+            self.frames.popleft()
+            self.sent += 1
+            stream.close()
+        elif len(self.frames) > 1:
+            # Let queued chat lines through between file chunks
+            self.frames.rotate(-1)
+
+    def wake(self):
+        """Called when a queued stream has new data to send"""
+        pass
+
+    def cancel_stream(self, transfer_id):
+        """Stop relaying a file this client has said it does not need"""
+        for data, _ in self.frames:
+            if isinstance(data, RelayStream) and data.relay.transfer_id == transfer_id:
+                data.cancel()
+        self.wake()
+
+    def drop_oldest(self):
+        # A partly written head frame has to be finished, or the stream breaks
+        for index in range(1 if self.offset else 0, len(self.frames)):
+            data, droppable = self.frames[index]
+            if droppable:
+                del self.frames[index]
+                self.bytes -= len(data)
+                self.dropped += 1
+                return True
+        return False
+
+    def pop(self):
+        data, _ = self.frames.popleft()
+        self.bytes -= len(data)
+        self.offset = 0
+        self.sent += 1
+        return data
+
+    def batch(self):
+        """Buffers for the frames at the head of the queue, up to batch_bytes, to send with one sendmsg"""
+        buffers = []
+        size = 0
+        for data, _ in self.frames:
+            if isinstance(data, RelayStream) or len(buffers) == MAX_BATCH_FRAMES:
+                break
+            if buffers and size + len(data) > self.batch_bytes:
+                break
+            buffers.append(memoryview(data)[self.offset:] if not buffers else data)
+            size += len(buffers[-1])
+        return buffers
+
+    def consume(self, sent):
+        """Remove what a sendmsg of batch() wrote from the head of the queue"""
+        self.writes += 1
+        while sent:
+            remaining = len(self.frames[0][0]) - self.offset
+            if sent < remaining:
+                self.offset += sent
+                return
+            sent -= remaining
+            self.pop()
+
+    def pop_batch(self):
+        """Take the buffers of batch() off the queue, for a writer that sends them itself"""
+        buffers = self.batch()
+        for _ in buffers:
+            self.pop()
+        self.writes += 1
+        return buffers
+
+    def close(self):
+        self.closed = True
+        for data, _ in self.frames:
+            if isinstance(data, RelayStream):
+                data.close()
+        self.frames.clear()
+        self.bytes = 0
+
+    def take_unsent(self):
+        """Close the queue and return the frames it still held, for a client that may resume its session.
+
+        A partly written head frame is returned whole; the client drops the part it got. Streams are left out.
+        """
+        frames = [data for data, _ in self.frames if not isinstance(data, RelayStream)]
+        self.close()
+        return frames
+
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'bytes': self.bytes,
+            'high_water': self.high_water,
+            'dropped': self.dropped,
+            'sent': self.sent,
+            'writes': self.writes
+        }
+
+
+class ThreadedOutbox(Outbox):
+    """Outbox drained by its own writer thread with blocking sends"""
+
+    def __init__(self, sock, on_error, **kwargs):
+        super().__init__(**kwargs)
+        self.sock = sock
+        self.on_error = on_error  # Called with the socket if a send fails
+        self.condition = threading.Condition()
+        self.writing = False  # The writer thread is in the middle of a send
+        # An SSLSocket takes no send flags, so TLS connections always go through the writer thread
+        self.fast_path = bool(NONBLOCKING_SEND) and not isinstance(sock, ssl.SSLSocket)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, data, droppable=False):
+        with self.condition:
+            fits = not droppable or len(data) <= self.max_bytes
+            if (not self.frames and not self.writing and not self.closed and self.fast_path and not self.batch_delay
+                    and fits):
+                # Fast path: hand the frame to the kernel right away instead of
+                # waking the writer thread, as long as the socket has room
+                try:
+                    sent = self.sock.send(data, NONBLOCKING_SEND)
+                except BlockingIOError:
+                    sent = 0
+                except OSError:
+                    sent = 0  # The writer thread reports the error
+                self.writes += 1
+                if sent == len(data):
+                    self.sent += 1
+                    return True
+                # Once part of the frame is on the wire the rest has to follow, or the stream breaks
+                accepted = super().put(data, droppable and not sent)
+                self.offset = sent
+            else:
+                accepted = super().put(data, droppable)
+            self.condition.notify_all()
+            return accepted
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def put_stream(self, stream):
+        with self.condition:
+            super().put_stream(stream)
+
+    def cancel_stream(self, transfer_id):
+        with self.condition:
+            super().cancel_stream(transfer_id)
+
+    def wait_for_room(self, timeout):
+        """Block until the queue is under its limits; returns False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.closed or self.has_room(), timeout)
+
+    def close(self):
+        with self.condition:
+            super().close()
+            self.condition.notify_all()
+
+    def take_unsent(self):
+        with self.condition:
+            return super().take_unsent()
+
+    def stats(self):
+        with self.condition:
+            return super().stats()
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.writing = False
+                self.condition.wait_for(lambda: self.closed or self.ready())
+                if self.batch_delay and not self.closed and not isinstance(self.frames[0][0], RelayStream):
+                    # Let more frames queue up so they go out in one call
+                    self.condition.wait_for(lambda: self.closed or self.bytes >= self.batch_bytes, self.batch_delay)
+                    if not self.closed and not self.ready():
+                        continue
+                if self.closed:
+                    return
+                head = self.frames[0][0]
+                buffers = None
+                if isinstance(head, RelayStream):
+                    stream = head  # Stays queued until it has sent everything
+                elif self.batch_delay:
+                    stream = None
+                    buffers = self.pop_batch()
+                else:
+                    stream = None
+                    offset = self.offset
+                    data = self.pop()
+                    self.writes += 1
+                self.writing = True
+                self.condition.notify_all()
+
+            try:
+                if buffers is not None:
+                    sendmsg_all(self.sock, buffers)
+                elif stream is None:
+                    self.sock.sendall(memoryview(data)[offset:])
+                else:
+                    finished = stream.send_some(self.sock)
+            except OSError:
+                self.on_error(self.sock)
+                return
+
+            if stream is not None:
+                with self.condition:
+                    self.stream_sent(stream, finished)
+
+
+def sendmsg_all(sock, buffers):
+    """sendall for a list of buffers on a blocking socket"""
+    if isinstance(sock, ssl.SSLSocket):
+        # No sendmsg over TLS; one write also makes one TLS record instead of one per frame
+        sock.sendall(b''.join(buffers))
+        return
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
@@ -0,0 +1,225 @@
+"""Wire format shared by the server, the command-line client and the GUI.
+
+Every message is a frame: a 1-byte type, a 4-byte big-endian payload length
+and the payload itself. Text payloads are UTF-8, control payloads are JSON and
+FILE_DATA payloads are a 4-byte transfer id and an 8-byte file offset followed
+by raw file bytes, so file contents never have to be told apart from chat text
+by trying to decode them.
+
+Any frame may also travel as a COMPRESSED frame once compression has been
+negotiated; decoders given the codecs (compression.DECODERS) expand those
+back into the original frame.
+"""
+import json
+import struct
+
+HEADER = struct.Struct('!BI')
+FILE_CHUNK = struct.Struct('!IQ')  # transfer id, file offset
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+# Frame types
+NICK = 1           # server -> client: request, {"compression": [codec names]} or empty; client -> server: the nickname
+CHAT = 2           # UTF-8 chat line; from a client it goes to the lobby channel
+FILE_OFFER = 3        # client -> server: {"id", "name", "size", "sha256", "chunk_size", "chunks"}, optionally "streams"
+                      #   plus "request" and "ranges" when answering FILE_RESEND
+FILE_INCOMING = 4     # server -> clients: the offer with the server's "id" and "sender"
+FILE_DATA = 5         # transfer id + offset + file bytes
+FILE_COMPLETE = 6     # server -> clients: {"id", "name"}
+FILE_RESUME = 7       # client -> server: {"name", "sender", "sha256", "ranges"} still missing
+FILE_RESEND = 8       # server -> original sender: {"request", "sha256", "ranges"}
+FILE_UNAVAILABLE = 9  # server -> client: {"name", "sha256"} nobody can resend it right now;
+                      #   sender -> server: {"request", "sha256"} in reply to FILE_RESEND
+FILE_ABORT = 10       # server -> clients: {"id", "name"} the sender went away mid-transfer
+FILE_ACCEPT = 11      # server -> sender: {"id", "upload"}; upload is false when the server already has the file,
+                      #   "token" is added when the offer asked for several "streams"
+FILE_SKIP = 12        # client -> server: {"id"} of a FILE_INCOMING the client already has
+DATA_CHANNEL = 13     # first frame on an extra upload connection: {"token"} from FILE_ACCEPT;
+                      #   only FILE_DATA frames follow
+JOIN = 14             # client -> server: {"channel"} to subscribe to
+PART = 15             # client -> server: {"channel"} to leave
+CHANNELS = 16         # client -> server: empty request; server -> client: {"channels": {name: members}, "joined"}
+CHANNEL_MESSAGE = 17  # client -> server: {"channel", "text"}; members get it as a CHAT line
+PRIVATE_MESSAGE = 18  # client -> server: {"to", "text"}; the addressee gets it as a CHAT line
+WHO = 19              # client -> server: empty request; server -> client: {"users": {nickname: server}}
+COMPRESSION = 20      # client -> server, before its nickname: {"codec"} picked from the NICK request
+COMPRESSED = 21       # codec id, original frame type, compressed payload
+HISTORY = 22          # client -> server: {"channel", "last"} or {"channel", "since", "limit"};
+                      # server -> client: {"channel", "messages": [[seq, time, line]], "next"} where next
+                      # is the "since" that continues the reply, or null
+STATS = 23            # client -> server: empty request; server -> client: metrics.Registry.summary()
+SESSION = 24          # server -> client: {"token", "grace"} once registered; after a RESUME it follows the replayed
+                      #   frames and adds "resumed", "replayed" and "lost"
+RESUME = 25           # client -> server, instead of NICK: {"token", "nickname"}; an unknown or expired token
+                      #   registers the nickname as NICK would
+QUIT = 26             # client -> server: empty; ends the session now instead of keeping it for a resume
+PING = 27             # server -> client: empty; sent to a client that has been quiet for a heartbeat interval
+PONG = 28             # client -> server: empty answer to PING, so a quiet client isn't taken for a dead one
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_frame(frame_type, payload=b''):
+    return HEADER.pack(frame_type, len(payload)) + payload
+
+
+def encode_text(frame_type, text):
+    return encode_frame(frame_type, text.encode('utf-8'))
+
+
+def encode_json(frame_type, obj):
+    return encode_frame(frame_type, json.dumps(obj).encode('utf-8'))
+
+
+def encode_file_data(transfer_id, offset, data):
+    return file_data_header(transfer_id, offset, len(data)) + data
+
+
+def original_type(frame):
+    """Type of an encoded frame, looking inside a COMPRESSED one"""
+    return frame[HEADER.size + 1] if frame[0] == COMPRESSED else frame[0]
+
+
+def decode_json(payload):
+    return json.loads(payload.decode('utf-8'))
+
+
+def file_data_header(transfer_id, offset, size):
+    """Start of a FILE_DATA frame whose size bytes of file data are sent separately"""
+    return HEADER.pack(FILE_DATA, FILE_CHUNK.size + size) + FILE_CHUNK.pack(transfer_id, offset)
+
+
+def decode_file_data(payload):
+    """Split a FILE_DATA payload into (transfer_id, offset, data); data is a view, not a copy"""
+    transfer_id, offset = FILE_CHUNK.unpack_from(payload)
+    return transfer_id, offset, memoryview(payload)[FILE_CHUNK.size:]
+
+
+class FrameDecoder:
+    """Incremental decoder: feed it bytes as they arrive, take whole frames out.
+
+    Bytes are appended once and consumed by moving a read offset, so decoding
+    costs O(bytes) however the stream is split into reads.
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD, codecs=None):
+        self.buffer = bytearray()
+        self.start = 0  # Offset of the first unconsumed byte
+        self.max_payload = max_payload
+        self.codecs = codecs or {}  # codec id -> codec for COMPRESSED frames
+
+    def feed(self, data):
+        """Append received bytes (bytes, bytearray or memoryview)"""
+        if self.start and self.start * 2 >= len(self.buffer):
+            # Drop consumed bytes once they make up at least half the buffer
+            del self.buffer[:self.start]
+            self.start = 0
+        self.buffer += data
+
+    def next_frame(self):
+        """Return the next complete (frame_type, payload), or None if more bytes are needed"""
+        if len(self.buffer) - self.start < HEADER.size:
+            return None
+
+        frame_type, length = HEADER.unpack_from(self.buffer, self.start)
+        if length > self.max_payload:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {self.max_payload} byte limit")
+
+        payload_start = self.start + HEADER.size
+        end = payload_start + length
+        if len(self.buffer) < end:
+            return None
+
+        with memoryview(self.buffer) as view:
+            payload = bytes(view[payload_start:end])
+        if end == len(self.buffer):
+            self.buffer.clear()
+            self.start = 0
+        else:
+            self.start = end
+        if frame_type == COMPRESSED:
+            return self.expand(payload)
+        return frame_type, payload
+
+    def expand(self, payload):
+        """The original (frame_type, payload) of a COMPRESSED frame"""
+        codec = self.codecs.get(payload[0]) if len(payload) >= 2 else None
+        if codec is None:
+            raise ProtocolError("Compressed frame with an unknown codec")
+        return payload[1], codec.decompress(memoryview(payload)[2:], self.max_payload)
+
+    def __iter__(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def peek_header(self):
+        """(frame_type, length) of the next frame if its header has arrived, else None"""
+        if len(self.buffer) - self.start < HEADER.size:
+            return None
+        return HEADER.unpack_from(self.buffer, self.start)
+
+    def take_partial(self, view):
+        """Consume the next frame's header and copy its buffered payload bytes into view.
+
+        Returns the number of payload bytes copied; the caller reads the rest itself.
+        """
+        payload_start = self.start + HEADER.size
+        count = min(len(view), len(self.buffer) - payload_start)
+        view[:count] = self.buffer[payload_start:payload_start + count]
+        self.buffer.clear()
+        self.start = 0
+        return count
+
+
+class FrameReader:
+    """Reads frames from a blocking socket through one reused receive buffer.
+
+    Payloads bigger than the buffer are received straight into their own
+    preallocated buffer instead of being accumulated by the decoder.
+    """
+
+    def __init__(self, sock, buffer_size=16384, codecs=None):
+        self.sock = sock
+        self.decoder = FrameDecoder(codecs=codecs)
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+    def read_frame(self):
+        """Return the next (frame_type, payload), or None once the peer has closed"""
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return frame
+            header = self.decoder.peek_header()
+            if header is not None and header[1] > len(self.buffer):
+                return self.read_large_frame(*header)
+            received = self.sock.recv_into(self.buffer)
+            if not received:
+                return None
+            self.decoder.feed(self.view[:received])
+
+    def read_large_frame(self, frame_type, length):
+        if length > self.decoder.max_payload:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {self.decoder.max_payload} byte limit")
+        payload = bytearray(length)
+        view = memoryview(payload)
+        received = self.decoder.take_partial(view)
+        while received < length:
+            count = self.sock.recv_into(view[received:])
+            if not count:
+                return None
+            received += count
+        if frame_type == COMPRESSED:
+            return self.decoder.expand(payload)
+        return frame_type, payload
+
+    def __iter__(self):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return
+            yield frame
@@ -0,0 +1,242 @@
+"""Spooled file relay.
+
+The server writes an upload into a spooled temp file once, and every receiver
+gets its own RelayStream that reads from the spool at that receiver's pace.
+Once the spool has rolled over to disk the file body goes out with
+os.sendfile, so the bytes never pass through Python; receivers on TLS get
+it read and encrypted instead. Receivers that negotiated compression get
+chunks compressed once per codec and shared between them instead.
+"""
+import collections
+import os
+import tempfile
+import threading
+
+import protocol
+import tls
+
+RELAY_CHUNK = 256 * 1024  # File bytes per FILE_DATA frame sent to receivers
+COMPRESSED_CHUNKS = 8  # Compressed chunks kept for receivers that are a little behind
+
+
+class SpoolRelay:
+    def __init__(self, transfer_id, file_name, file_size, sender, memory_limit=1024 * 1024, spool=None):
+        self.transfer_id = transfer_id
+        self.file_name = file_name
+        self.file_size = file_size
+        self.sender = sender
+        self.spool = spool if spool is not None else tempfile.SpooledTemporaryFile(max_size=memory_limit)
+        self.memory_limit = memory_limit
+        self.on_disk = False
+        self.size = 0  # Bytes uploaded so far without gaps
+        self.pending = {}  # offset -> end of ranges that arrived ahead of a gap
+        self.complete = False
+        self.aborted = False
+        self.streams = set()
+        self.compressed = collections.OrderedDict()  # (codec name, offset, count) -> frame
+        self.incompressible = False  # Set once a full chunk did not compress; the rest goes out as is
+        self.lock = threading.Lock()
+
+    def write(self, offset, data):
+        """Store upload bytes. Ranges uploaded in parallel can arrive out of
+        order; receivers only see data up to the first gap."""
+        with self.lock:
+            end = offset + len(data)
+            if not self.on_disk and end > self.memory_limit:
+                # Before writing: an in-memory spool would first grow to the end of this write
+                self.spool.rollover()
+                self.on_disk = True
+            self.spool.seek(offset)
+            self.spool.write(data)
+            if self.on_disk:
+                # os.sendfile reads the descriptor, not Python's write buffer
+                self.spool.flush()
+            if offset > self.size:
+                self.pending[offset] = end
+                return
+            self.size = max(self.size, end)
+            while self.size in self.pending:
+                self.size = self.pending.pop(self.size)
+        self.wake_streams()
+
+    def read(self, offset, count):
+        with self.lock:
+            self.spool.seek(offset)
+            return self.spool.read(count)
+
+    def finish(self):
+        self.complete = True
+        self.wake_streams()
+        self.close_if_unused()
+
+    def abort(self):
+        self.aborted = True
+        self.wake_streams()
+        self.close_if_unused()
+
+    def add_stream(self, stream):
+        with self.lock:
+            self.streams.add(stream)
+
+    def remove_stream(self, stream):
+        with self.lock:
+            self.streams.discard(stream)
+        self.close_if_unused()
+
+    def wake_streams(self):
+        with self.lock:
+            streams = list(self.streams)
+        for stream in streams:
+            if stream.outbox is not None:
+                stream.outbox.wake()
+
+    def close_if_unused(self):
+        with self.lock:
+            if (self.complete or self.aborted) and not self.streams and not self.spool.closed:
+                self.spool.close()
+
+    def compressed_frame(self, compressor, codec, offset, count):
+        """The FILE_DATA frame for a chunk, compressed with codec if that is worth it.
+
+        Each chunk is compressed once and shared by every receiver using the same codec.
+        """
+        key = (codec.name, offset, count)
+        with self.lock:
+            frame = self.compressed.get(key)
+        if frame is not None:
+            return frame
+        raw = protocol.encode_file_data(self.transfer_id, offset, self.read(offset, count))
+        frame = compressor.compress(raw, codec)
+        if frame is raw:
+            if compressor.wants(raw) and count == RELAY_CHUNK:
+                self.incompressible = True
+            return raw
+        with self.lock:
+            self.compressed[key] = frame
+            if len(self.compressed) > COMPRESSED_CHUNKS:
+                self.compressed.popitem(last=False)
+        return frame
+
+    def stream_to(self, outbox, ranges=None, codec=None, compressor=None):
+        """Queue this upload, or just the given [offset, length] ranges of it, for one receiver"""
+        stream = RelayStream(self, ranges, codec, compressor)
+        self.add_stream(stream)
+        outbox.put_stream(stream)
+        return stream
+
+
+class CachedRelay(SpoolRelay):
+    """Relays a complete file from the server's file cache.
+
+    Call finish() once every receiver's stream is queued; until then the file
+    stays open even if the first streams are already done with it.
+    """
+
+    def __init__(self, transfer_id, file_name, entry, sender):
+        super().__init__(transfer_id, file_name, entry.size, sender, memory_limit=0, spool=entry.open())
+        self.on_disk = entry.on_disk
+        self.size = entry.size
+
+
+class RelayStream:
+    """Sends one spooled upload to one receiver as FILE_DATA frames, then FILE_COMPLETE or FILE_ABORT"""
+
+    def __init__(self, relay, ranges=None, codec=None, compressor=None):
+        self.relay = relay
+        self.codec = codec  # Compression the receiver negotiated, if any
+        self.compressor = compressor
+        self.outbox = None  # Set when queued
+        self.ranges = [list(r) for r in ranges] if ranges is not None else [[0, relay.file_size]]
+        self.position = self.ranges[0][0] if self.ranges else 0  # Next file offset to frame
+        self.pending = None  # Frame bytes (header, or header and body) not yet written
+        self.body_offset = 0  # File offset of the body still to go out with sendfile
+        self.body_left = 0
+        self.finished = False
+        self.cancelled = False
+
+    def ready(self):
+        """True if there is something to send right now"""
+        if self.pending or self.body_left or self.cancelled:
+            return True
+        relay = self.relay
+        return self.available() > 0 or relay.complete or relay.aborted
+
+    def available(self):
+        """Uploaded bytes of the current range that are still to be framed"""
+        while self.ranges and self.position >= sum(self.ranges[0]):
+            self.ranges.pop(0)
+            if self.ranges:
+                self.position = self.ranges[0][0]
+        if not self.ranges:
+            return 0
+        return min(self.relay.size, sum(self.ranges[0])) - self.position
+
+    def cancel(self):
+        """Stop after the frame in progress, e.g. because the receiver already has the file"""
+        self.cancelled = True
+
+    def send_some(self, sock):
+        """Write at most one chunk. Returns True once the whole stream has been sent.
+
+        With a non-blocking socket this raises BlockingIOError when the socket
+        is full; the stream keeps its place and can simply be called again.
+        """
+        while True:
+            if self.pending:
+                sent = sock.send(self.pending)
+                self.pending = self.pending[sent:]
+                if not self.pending and not self.body_left:
+                    return self.finished
+                continue
+
+            if self.body_left:
+                sent = self.send_body(sock)
+                self.body_offset += sent
+                self.body_left -= sent
+                if not self.body_left:
+                    return False
+                continue
+
+            relay = self.relay
+            if self.cancelled:
+                self.finished = True
+                return True
+            if relay.aborted:
+                # The receiver keeps what it has and can resume the rest later
+                self.pending = memoryview(protocol.encode_json(protocol.FILE_ABORT, {
+                    'id': relay.transfer_id,
+                    'name': relay.file_name
+                }))
+                self.finished = True
+                continue
+            available = self.available()
+            if available > 0:
+                count = min(available, RELAY_CHUNK)
+                header = protocol.file_data_header(relay.transfer_id, self.position, count)
+                if self.codec is not None and not relay.incompressible:
+                    self.pending = memoryview(relay.compressed_frame(self.compressor, self.codec, self.position, count))
+                elif relay.on_disk and tls.can_sendfile(sock):
+                    self.pending = memoryview(header)
+                    self.body_offset = self.position
+                    self.body_left = count
+                else:
+                    # Small uploads stay in memory; copying them is cheaper than a temp file
+                    self.pending = memoryview(header + relay.read(self.position, count))
+                self.position += count
+                continue
+
+            if relay.complete:
+                self.pending = memoryview(protocol.encode_json(protocol.FILE_COMPLETE, {
+                    'id': relay.transfer_id,
+                    'name': relay.file_name
+                }))
+                self.finished = True
+                continue
+
+            return False  # Waiting for more of the upload
+
+    def send_body(self, sock):
+        return os.sendfile(sock.fileno(), self.relay.spool.fileno(), self.body_offset, self.body_left)
+
+    def close(self):
+        self.relay.remove_stream(self)
@@ -0,0 +1,252 @@
+"""Per-connection session state and the registry of connected clients.
+
+Sessions are looked up by socket and by nickname in O(1), and every channel
+keeps the set of sessions subscribed to it, so a channel message costs one
+send per member however many clients are connected. Broadcasts iterate over
+snapshot tuples, which are only rebuilt after a client has joined or left, so
+handler threads can add and remove clients while others are broadcasting.
+
+A session with a token outlives a dropped connection for a grace period. It
+keeps its nickname and channels, and the frames sent to it meanwhile go to a
+bounded backlog, which is replayed when the client resumes the session on a
+new connection.
+"""
+import collections
+import threading
+import time
+
+import protocol
+
+LOBBY = 'general'  # Every client joins this channel on connect; plain CHAT lines go here
+MAX_CHANNEL_NAME = 32
+
+# File frames belong to transfers that end with the connection; a resumed client gets files like a late joiner
+NOT_REPLAYED = frozenset((protocol.FILE_INCOMING, protocol.FILE_DATA, protocol.FILE_COMPLETE, protocol.FILE_ABORT,
+                          protocol.FILE_ACCEPT))
+
+
+def channel_name(name):
+    """Normalised channel name ('#Python' -> 'python'), or None if it isn't a valid one"""
+    name = name.strip().lstrip('#').lower()
+    if not name or len(name) > MAX_CHANNEL_NAME or any(c.isspace() for c in name):
+        return None
+    return name
+
+
+class Backlog:
+    """Frames kept for a dropped client, oldest first.
+
+    Past max_frames or max_bytes the oldest frames are dropped and counted as lost.
+    """
+
+    def __init__(self, max_bytes=1024 * 1024, max_frames=1000):
+        self.frames = collections.deque()
+        self.bytes = 0
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.lost = 0
+        self.lock = threading.Lock()  # Broadcasts from several threads add frames
+
+    def add(self, frames, front=False):
+        """Keep frames, after the ones already kept or, with front, before them"""
+        frames = [frame for frame in frames if protocol.original_type(frame) not in NOT_REPLAYED]
+        with self.lock:
+            if front:
+                self.frames.extendleft(reversed(frames))
+            else:
+                self.frames.extend(frames)
+            self.bytes += sum(len(frame) for frame in frames)
+            while self.frames and (self.bytes > self.max_bytes or len(self.frames) > self.max_frames):
+                self.bytes -= len(self.frames.popleft())
+                self.lost += 1
+
+    def take(self):
+        """(frames, lost count) kept so far; the backlog starts empty again"""
+        with self.lock:
+            frames, lost = list(self.frames), self.lost
+            self.frames.clear()
+            self.bytes = 0
+            self.lost = 0
+            return frames, lost
+
+
+class Session:
+    __slots__ = ('sock', 'nickname', 'outbox', 'transfers', 'data_channels', 'channels', 'connected_at',
+                 'frames_received', 'bytes_received', 'token', 'backlog', 'dropped_at', 'message_bucket',
+                 'byte_bucket')
+
+    def __init__(self, sock, nickname, outbox=None, token=None, backlog=None):
+        self.sock = sock
+        self.nickname = nickname
+        self.outbox = outbox
+        self.transfers = {}  # client's transfer id -> transfer being uploaded by this client
+        self.data_channels = set()  # Extra upload connections
+        self.channels = set()  # Names of the channels this client has joined
+        self.connected_at = time.monotonic()
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.token = token  # Lets the client resume the session after its connection drops; None can't resume
+        self.backlog = backlog  # Backlog of frames sent while the connection is down
+        self.dropped_at = None  # When the connection dropped, while the session waits for a resume
+        self.message_bucket = None  # limits.TokenBucket for frames and for bytes received; None is unlimited
+        self.byte_bucket = None
+
+    def stats(self):
+        return {
+            'connected_seconds': round(time.monotonic() - self.connected_at, 1),
+            'frames_received': self.frames_received,
+            'bytes_received': self.bytes_received,
+            'uploads': len(self.transfers),
+            'channels': sorted(self.channels)
+        }
+
+
+class Channel:
+    __slots__ = ('name', 'members', 'snapshot', 'stale')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()  # Subscribed sessions
+        self.snapshot = ()
+        self.stale = False
+
+
+class SessionRegistry:
+    def __init__(self):
+        self.by_socket = {}
+        self.by_nickname = {}
+        self.by_token = {}
+        self.channels = {}  # channel name -> Channel; a channel goes away with its last member
+        self.lock = threading.Lock()
+        self.snapshot = ()
+        self.stale = False  # The snapshot needs rebuilding
+
+    def add(self, session):
+        """Register a session; returns False if its nickname is already taken"""
+        with self.lock:
+            if session.nickname in self.by_nickname:
+                return False
+            self.by_socket[session.sock] = session
+            self.by_nickname[session.nickname] = session
+            if session.token is not None:
+                self.by_token[session.token] = session
+            self.stale = True
+            return True
+
+    def remove(self, sock):
+        """Unregister and return the session for a socket; None if it was already gone.
+
+        The session leaves all its channels but keeps their names in
+        session.channels, so the caller can still tell their members.
+        """
+        with self.lock:
+            session = self.by_socket.pop(sock, None)
+            if session is not None:
+                del self.by_nickname[session.nickname]
+                self.by_token.pop(session.token, None)
+                self.stale = True
+                for name in session.channels:
+                    self.unsubscribe(session, name)
+            return session
+
+    def detach(self, session):
+        """Mark a session whose connection dropped as waiting for a resume; returns False if it already was"""
+        with self.lock:
+            if session.dropped_at is not None or self.by_socket.get(session.sock) is not session:
+                return False
+            session.dropped_at = time.monotonic()
+            return True
+
+    def resume(self, token, sock):
+        """Move the waiting session with this token to a new connection; returns it, or None if there is none"""
+        with self.lock:
+            session = self.by_token.get(token)
+            if session is None or session.dropped_at is None:
+                return None
+            del self.by_socket[session.sock]
+            session.sock = sock
+            session.dropped_at = None
+            self.by_socket[sock] = session
+            self.stale = True
+            return session
+
+    def expire(self, session, dropped_at):
+        """Stop a session waiting since dropped_at from being resumed; returns False if it was resumed meanwhile"""
+        with self.lock:
+            if session.dropped_at != dropped_at or self.by_token.get(session.token) is not session:
+                return False
+            del self.by_token[session.token]
+            return True
+
+    def get(self, sock):
+        return self.by_socket.get(sock)
+
+    def find_token(self, token):
+        return self.by_token.get(token)
+
+    def find(self, nickname):
+        return self.by_nickname.get(nickname)
+
+    def all(self):
+        """Tuple of every session, safe to iterate while clients come and go"""
+        if self.stale:
+            with self.lock:
+                if self.stale:
+                    self.snapshot = tuple(self.by_socket.values())
+                    self.stale = False
+        return self.snapshot
+
+    def join(self, session, name):
+        """Subscribe a session to a channel; returns False if it was already a member or has left"""
+        with self.lock:
+            if name in session.channels or self.by_socket.get(session.sock) is not session:
+                return False
+            channel = self.channels.get(name)
+            if channel is None:
+                channel = self.channels[name] = Channel(name)
+            channel.members.add(session)
+            channel.stale = True
+            session.channels.add(name)
+            return True
+
+    def part(self, session, name):
+        """Unsubscribe a session from a channel; returns False if it wasn't a member"""
+        with self.lock:
+            if name not in session.channels:
+                return False
+            session.channels.discard(name)
+            self.unsubscribe(session, name)
+            return True
+
+    def unsubscribe(self, session, name):
+        # Called with the lock held
+        channel = self.channels.get(name)
+        if channel is None:
+            return
+        channel.members.discard(session)
+        channel.stale = True
+        if not channel.members:
+            del self.channels[name]
+
+    def members(self, name):
+        """Tuple of a channel's sessions, safe to iterate while members come and go"""
+        channel = self.channels.get(name)
+        if channel is None:
+            return ()
+        if channel.stale:
+            with self.lock:
+                if channel.stale:
+                    channel.snapshot = tuple(channel.members)
+                    channel.stale = False
+        return channel.snapshot
+
+    def channel_sizes(self):
+        """Member count per channel"""
+        with self.lock:
+            return {name: len(channel.members) for name, channel in self.channels.items()}
+
+    def __contains__(self, sock):
+        return sock in self.by_socket
+
+    def __len__(self):
+        return len(self.by_socket)
@@ -0,0 +1,134 @@
+"""TLS for client connections.
+
+The threaded server and the client use ordinary blocking ssl.SSLSocket
+objects. The event loop can't: a non-blocking SSLSocket raises
+SSLWantWriteError halfway through a frame and must then be handed the same
+bytes again, which the send queues can't promise. TLSSocket instead runs the
+TLS connection through an ssl.SSLObject and two memory BIOs and writes the
+encrypted bytes itself, so to the loop it behaves like a plain non-blocking
+socket.
+
+Session tickets (TLS 1.3) let a client that connected once resume its
+session on its next connection, skipping the certificate exchange. The
+client keeps the session of its chat connection and reuses it for its upload
+connections and its reconnects. Tickets are encrypted with a key the context
+creates, so a context made before forking the workers lets any worker
+resume any other worker's sessions.
+"""
+import os
+import socket
+import ssl
+
+MAX_WRITE = 64 * 1024  # Plaintext bytes encrypted per send call
+MAX_BACKLOG = 256 * 1024  # Encrypted bytes held for a full socket before send refuses more
+
+
+def server_context(certfile, keyfile=None):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    # The kernel encrypts sendfile writes where Python and the kernel support it (kTLS, Python 3.12+)
+    context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+    return context
+
+
+def client_context(cafile=None, verify=True):
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        # For self-signed test certificates only
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    context.options |= getattr(ssl, 'OP_ENABLE_KTLS', 0)
+    return context
+
+
+def can_sendfile(sock):
+    """True if file bytes can go to sock with os.sendfile; TLS connections have to encrypt them first"""
+    return hasattr(os, 'sendfile') and isinstance(sock, socket.socket) and not isinstance(sock, ssl.SSLSocket)
+
+
+class TLSSocket:
+    """The server side of a TLS connection over a non-blocking socket"""
+
+    def __init__(self, sock, context):
+        self.sock = sock
+        self.incoming = ssl.MemoryBIO()
+        self.outgoing = ssl.MemoryBIO()
+        self.tls = context.wrap_bio(self.incoming, self.outgoing, server_side=True)
+        self.handshake_done = False
+        self.backlog = bytearray()  # Encrypted bytes the socket had no room for
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    @property
+    def session_reused(self):
+        return self.tls.session_reused
+
+    def do_handshake(self):
+        """Take the handshake as far as the bytes received allow; returns True once it is done"""
+        try:
+            self.tls.do_handshake()
+        except ssl.SSLWantReadError:
+            return False
+        finally:
+            self.flush()
+        self.handshake_done = True
+        return True
+
+    def recv_into(self, buffer):
+        while True:
+            if self.handshake_done or self.do_handshake():
+                try:
+                    count = self.tls.read(len(buffer), buffer)
+                    self.flush()  # Reading can produce records to send, e.g. a key update
+                    return count
+                except ssl.SSLWantReadError:
+                    pass
+                except ssl.SSLZeroReturnError:
+                    return 0  # The peer closed the TLS session
+            data = self.sock.recv(MAX_BACKLOG)  # Raises BlockingIOError once the socket is empty
+            if not data:
+                return 0
+            self.incoming.write(data)
+
+    def pending(self):
+        """True if received bytes are buffered here, where the selector can't see them"""
+        return self.tls.pending() > 0 or self.incoming.pending > 0
+
+    def send(self, data):
+        """Encrypt up to MAX_WRITE bytes of data; raises BlockingIOError if the connection can't take any now"""
+        if not self.handshake_done:
+            raise BlockingIOError
+        if not self.flush() and len(self.backlog) >= MAX_BACKLOG:
+            raise BlockingIOError
+        count = self.tls.write(memoryview(data)[:MAX_WRITE])
+        self.flush()
+        return count
+
+    def sendmsg(self, buffers):
+        return self.send(b''.join(buffers))
+
+    def flush(self):
+        """Write out encrypted bytes; returns True once none are left"""
+        if self.outgoing.pending:
+            self.backlog += self.outgoing.read()
+        while self.backlog:
+            try:
+                sent = self.sock.send(self.backlog)
+            except BlockingIOError:
+                return False
+            del self.backlog[:sent]
+        return True
+
+    def wants_write(self):
+        return bool(self.backlog) or self.outgoing.pending > 0
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
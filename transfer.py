@@ -0,0 +1,234 @@
+"""Chunk manifests and resumable download state.
+
+A sender hashes its file in fixed-size chunks before offering it. Receivers
+write into a .part file next to a small JSON state file that records which
+chunks have been received and verified, so a dropped transfer can later ask
+for just the chunks that are missing.
+"""
+import hashlib
+import json
+import os
+import time
+
+MIN_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNKS = 16384  # Keeps manifests of very large files to about a megabyte
+PART_SUFFIX = '.part'
+STATE_SUFFIX = '.part.json'
+INDEX_FILE = '.index.json'  # sha256 -> name of every completed download
+
+
+def manifest_chunk_size(file_size):
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size * MAX_CHUNKS < file_size:
+        chunk_size *= 2
+    return chunk_size
+
+
+def build_manifest(path):
+    """Hash a file in chunks: {"sha256", "chunk_size", "chunks"}"""
+    file_size = os.path.getsize(path)
+    chunk_size = manifest_chunk_size(file_size)
+    whole = hashlib.sha256()
+    chunks = []
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            whole.update(data)
+            chunks.append(hashlib.sha256(data).hexdigest())
+    return {'sha256': whole.hexdigest(), 'chunk_size': chunk_size, 'chunks': chunks}
+
+
+def chunk_ranges(indexes, chunk_size, file_size):
+    """Merge chunk indexes into [offset, length] byte ranges"""
+    ranges = []
+    for index in sorted(indexes):
+        offset = index * chunk_size
+        length = min(chunk_size, file_size - offset)
+        if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+            ranges[-1][1] += length
+        else:
+            ranges.append([offset, length])
+    return ranges
+
+
+def split_ranges(ranges, size):
+    """Cut [offset, length] ranges into pieces of at most size bytes"""
+    pieces = []
+    for offset, length in ranges:
+        end = offset + length
+        while offset < end:
+            pieces.append([offset, min(size, end - offset)])
+            offset += size
+    return pieces
+
+
+class Download:
+    """A file being received into downloads/<name>.part"""
+
+    save_interval = 1.0  # Seconds between state file writes while data is arriving
+
+    def __init__(self, directory, info, have=()):
+        self.name = os.path.basename(info['name'])
+        self.path = os.path.join(directory, self.name)
+        self.part_path = self.path + PART_SUFFIX
+        self.state_path = self.path + STATE_SUFFIX
+        self.sender = info['sender']
+        self.size = info['size']
+        self.sha256 = info['sha256']
+        self.chunk_size = info['chunk_size']
+        self.chunks = info['chunks']
+        self.have = set(have)  # Verified chunk indexes
+        self.pending = {}  # chunk index -> bytes written but not yet verified
+        self.received = sum(min(self.chunk_size, self.size - index * self.chunk_size) for index in self.have)
+        self.last_save = 0
+        mode = 'r+b' if os.path.exists(self.part_path) else 'w+b'
+        self.file = open(self.part_path, mode)
+
+    @classmethod
+    def open(cls, directory, info):
+        """Continue an earlier download of the same content, or start a new one"""
+        state = load_state(os.path.join(directory, os.path.basename(info['name']) + STATE_SUFFIX))
+        if state is not None and state['sha256'] == info['sha256']:
+            return cls(directory, info, state['have'])
+        part_path = os.path.join(directory, os.path.basename(info['name']) + PART_SUFFIX)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return cls(directory, info)
+
+    def write(self, offset, data):
+        self.file.seek(offset)
+        self.file.write(data)
+        self.received += len(data)
+
+        # Credit the bytes to every chunk they touch and verify the ones that are full
+        end = offset + len(data)
+        index = offset // self.chunk_size
+        while index * self.chunk_size < end:
+            start = index * self.chunk_size
+            chunk_end = min(start + self.chunk_size, self.size)
+            written = min(end, chunk_end) - max(offset, start)
+            if index not in self.have:
+                self.pending[index] = self.pending.get(index, 0) + written
+                if self.pending[index] >= chunk_end - start:
+                    self.verify(index)
+            index += 1
+
+        if time.monotonic() - self.last_save >= self.save_interval:
+            self.save()
+
+    def verify(self, index):
+        del self.pending[index]
+        self.file.flush()
+        self.file.seek(index * self.chunk_size)
+        data = self.file.read(self.chunk_size)
+        if hashlib.sha256(data).hexdigest() == self.chunks[index]:
+            self.have.add(index)
+
+    def missing(self):
+        return [index for index in range(len(self.chunks)) if index not in self.have]
+
+    def missing_ranges(self):
+        return chunk_ranges(self.missing(), self.chunk_size, self.size)
+
+    def complete(self):
+        return len(self.have) == len(self.chunks)
+
+    def state(self):
+        return {
+            'name': self.name,
+            'sender': self.sender,
+            'size': self.size,
+            'sha256': self.sha256,
+            'chunk_size': self.chunk_size,
+            'chunks': self.chunks,
+            'have': sorted(self.have)
+        }
+
+    def save(self):
+        self.last_save = time.monotonic()
+        with open(self.state_path + '.tmp', 'w') as f:
+            json.dump(self.state(), f)
+        os.replace(self.state_path + '.tmp', self.state_path)
+
+    def close(self):
+        """Close the .part file; returns True if the download was complete and has been moved into place"""
+        self.file.close()
+        if self.complete():
+            os.replace(self.part_path, self.path)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            record_download(os.path.dirname(self.path), self.sha256, self.name)
+            return True
+        self.save()
+        return False
+
+
+def load_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_index(directory):
+    try:
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_download(directory, sha256, name):
+    index = load_index(directory)
+    index[sha256] = name
+    path = os.path.join(directory, INDEX_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+
+def find_download(directory, sha256, size):
+    """Path of a completed download with this content, or None"""
+    name = load_index(directory).get(sha256)
+    if name is None:
+        return None
+    path = os.path.join(directory, name)
+    # A file that was replaced or edited since no longer counts
+    if not os.path.isfile(path) or os.path.getsize(path) != size:
+        return None
+    return path
+
+
+def remove_partial(directory, name):
+    for suffix in (PART_SUFFIX, STATE_SUFFIX):
+        path = os.path.join(directory, os.path.basename(name) + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def resume_request(state):
+    """FILE_RESUME payload asking for the chunks a saved download is missing"""
+    have = set(state['have'])
+    missing = [index for index in range(len(state['chunks'])) if index not in have]
+    return {
+        'name': state['name'],
+        'sender': state['sender'],
+        'sha256': state['sha256'],
+        'ranges': chunk_ranges(missing, state['chunk_size'], state['size'])
+    }
+
+
+def unfinished_downloads(directory):
+    """Saved state of every interrupted download in a directory"""
+    if not os.path.isdir(directory):
+        return []
+    states = []
+    for entry in sorted(os.listdir(directory)):
+        if entry.endswith(STATE_SUFFIX):
+            state = load_state(os.path.join(directory, entry))
+            if state is not None:
+                states.append(state)
+    return states